@@ -0,0 +1,152 @@
+"""
+CPU throughput autotuner: times short training runs of every model over intra-op threads, batch size and
+DataLoader workers, and writes the fastest configuration within a memory ceiling to a profile that trainer.py and
+trainer_sdae_model.py load with --perf_profile.
+"""
+import os
+import sys
+import json
+import time
+import itertools
+import subprocess
+from argparse import ArgumentParser
+from typing import Dict, List, Mapping
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.constants import DATA_DIR
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS = ["Softmax", "DNN", "Capsule", "SDAE"]
+
+
+def build_model(model_name: str, input_size: int):
+    from src.models.softmax_model import SoftmaxModel
+    from src.models.dnn_model import DNNModel
+    from src.models.capsule_model import CapsuleModel
+    from src.models.sdae_model import StackedAutoEncoderModel
+    if model_name == "Softmax":
+        return SoftmaxModel(input_size=input_size)
+    elif model_name == "DNN":
+        return DNNModel(input_size=input_size)
+    elif model_name == "Capsule":
+        # same configuration as trainer.py
+        return CapsuleModel(conv_inputs=1,
+                            conv_outputs=1,
+                            num_primary_units=8,
+                            primary_unit_size=8*61,
+                            num_output_units=2,
+                            output_unit_size=2)
+    elif model_name == "SDAE":
+        return StackedAutoEncoderModel(dimensions=[input_size, 1024, 512, 256, 128], final_activation=None)
+    raise ValueError("Please input the right model type.")
+
+
+def run_trial(args) -> Dict[str, float]:
+    """Time the training steps of one configuration in this process, the configuration is set up by the parent."""
+    import gc
+    import resource
+    import torch
+    from torch.utils.data import DataLoader
+    from src.featurizers.featurizer import load_dataset
+    from src.utils.utils import custom_collate_fn, model_logits, peak_memory_mb
+    torch.set_num_threads(args.num_threads)
+    dataset = load_dataset(args.input_file)
+    dataloader = DataLoader(dataset,
+                            batch_size=args.batch_size,
+                            collate_fn=custom_collate_fn,
+                            shuffle=True,
+                            num_workers=args.num_workers,
+                            persistent_workers=args.num_workers > 0)
+    model = build_model(args.model_name, dataset[0]["input_ids"].shape[0])
+    model.train()
+    samples, step = 0, 0
+    while step < args.warmup_steps + args.steps:
+        for batch in dataloader:
+            if step == args.warmup_steps:
+                start_time = time.time()
+            input_ids, label = batch["input_ids"], batch["label"].view(-1)
+            loss = model.criterion(model_logits(model, input_ids).float(), label)
+            model.optimizer.zero_grad()
+            loss.backward()
+            model.optimizer.step()
+            if step >= args.warmup_steps:
+                samples += len(label)
+            step += 1
+            if step >= args.warmup_steps + args.steps:
+                break
+    elapsed = time.time() - start_time
+    # shut the data loading workers down, the resource usage of children only covers those that were waited for
+    del dataloader
+    gc.collect()
+    # the largest worker counted once per worker, an upper bound as forked workers share pages with this process
+    workers_memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 * args.num_workers
+    return {"samples_per_second": samples / elapsed, "peak_memory_mb": peak_memory_mb("cpu") + workers_memory}
+
+
+def search_space(args) -> List[Mapping[str, int]]:
+    return [{"num_threads": num_threads, "batch_size": batch_size, "num_workers": num_workers}
+            for num_threads, batch_size, num_workers in itertools.product(args.threads, args.batch_sizes, args.workers)
+            # data loading workers compete with the intra-op threads for the cores
+            if num_threads + num_workers <= args.max_cores]
+
+
+def autotune(args) -> Dict[str, Dict]:
+    profile = {}
+    for model_name in args.models:
+        results = []
+        for config in search_space(args):
+            command = [sys.executable, os.path.abspath(__file__), "--trial",
+                       "--model_name", model_name,
+                       "--input_file", args.input_file,
+                       "--steps", str(args.steps),
+                       "--warmup_steps", str(args.warmup_steps)] + \
+                      [item for key, value in config.items() for item in (f"--{key}", str(value))]
+            # the OpenMP pool of the trial is sized before torch starts
+            env = dict(os.environ, OMP_NUM_THREADS=str(config["num_threads"]), MKL_NUM_THREADS=str(config["num_threads"]))
+            result = subprocess.run(command, env=env, cwd=SRC_DIR, stdout=subprocess.PIPE, universal_newlines=True)
+            if result.returncode != 0:
+                print(f"{model_name} {config}: failed")
+                continue
+            measurement = json.loads(result.stdout.strip().splitlines()[-1])
+            fits = measurement["peak_memory_mb"] <= args.memory_limit_mb
+            print(f"{model_name} {config}: {round(measurement['samples_per_second'], 1)} samples/s, "
+                  f"peak memory {round(measurement['peak_memory_mb'], 1)} MB{'' if fits else ' (over the memory limit)'}")
+            if fits:
+                results.append({**config, **measurement})
+        if results:
+            profile[model_name] = max(results, key=lambda result: result["samples_per_second"])
+    return profile
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/train_file.pt'),
+                        help="Path of the dataset to train on.")
+    parser.add_argument("--models", type=str, nargs="+", default=MODELS, choices=MODELS, help="Models to tune.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Candidate intra-op threads.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[32, 64, 128, 256], help="Candidate batch sizes.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="Candidate DataLoader workers.")
+    parser.add_argument("--max_cores", type=int, default=os.cpu_count(), help="Upper bound of threads plus workers.")
+    parser.add_argument("--memory_limit_mb", type=float, default=float("inf"), help="Peak memory ceiling of a configuration.")
+    parser.add_argument("--steps", type=int, default=20, help="Timed training steps per configuration.")
+    parser.add_argument("--warmup_steps", type=int, default=3, help="Untimed training steps per configuration.")
+    parser.add_argument("--output_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'perf_profile.json'),
+                        help="Path of the profile.")
+    # a single configuration, run by the parent in a fresh process
+    parser.add_argument("--trial", action="store_true", help="Run a single configuration.")
+    parser.add_argument("--model_name", type=str, default="Softmax", help="Model of a single configuration.")
+    parser.add_argument("--num_threads", type=int, default=1, help="Threads of a single configuration.")
+    parser.add_argument("--batch_size", type=int, default=128, help="Batch size of a single configuration.")
+    parser.add_argument("--num_workers", type=int, default=0, help="Workers of a single configuration.")
+    args = parser.parse_args()
+    if args.trial:
+        print(json.dumps(run_trial(args)))
+    else:
+        profile = autotune(args)
+        with open(args.output_file, "w") as fp:
+            json.dump(profile, fp, indent=2)
+        print(f"Profile written to {args.output_file}: {profile}")
+    pass
@@ -0,0 +1,77 @@
+"""
+Scaling efficiency of multi-process CPU data-parallel training, run from the src directory:
+python benchmark_distributed.py --models Softmax DNN Capsule --nproc 1 2 4
+Every run writes its models, checkpoints and logs below --output_dir, and the table is also saved as CSV.
+"""
+import os
+import re
+import sys
+import csv
+import subprocess
+from argparse import ArgumentParser
+from typing import List, Optional
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.constants import PROJECT_DIR
+
+THROUGHPUT_PATTERN = re.compile(r"Throughput of (\d+) processes: ([\d.]+) samples/s")
+
+
+def run_trainer(model_name: str, nproc: int, threads_per_process: int, epochs: int, run_dir: str, extra_args: List[str]) -> Optional[float]:
+    """
+    Launch trainer.py with torchrun and parse the throughput of its last epoch.
+    :param run_dir: output directory of the run, so that the models of the default model directory are kept
+    :return: samples per second, or None if training failed
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    command = [sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={nproc}",
+               "trainer.py", "--model_name", model_name, "--device", "cpu", "--epochs", str(epochs),
+               "--num_threads", str(threads_per_process),
+               "--model_dir", run_dir,
+               "--checkpoint_dir", run_dir,
+               "--visualization_dir", run_dir,
+               "--log_path", os.path.join(run_dir, "log")] + extra_args
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads_per_process))
+    result = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    throughputs = [float(match.group(2)) for match in THROUGHPUT_PATTERN.finditer(result.stdout)]
+    if result.returncode != 0 or not throughputs:
+        print(result.stdout[-2000:])
+        return None
+    return throughputs[-1]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=["Softmax", "DNN", "Capsule"], help="Models to benchmark.")
+    parser.add_argument("--nproc", type=int, nargs="+", default=[1, 2, 4], help="Numbers of processes.")
+    parser.add_argument("--total_threads",
+                        type=int,
+                        default=os.cpu_count(),
+                        help="Cores shared by the processes, each process gets total_threads / nproc threads.")
+    parser.add_argument("--epochs", type=int, default=1, help="Epochs per run.")
+    parser.add_argument("--output_dir",
+                        type=str,
+                        default=os.path.join(PROJECT_DIR, 'benchmark'),
+                        help="Output directory of the runs.")
+    parser.add_argument("--output_file", type=str, default=None, help="CSV of the table, defaults to <output_dir>/scaling.csv.")
+    args, extra_args = parser.parse_known_args()
+    rows = []
+    print(f"{'Model':<10}{'Processes':>10}{'Samples/s':>12}{'Speedup':>10}{'Efficiency':>12}")
+    for model_name in args.models:
+        baseline = None  # (processes, throughput) of the first successful run
+        for nproc in args.nproc:
+            throughput = run_trainer(model_name, nproc, max(1, args.total_threads // nproc), args.epochs,
+                                     os.path.join(args.output_dir, f"{model_name}_{nproc}"), extra_args)
+            if throughput is None:
+                print(f"{model_name:<10}{nproc:>10}{'failed':>12}")
+                continue
+            baseline = baseline or (nproc, throughput)
+            speedup = throughput / baseline[1]
+            efficiency = speedup / (nproc / baseline[0])
+            print(f"{model_name:<10}{nproc:>10}{throughput:>12.1f}{speedup:>10.2f}{efficiency:>12.2%}")
+            rows.append({"model": model_name, "processes": nproc, "samples_per_second": round(throughput, 1),
+                         "speedup": round(speedup, 3), "efficiency": round(efficiency, 3)})
+    with open(args.output_file or os.path.join(args.output_dir, "scaling.csv"), "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=["model", "processes", "samples_per_second", "speedup", "efficiency"])
+        writer.writeheader()
+        writer.writerows(rows)
+    pass
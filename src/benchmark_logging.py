@@ -0,0 +1,69 @@
+"""
+Step time of per-step loss logging, run from the src directory:
+python benchmark_logging.py --models Softmax DNN SDAE --device cpu
+Trains every model on random fingerprints, once reading the loss with .item() and writing it to TensorBoard on
+every step as the trainers did before, and once through AsyncStepLogger, and prints the ms/step of both.
+"""
+import os
+import sys
+import time
+import tempfile
+from argparse import ArgumentParser
+from typing import Callable
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.autotune import build_model
+
+
+def time_steps(model_name: str, args, log_step: Callable) -> float:
+    """
+    :param log_step: function of the loss tensor and the step, called after every optimizer step
+    :return: mean ms per timed step
+    """
+    import torch
+    from src.utils.utils import model_logits
+    torch.manual_seed(args.seed)
+    model = build_model(model_name, args.input_size).to(args.device)
+    model.train()
+    input_ids = (torch.rand(args.batch_size, args.input_size, device=args.device) < args.density).float()
+    label = torch.randint(0, 2, (args.batch_size,), device=args.device)
+    for step in range(args.warmup_steps + args.steps):
+        if step == args.warmup_steps:
+            if str(args.device).startswith("cuda"):
+                torch.cuda.synchronize()
+            start_time = time.time()
+        loss = model.criterion(model_logits(model, input_ids).float(), label)
+        model.optimizer.zero_grad()
+        loss.backward()
+        model.optimizer.step()
+        log_step(loss, step)
+    if str(args.device).startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / args.steps * 1000
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", default=["Softmax", "DNN", "SDAE"], help="Models to benchmark.")
+    parser.add_argument("--input_size", type=int, default=3968, help="Fingerprint size of the random inputs.")
+    parser.add_argument("--density", type=float, default=0.01, help="Fraction of set bits of the random inputs.")
+    parser.add_argument("--batch_size", type=int, default=128, help="Batch size.")
+    parser.add_argument("--steps", type=int, default=200, help="Timed training steps per run.")
+    parser.add_argument("--warmup_steps", type=int, default=10, help="Untimed training steps per run.")
+    parser.add_argument("--log_every", type=int, default=50, help="Steps between flushes of AsyncStepLogger.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device (cuda or cpu)")
+    args = parser.parse_args()
+    from torch.utils.tensorboard import SummaryWriter
+    from src.utils.logger import AsyncStepLogger
+    print(f"{'Model':<10}{'item ms/step':>14}{'async ms/step':>15}{'Speedup':>10}")
+    with tempfile.TemporaryDirectory() as log_dir:
+        for model_name in args.models:
+            writer = SummaryWriter(os.path.join(log_dir, model_name, "item"))
+            item_ms = time_steps(model_name, args, lambda loss, step: writer.add_scalar("loss", loss.item(), step))
+            writer.close()
+            step_logger = AsyncStepLogger(SummaryWriter(os.path.join(log_dir, model_name, "async")), args.log_every)
+            async_ms = time_steps(model_name, args, lambda loss, step: step_logger.add_scalar("loss", loss, step))
+            # the last buffer is written outside the timed steps, as the trainers do at epoch end
+            step_logger.close()
+            print(f"{model_name:<10}{item_ms:>14.2f}{async_ms:>15.2f}{item_ms / async_ms:>10.2f}")
+    pass
@@ -0,0 +1,64 @@
+"""
+Check that bf16 training keeps the validation quality of fp32: trains the same model with the same seed once per
+precision and fails when a validation metric of bf16 differs from fp32 by more than the tolerance. Arguments that
+are not known here are passed on to the trainer.
+"""
+import os
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+from typing import Dict, List
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.constants import PROJECT_DIR
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAINERS = {"trainer": "trainer.py", "trainer_sdae_model": "trainer_sdae_model.py"}
+METRICS = ["loss", "auc", "f1", "accuracy"]
+
+
+def train(args, precision: str) -> Dict[str, float]:
+    """Train with the given precision in a fresh process, every run writes to its own directory."""
+    run_dir = os.path.join(args.output_dir, precision)
+    os.makedirs(run_dir, exist_ok=True)
+    metrics_file = os.path.join(run_dir, "metrics.json")
+    command = [sys.executable, os.path.join(SRC_DIR, TRAINERS[args.trainer]),
+               "--precision", precision,
+               "--seed", str(args.seed),
+               "--model_dir", run_dir,
+               "--checkpoint_dir", run_dir,
+               "--visualization_dir", run_dir,
+               "--log_path", os.path.join(run_dir, "log"),
+               "--metrics_file", metrics_file] + args.trainer_args
+    subprocess.run(command, cwd=SRC_DIR, check=True)
+    with open(metrics_file, "r") as fp:
+        return json.load(fp)
+
+
+def compare(reference: Dict[str, float], candidate: Dict[str, float], metrics: List[str], tolerance: float) -> bool:
+    ok = True
+    print(f"{'metric':>10} | {'fp32':>10} | {'bf16':>10} | {'difference':>10}")
+    for metric in metrics:
+        difference = candidate[metric] - reference[metric]
+        within = abs(difference) <= tolerance
+        ok = ok and within
+        print(f"{metric:>10} | {reference[metric]:>10.4f} | {candidate[metric]:>10.4f} | {difference:>+10.4f}"
+              f"{'' if within else ' OVER TOLERANCE'}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--trainer", type=str, default="trainer_sdae_model", choices=list(TRAINERS), help="Trainer to run.")
+    parser.add_argument("--output_dir",
+                        type=str,
+                        default=os.path.join(PROJECT_DIR, 'precision'),
+                        help="Output directory of the runs.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of both runs.")
+    parser.add_argument("--metrics", type=str, nargs="+", default=METRICS, help="Validation metrics to compare.")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Largest allowed absolute difference of a metric.")
+    args, args.trainer_args = parser.parse_known_args()
+    results = {precision: train(args, precision) for precision in ("fp32", "bf16")}
+    if not compare(results["fp32"], results["bf16"], args.metrics, args.tolerance):
+        sys.exit(1)
+    pass
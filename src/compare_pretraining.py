@@ -0,0 +1,67 @@
+"""
+Joint against sequential pretraining of the SDAE model, run from the src directory:
+python compare_pretraining.py --pretrain_epochs 3 --finetune_epochs 5
+Trains trainer_sdae_model.py once per pretraining schedule with the same seed and prints the pretraining time and
+the validation metrics after finetuning. Arguments that are not known here are passed on to the trainer.
+"""
+import os
+import re
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+from typing import Dict, Optional
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.constants import PROJECT_DIR
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEDULES = ["sequential", "joint"]
+PRETRAIN_TIME_PATTERN = re.compile(r"Pretraining \(\w+\) took ([\d.]+) s\.")
+
+
+def train(args, schedule: str) -> Optional[Dict[str, float]]:
+    """
+    Train with the given pretraining schedule in a fresh process, every run writes to its own directory.
+    :return: validation metrics and pretraining seconds, or None if training failed
+    """
+    run_dir = os.path.join(args.output_dir, schedule)
+    os.makedirs(run_dir, exist_ok=True)
+    metrics_file = os.path.join(run_dir, "metrics.json")
+    command = [sys.executable, os.path.join(SRC_DIR, "trainer_sdae_model.py"),
+               "--pretrain_schedule", schedule,
+               "--seed", str(args.seed),
+               "--model_dir", run_dir,
+               "--checkpoint_dir", run_dir,
+               "--visualization_dir", run_dir,
+               "--log_path", os.path.join(run_dir, "log"),
+               "--metrics_file", metrics_file] + args.trainer_args
+    result = subprocess.run(command, cwd=SRC_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    with open(os.path.join(run_dir, "output.log"), "w") as fp:
+        fp.write(result.stdout)
+    pretrain_times = [float(match.group(1)) for match in PRETRAIN_TIME_PATTERN.finditer(result.stdout)]
+    if result.returncode != 0 or not os.path.exists(metrics_file):
+        print(result.stdout[-2000:])
+        return None
+    with open(metrics_file, "r") as fp:
+        metrics = json.load(fp)
+    metrics["pretrain_seconds"] = pretrain_times[-1] if pretrain_times else float("nan")
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--output_dir",
+                        type=str,
+                        default=os.path.join(PROJECT_DIR, 'pretraining'),
+                        help="Output directory of the runs.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of both runs.")
+    args, args.trainer_args = parser.parse_known_args()
+    print(f"{'Schedule':<12}{'Pretrain s':>12}{'AUC':>8}{'F1':>8}{'Accuracy':>10}{'Loss':>8}")
+    for schedule in SCHEDULES:
+        metrics = train(args, schedule)
+        if metrics is None:
+            print(f"{schedule:<12}{'failed':>12}")
+            continue
+        print(f"{schedule:<12}{metrics['pretrain_seconds']:>12.1f}{metrics['auc']:>8.4f}{metrics['f1']:>8.4f}"
+              f"{metrics['accuracy']:>10.4f}{metrics['loss']:>8.4f}")
+    pass
@@ -0,0 +1,180 @@
+"""
+Post-training low-rank compression of the first layer of the SDAE and DNN models.
+"""
+import os
+import sys
+import copy
+import time
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+from argparse import ArgumentParser
+from typing import List, Tuple
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.utils.metrics import Metrics
+from src.utils.utils import custom_collate_fn, load_pickled
+from src.featurizers.featurizer import CSFPDataset, get_dataloader
+from src.models.sdae_model import StackedAutoEncoderModel
+from src.models.dnn_model import DNNModel
+from src.constants import DATA_DIR, MODEL_DIR
+
+
+def get_first_layer(model: nn.Module) -> nn.Module:
+    if isinstance(model, StackedAutoEncoderModel):
+        return model.encoder[0].linear
+    elif isinstance(model, DNNModel):
+        return model.dnn_model[0]
+    raise ValueError("Only the SDAE and DNN models can be compressed.")
+
+
+def set_first_layer(model: nn.Module, layer: nn.Module) -> None:
+    if isinstance(model, StackedAutoEncoderModel):
+        model.encoder[0].linear = layer
+    elif isinstance(model, DNNModel):
+        model.dnn_model[0] = layer
+    else:
+        raise ValueError("Only the SDAE and DNN models can be compressed.")
+
+
+def factorize_linear(U: torch.Tensor, S: torch.Tensor, Vh: torch.Tensor, bias: torch.Tensor, rank: int) -> nn.Sequential:
+    """
+    Build the truncated-SVD pair input -> rank -> output from the SVD W = U diag(S) Vh of a Linear weight.
+    :param U: left singular vectors, [out_features, k]
+    :param S: singular values, [k]
+    :param Vh: right singular vectors, [k, in_features]
+    :param bias: bias of the original Linear unit
+    :param rank: number of singular values to keep
+    :return: Sequential of the two Linear units
+    """
+    sqrt_s = S[:rank].sqrt()
+    first = nn.Linear(Vh.shape[1], rank, bias=False)
+    second = nn.Linear(rank, U.shape[0])
+    first.weight.data.copy_(sqrt_s.unsqueeze(1) * Vh[:rank])
+    second.weight.data.copy_(U[:, :rank] * sqrt_s.unsqueeze(0))
+    second.bias.data.copy_(bias)
+    return nn.Sequential(first, second)
+
+
+def count_parameters(model: nn.Module) -> int:
+    """Parameters used for prediction, the decoder of the SDAE model is only used in pretraining."""
+    decoder = set(map(id, model.decoder.parameters())) if isinstance(model, StackedAutoEncoderModel) else set()
+    return sum(parameter.numel() for parameter in model.parameters() if id(parameter) not in decoder)
+
+
+class Compressor(object):
+    def __init__(self, args):
+        self.args = args
+        self.metrics = Metrics()
+        self.train_dataset = CSFPDataset(self.args.train_input_file)
+        self.validation_dataset = CSFPDataset(self.args.validation_input_file)
+        self.train_dataloader, self.validation_dataloader = get_dataloader(train_dataset=self.train_dataset,
+                                                                           validation_dataset=self.validation_dataset,
+                                                                           collate_fn=custom_collate_fn,
+                                                                           batch_size=self.args.batch_size,
+                                                                           num_workers=self.args.num_workers,
+                                                                           shuffle=False)
+        self.model = load_pickled(self.args.model_file, map_location=self.args.device)
+        pass
+
+    def evaluate(self, model: nn.Module) -> Tuple[float, float]:
+        """
+        Validation AUC from the positive class probability and the mean forward latency per molecule in ms.
+        """
+        model.eval()
+        probabilities, labels, forward_time = [], [], 0.0
+        for batch in self.validation_dataloader:
+            input_ids, label = batch["input_ids"].to(self.args.device), batch["label"].view(-1)
+            with torch.no_grad():
+                start_time = time.time()
+                prediction = model(input_ids)
+                forward_time += time.time() - start_time
+            probabilities.append(torch.softmax(prediction.float(), dim=1)[:, 1].cpu())
+            labels.append(label)
+        probabilities, labels = torch.cat(probabilities).numpy(), torch.cat(labels).numpy()
+        return self.metrics.calculate_auc(labels, probabilities), forward_time / len(labels) * 1000
+
+    def finetune(self, model: nn.Module, epochs: int) -> None:
+        optimizer = torch.optim.Adam(model.parameters(), lr=self.args.finetune_lr)
+        criterion = nn.CrossEntropyLoss()
+        model.train()
+        for epoch in range(epochs):
+            for batch in tqdm(self.train_dataloader, desc=f"Finetune epoch {epoch}: "):
+                input_ids, label = batch["input_ids"].to(self.args.device), batch["label"].view(-1).to(self.args.device)
+                loss = criterion(model(input_ids), label)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+    def compress(self, ranks: List[int], tolerance: float) -> nn.Module:
+        """
+        Replace the first layer with the smallest truncated-SVD pair whose validation AUC is within tolerance
+        of the original model.
+        :param ranks: candidate ranks, tried in ascending order
+        :param tolerance: allowed drop of validation AUC
+        :return: compressed model, or the original model if no rank is within tolerance
+        """
+        baseline_auc, baseline_latency = self.evaluate(self.model)
+        layer = get_first_layer(self.model)
+        U, S, Vh = torch.linalg.svd(layer.weight.data.float(), full_matrices=False)
+        print(f"Original: {count_parameters(self.model)} parameters, auc {round(baseline_auc, 4)}, "
+              f"{round(baseline_latency, 4)} ms/molecule")
+        compressed_model = self.model
+        for rank in sorted(ranks):
+            if rank >= min(layer.weight.shape):
+                # no smaller than the original layer, larger ranks are neither
+                continue
+            # the optimizer the models attach refers to the original first layer, it is not copied but rebuilt
+            optimizer = getattr(self.model, "optimizer", None)
+            candidate = copy.deepcopy(self.model, {id(optimizer): None} if optimizer is not None else {})
+            set_first_layer(candidate, factorize_linear(U, S, Vh, layer.bias.data, rank).to(self.args.device))
+            if optimizer is not None:
+                candidate.optimizer = type(optimizer)(candidate.parameters(), **optimizer.defaults)
+            auc, latency = self.evaluate(candidate)
+            if baseline_auc - auc > tolerance and self.args.finetune_epochs > 0:
+                self.finetune(candidate, self.args.finetune_epochs)
+                auc, latency = self.evaluate(candidate)
+            print(f"Rank {rank}: {count_parameters(candidate)} parameters, auc {round(auc, 4)}, "
+                  f"{round(latency, 4)} ms/molecule")
+            if baseline_auc - auc <= tolerance:
+                compressed_model = candidate
+                print(f"Selected rank {rank}: parameters x{round(count_parameters(self.model) / count_parameters(candidate), 2)} "
+                      f"smaller, latency x{round(baseline_latency / latency, 2)} faster, auc drop {round(baseline_auc - auc, 4)}")
+                break
+        else:
+            print(f"No rank within auc tolerance {tolerance}, keep the original model.")
+        return compressed_model
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--train_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/train_file.pt'),
+                        help="Path of the train dataset.")
+    parser.add_argument("--validation_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/validate_file.pt'),
+                        help="Path of the validation dataset.")
+    parser.add_argument("--model_file",
+                        type=str,
+                        default=os.path.join(MODEL_DIR, 'sdae1024-512-256-128_model-p3-c3-f5.pt'),
+                        help="Path of the trained SDAE or DNN model.")
+    parser.add_argument("--output_file", type=str, default=None, help="Path of the compressed model.")
+    parser.add_argument("--device",
+                        type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="Device (cuda or cpu)")
+    parser.add_argument("--ranks", type=int, nargs="+", default=[16, 32, 64, 128, 256, 512], help="Candidate ranks.")
+    parser.add_argument("--auc_tolerance", type=float, default=0.005, help="Allowed drop of validation AUC.")
+    parser.add_argument("--finetune_epochs", type=int, default=0, help="Epochs of finetuning a factorized candidate.")
+    parser.add_argument("--finetune_lr", type=float, default=0.0001, help="Learning rate of finetuning.")
+    parser.add_argument("--batch_size", type=int, default=128, help="Batch size.")
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of subprocesses for data loading.")
+    args = parser.parse_args()
+    compressor = Compressor(args=args)
+    compressed_model = compressor.compress(args.ranks, args.auc_tolerance)
+    output_file = args.output_file or args.model_file.replace(".pt", "_lowrank.pt")
+    torch.save(compressed_model, output_file)
+    print(f"Saved {output_file}: {round(os.path.getsize(output_file) / 1024 ** 2, 1)} MB, "
+          f"original {round(os.path.getsize(args.model_file) / 1024 ** 2, 1)} MB.")
+    pass
@@ -0,0 +1,12 @@
+"""
+Paths shared by the scripts and models, relative to the working directory the scripts are run from (src/).
+Importing this module has no side effects and needs nothing beyond the standard library.
+"""
+import os
+
+PROJECT_DIR = os.path.dirname(os.getcwd())  # get current working directory
+DATA_DIR = os.path.join(PROJECT_DIR, 'data')
+MODEL_DIR = os.path.join(PROJECT_DIR, 'model')
+VISUALIZATION_DIR = os.path.join(DATA_DIR, 'visualization')
+LOG_DIR = os.path.join(PROJECT_DIR, 'log')
+CHECKPOINT_DIR = os.path.join(PROJECT_DIR, 'checkpoint')
@@ -0,0 +1,110 @@
+"""
+Stratified k-fold cross-validation of the models of trainer.py and trainer_sdae_model.py, the folds train in
+parallel processes on index views of one shared memory-mapped dataset.
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from sklearn.model_selection import StratifiedKFold
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.featurizers.featurizer import MemmapCSFPDataset
+from src.sweep import prepare_memmap
+from src.utils.metrics import Metrics
+from src.constants import PROJECT_DIR, DATA_DIR
+
+CV_DIR = os.path.join(PROJECT_DIR, 'cross_validation')
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class CrossValidation(object):
+    def __init__(self, args):
+        self.args = args
+        self.input_file = prepare_memmap(self.args.input_file, self.args.memmap_dir)
+        self.metrics = Metrics()
+
+    def make_folds(self) -> List[Dict[str, str]]:
+        """
+        Write the train and validation indices of every fold, only the labels of the dataset are read.
+        :return: index files of every fold
+        """
+        labels = np.asarray(MemmapCSFPDataset(self.input_file).labels)
+        splitter = StratifiedKFold(n_splits=self.args.folds, shuffle=True, random_state=self.args.seed)
+        folds = []
+        for fold, (train_indices, validation_indices) in enumerate(splitter.split(np.zeros(len(labels)), labels)):
+            fold_dir = os.path.join(self.args.cv_dir, f"fold_{fold}")
+            os.makedirs(fold_dir, exist_ok=True)
+            folds.append({"dir": fold_dir,
+                          "train": os.path.join(fold_dir, "train_indices.npy"),
+                          "validation": os.path.join(fold_dir, "validation_indices.npy")})
+            np.save(folds[-1]["train"], train_indices)
+            np.save(folds[-1]["validation"], validation_indices)
+        return folds
+
+    def run_fold(self, fold: int, files: Dict[str, str]) -> Dict:
+        metrics_file = os.path.join(files["dir"], "metrics.json")
+        if self.args.trainer == "sdae":
+            command = [sys.executable, os.path.join(SRC_DIR, "trainer_sdae_model.py")]
+        else:
+            command = [sys.executable, os.path.join(SRC_DIR, "trainer.py"), "--model_name", self.args.model_name]
+        command += ["--train_input_file", self.input_file,
+                    "--visualization_dir", files["dir"],
+                    "--validation_input_file", self.input_file,
+                    "--train_index_file", files["train"],
+                    "--validation_index_file", files["validation"],
+                    "--model_dir", files["dir"],
+                    "--checkpoint_dir", files["dir"],
+                    "--log_path", os.path.join(files["dir"], "log"),
+                    "--num_workers", "0",
+                    "--num_threads", str(self.args.threads_per_fold),
+                    "--metrics_file", metrics_file] + self.args.trainer_args
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.args.threads_per_fold), MKL_NUM_THREADS=str(self.args.threads_per_fold))
+        start_time = time.time()
+        with open(os.path.join(files["dir"], "output.log"), "w") as log:
+            returncode = subprocess.call(command, env=env, cwd=SRC_DIR, stdout=log, stderr=subprocess.STDOUT)
+        if returncode != 0 or not os.path.exists(metrics_file):
+            raise RuntimeError(f"Fold {fold} failed, see {os.path.join(files['dir'], 'output.log')}.")
+        with open(metrics_file, "r") as fp:
+            metrics = json.load(fp)
+        print(f"Fold {fold}: auc {round(metrics['auc'], 4)} in {round(time.time() - start_time, 1)} s")
+        return metrics
+
+    def run(self):
+        folds = self.make_folds()
+        with ThreadPoolExecutor(max_workers=self.args.parallel) as executor:
+            fold_metrics = list(executor.map(self.run_fold, range(len(folds)), folds))
+        return self.metrics.aggregate(fold_metrics)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/train_file.pt'),
+                        help="Path of the labeled dataset to split into folds.")
+    parser.add_argument("--memmap_dir",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'memmap'),
+                        help="Directory of the memory-mapped dataset shared by the folds.")
+    parser.add_argument("--cv_dir", type=str, default=CV_DIR, help="Output directory of the folds.")
+    parser.add_argument("--trainer", type=str, default="trainer", choices=["trainer", "sdae"], help="trainer.py or trainer_sdae_model.py.")
+    parser.add_argument("--model_name", type=str, default="Softmax", help="Model of trainer.py (Softmax, DNN or Capsule).")
+    parser.add_argument("--folds", type=int, default=5, help="Number of folds.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the split.")
+    parser.add_argument("--parallel", type=int, default=5, help="Concurrent folds.")
+    parser.add_argument("--threads_per_fold",
+                        type=int,
+                        default=max(1, (os.cpu_count() or 1) // 5),
+                        help="Intra-op threads of every fold.")
+    args, args.trainer_args = parser.parse_known_args()
+    if any(arg.split("=")[0] == "--model_names" for arg in args.trainer_args):
+        # the folds read the flat metrics of a single model, cross-validate one --model_name per run
+        parser.error("--model_names is not supported, cross-validate one --model_name at a time.")
+    summary = CrossValidation(args).run()
+    print(summary.apply(lambda row: f"{row['mean']:.4f} ± {row['std']:.4f}", axis=1).to_string())
+    pass
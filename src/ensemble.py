@@ -0,0 +1,189 @@
+"""
+Ensemble inference of Softmax, DNN, SDAE and Capsule Networks models sharing one featurized batch.
+"""
+import os
+import sys
+import torch
+import numpy as np
+from tqdm import tqdm
+from argparse import ArgumentParser
+from typing import Dict, List, Mapping, Optional
+from torch.utils.data import Dataset, DataLoader
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.utils.metrics import Metrics
+from src.utils.utils import custom_collate_fn, model_logits
+from src.utils.artifact import check_vocab, load_model
+from src.utils.prediction_cache import PredictionCache, fingerprint_hash, model_version
+from src.featurizers.featurizer import CSFPDataset
+from src.constants import DATA_DIR, MODEL_DIR
+
+
+class EnsembleRunner(object):
+    """
+    Load every model once, then featurize and collate each batch once and fan the same input tensor out to all
+    models. Probabilities of the positive class are combined by mean, weighted mean or a stacking logistic
+    regression fitted on a labeled held-out dataset, or out of fold on the scored dataset. With a prediction cache,
+    only the molecules whose fingerprint a model has not scored yet run through it.
+    """
+    def __init__(self,
+                 model_files: Mapping[str, str],
+                 device: str = "cpu",
+                 combine: str = "mean",
+                 weights: Optional[List[float]] = None,
+                 batch_size: int = 128,
+                 num_workers: int = 0,
+                 cache: Optional[PredictionCache] = None,
+                 vocab_file: Optional[str] = None):
+        if combine not in ("mean", "weighted", "stacking"):
+            raise ValueError(f"Unsupported combine method: {combine}.")
+        self.device = device
+        self.combine = combine
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        for model_file in model_files.values():
+            check_vocab(model_file, vocab_file)
+        self.models = {name: load_model(model_file, device) for name, model_file in model_files.items()}
+        self.weights = np.asarray(weights if weights is not None else [1.0] * len(self.models), dtype=np.float64)
+        if len(self.weights) != len(self.models):
+            raise ValueError("The number of weights must equal the number of models.")
+        self.weights = self.weights / self.weights.sum()
+        self.stacker = None
+        self.cache = cache
+        self.versions = {name: model_version(model, vocab_file) for name, model in self.models.items()} \
+            if cache is not None else None
+
+    def predict_models(self, dataset: Dataset) -> Dict[str, np.ndarray]:
+        """
+        Positive class probability of every model in a single pass over the dataset.
+        :return: mapping of model name to probabilities, plus "label" when the dataset has labels
+        """
+        dataloader = DataLoader(dataset,
+                                batch_size=self.batch_size,
+                                collate_fn=custom_collate_fn,
+                                shuffle=False,
+                                num_workers=self.num_workers)
+        probabilities = {name: [] for name in self.models}
+        labels = []
+        for batch in tqdm(dataloader, desc="Ensemble: "):
+            input_ids = batch["input_ids"].to(self.device)
+            if self.cache is None:
+                with torch.no_grad():
+                    for name, model in self.models.items():
+                        probabilities[name].append(torch.softmax(model_logits(model, input_ids).float(), dim=1)[:, 1].cpu())
+            else:
+                fingerprints = [fingerprint_hash(np.flatnonzero(row)) for row in batch["input_ids"].numpy()]
+                for name, model in self.models.items():
+                    probabilities[name].append(torch.tensor(self.predict_cached(name, model, input_ids, fingerprints)))
+            labels.append(batch["label"].view(-1))
+        outputs = {name: torch.cat(probability).numpy() for name, probability in probabilities.items()}
+        outputs["label"] = torch.cat(labels).numpy()
+        return outputs
+
+    def predict_cached(self, name: str, model: torch.nn.Module, input_ids: torch.Tensor, fingerprints: List[str]) -> List[float]:
+        probabilities = [self.cache.get(fingerprint, self.versions[name]) for fingerprint in fingerprints]
+        missing = [row for row, probability in enumerate(probabilities) if probability is None]
+        if missing:
+            with torch.no_grad():
+                logits = model_logits(model, input_ids[missing]).float()
+            for row, probability in zip(missing, torch.softmax(logits, dim=1)[:, 1].cpu().tolist()):
+                probabilities[row] = probability
+                self.cache.put(fingerprints[row], self.versions[name], probability)
+        return probabilities
+
+    def fit_stacking(self, dataset: Dataset) -> None:
+        from sklearn.linear_model import LogisticRegression
+        outputs = self.predict_models(dataset)
+        features = np.stack([outputs[name] for name in self.models], axis=1)
+        self.stacker = LogisticRegression().fit(features, outputs["label"])
+
+    def predict(self, dataset: Dataset) -> Dict[str, np.ndarray]:
+        """
+        Per-model and ensemble probabilities of the positive class.
+        """
+        outputs = self.predict_models(dataset)
+        features = np.stack([outputs[name] for name in self.models], axis=1)
+        if self.combine == "stacking":
+            if self.stacker is None:
+                raise ValueError("Call fit_stacking with a labeled dataset before stacking predictions.")
+            outputs["ensemble"] = self.stacker.predict_proba(features)[:, 1]
+        else:
+            outputs["ensemble"] = features @ self.weights
+        return outputs
+
+    def predict_out_of_fold(self, dataset: Dataset, folds: int = 5, seed: int = 42) -> Dict[str, np.ndarray]:
+        """
+        Per-model probabilities and stacking ensemble probabilities of a labeled dataset, where the stacking model
+        scoring a molecule is fitted on the other folds only, so the ensemble metrics are not fitted to the
+        molecules they are measured on.
+        """
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.model_selection import StratifiedKFold, cross_val_predict
+        outputs = self.predict_models(dataset)
+        features = np.stack([outputs[name] for name in self.models], axis=1)
+        splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+        outputs["ensemble"] = cross_val_predict(LogisticRegression(), features, outputs["label"], cv=splitter,
+                                                method="predict_proba")[:, 1]
+        return outputs
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/validate_file.pt'),
+                        help="Path of the dataset to score.")
+    parser.add_argument("--stacking_input_file",
+                        type=str,
+                        default=None,
+                        help="Path of a labeled held-out dataset to fit the stacking model, not the training data of "
+                             "the models whose probabilities on it are overfit. Defaults to stacking out of fold on the "
+                             "scored dataset.")
+    parser.add_argument("--stacking_folds", type=int, default=5, help="Folds of out of fold stacking.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the stacking folds.")
+    parser.add_argument("--models",
+                        type=str,
+                        nargs="+",
+                        default=[f"SDAE={os.path.join(MODEL_DIR, 'sdae1024-512-256-128_model-p3-c3-f5.pt')}"],
+                        help="Models to ensemble as name=path, the path of a model file or artifact directory.")
+    parser.add_argument("--combine",
+                        type=str,
+                        default="mean",
+                        choices=["mean", "weighted", "stacking"],
+                        help="How to combine the model probabilities.")
+    parser.add_argument("--weights", type=float, nargs="+", default=None, help="Model weights for weighted combine.")
+    parser.add_argument("--output_file", type=str, default=None, help="Path to save the predictions.")
+    parser.add_argument("--device",
+                        type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="Device (cuda or cpu)")
+    parser.add_argument("--batch_size", type=int, default=128, help="Batch size for inference.")
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of subprocesses for data loading.")
+    parser.add_argument("--cache_entries", type=int, default=0, help="Entries of the prediction cache, 0 disables it.")
+    parser.add_argument("--cache_mb", type=float, default=512, help="Size bound of the prediction cache in MB.")
+    parser.add_argument("--smiles_vocab",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'vocab/update_smiles_vocab.pt'),
+                        help="Path of the smiles vocab the datasets were featurized with, part of the cache key.")
+    args = parser.parse_args()
+    runner = EnsembleRunner(model_files=dict(model.split("=", 1) for model in args.models),
+                            device=args.device,
+                            combine=args.combine,
+                            weights=args.weights,
+                            batch_size=args.batch_size,
+                            num_workers=args.num_workers,
+                            cache=PredictionCache(args.cache_entries, int(args.cache_mb * 1024 ** 2)) if args.cache_entries > 0 else None,
+                            vocab_file=args.smiles_vocab)
+    if args.combine == "stacking" and args.stacking_input_file is None:
+        outputs = runner.predict_out_of_fold(CSFPDataset(args.input_file), args.stacking_folds, args.seed)
+    else:
+        if args.combine == "stacking":
+            runner.fit_stacking(CSFPDataset(args.stacking_input_file))
+        outputs = runner.predict(CSFPDataset(args.input_file))
+    metrics = Metrics()
+    for name in list(runner.models) + ["ensemble"]:
+        print(f"Auc of {name}: {round(metrics.calculate_auc(outputs['label'], outputs[name]), 4)}")
+    if runner.cache is not None:
+        print(f"Prediction cache: {runner.cache.stats()}")
+    if args.output_file is not None:
+        torch.save(outputs, args.output_file)
+    pass
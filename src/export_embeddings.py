@@ -0,0 +1,211 @@
+"""
+Export the SDAE encodings of a molecule library: molecules stream through the encoder, up to a chosen layer, in
+batches and the vectors are written straight into a preallocated fp16 or fp32 memory-mapped .npy array. ids.txt
+holds the molecule of every row. The rows are split in units, the shards of a library written by
+FingerPrints.to_shards or fixed ranges of a dataset; a finished unit is marked done, so an interrupted export
+resumes with the units left, and several worker processes export disjoint units into the same array.
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+from argparse import ArgumentParser
+from typing import Dict, Iterator, List
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.constants import DATA_DIR, MODEL_DIR
+
+EMBEDDINGS_FILE = "embeddings.npy"
+IDS_FILE = "ids.txt"
+METADATA_FILE = "metadata.json"
+DONE_DIR = "done"
+
+
+def library_units(library_dir: str) -> List[Dict]:
+    """One unit per library shard, the rows of the shards follow each other in the order of meta.json."""
+    from src.featurizers.featurizer import read_shards
+    shard_prefixes, _ = read_shards(library_dir)
+    units, row = [], 0
+    for prefix in shard_prefixes:
+        size = len(np.load(f"{prefix}.offsets.npy", mmap_mode="r")) - 1
+        units.append({"name": os.path.basename(prefix), "shard": prefix, "start": row, "end": row + size})
+        row += size
+    return units
+
+
+def dataset_units(size: int, unit_size: int) -> List[Dict]:
+    return [{"name": f"rows_{start:09d}", "start": start, "end": min(start + unit_size, size)}
+            for start in range(0, size, unit_size)]
+
+
+def unit_ids(unit: Dict, dataset=None) -> List[str]:
+    from src.featurizers.featurizer import CSFPDataset
+    if "shard" in unit:
+        names_file = f"{unit['shard']}.names.npy"
+        if os.path.exists(names_file):
+            return np.load(names_file).tolist()
+        # shards written before the names were stored
+        return [f"{unit['name']}:{row}" for row in range(unit["end"] - unit["start"])]
+    names = dataset.dataset["molecule_name"] if isinstance(dataset, CSFPDataset) else None
+    return [str(names[row]) if names is not None else str(row) for row in range(unit["start"], unit["end"])]
+
+
+def encoder_layers(model, layer: int):
+    """The encoder units of an SDAE model up to and including layer, negative layers count from the last."""
+    if not hasattr(model, "encoder"):
+        raise ValueError("Only the encoder of an SDAE model can be exported.")
+    return model.encoder[:layer + 1] if layer >= 0 else model.encoder[:len(model.encoder) + layer + 1]
+
+
+def prepare(args) -> Dict:
+    """
+    Preallocate the array and write the id index and metadata, or check that an existing export is the same job.
+    :return: the metadata of the export
+    """
+    from src.utils.artifact import load_model
+    metadata_path = os.path.join(args.output_dir, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "r") as fp:
+            metadata = json.load(fp)
+        job = {"model_file": os.path.abspath(args.model_file),
+               "layer": args.layer,
+               "dtype": args.dtype,
+               "source": os.path.abspath(args.library_dir if args.library_dir is not None else args.input_file)}
+        if any(metadata[key] != value for key, value in job.items()):
+            raise ValueError(f"{args.output_dir} holds the export of {metadata['source']} by {metadata['model_file']} "
+                             f"layer {metadata['layer']} as {metadata['dtype']}, choose another output directory.")
+        return metadata
+    os.makedirs(os.path.join(args.output_dir, DONE_DIR), exist_ok=True)
+    dimension = encoder_layers(load_model(args.model_file, "cpu"), args.layer)[-1].linear.out_features
+    dataset = None
+    if args.library_dir is not None:
+        units = library_units(args.library_dir)
+    else:
+        from src.featurizers.featurizer import load_dataset
+        dataset = load_dataset(args.input_file)
+        units = dataset_units(len(dataset), args.unit_size)
+    rows = units[-1]["end"] if units else 0
+    with open(os.path.join(args.output_dir, IDS_FILE + ".tmp"), "w") as fp:
+        for unit in units:
+            for molecule_id in unit_ids(unit, dataset):
+                fp.write(f"{molecule_id}\n")
+    os.replace(os.path.join(args.output_dir, IDS_FILE + ".tmp"), os.path.join(args.output_dir, IDS_FILE))
+    # a sparse file, the pages are only written by the workers
+    array = np.lib.format.open_memmap(os.path.join(args.output_dir, EMBEDDINGS_FILE),
+                                      mode="w+",
+                                      dtype=np.float16 if args.dtype == "fp16" else np.float32,
+                                      shape=(rows, dimension))
+    del array
+    metadata = {"model_file": os.path.abspath(args.model_file),
+                "layer": args.layer,
+                "dtype": args.dtype,
+                "rows": rows,
+                "dimension": dimension,
+                "source": os.path.abspath(args.library_dir if args.library_dir is not None else args.input_file),
+                "units": units}
+    with open(metadata_path + ".tmp", "w") as fp:
+        json.dump(metadata, fp, indent=2)
+    # written last, an export is only resumed once it is completely prepared
+    os.replace(metadata_path + ".tmp", metadata_path)
+    return metadata
+
+
+def unit_batches(unit: Dict, batch_size: int, input_size: int, dataset=None) -> Iterator:
+    """Dense input batches of the rows of a unit, in row order."""
+    import torch
+    if "shard" in unit:
+        indices = np.load(f"{unit['shard']}.indices.npy", mmap_mode="r")
+        offsets = np.load(f"{unit['shard']}.offsets.npy")
+        for start in range(0, len(offsets) - 1, batch_size):
+            end = min(start + batch_size, len(offsets) - 1)
+            batch = torch.zeros(end - start, input_size)
+            rows = np.repeat(np.arange(end - start), np.diff(offsets[start:end + 1]))
+            batch[torch.from_numpy(rows), torch.from_numpy(np.asarray(indices[offsets[start]:offsets[end]], dtype=np.int64))] = 1.0
+            yield batch
+    else:
+        for start in range(unit["start"], unit["end"], batch_size):
+            yield torch.stack([dataset[row]["input_ids"] for row in range(start, min(start + batch_size, unit["end"]))]).float()
+
+
+def export(args, metadata: Dict) -> int:
+    """
+    Encode the units of this worker that are not done yet.
+    :return: number of rows encoded
+    """
+    import torch
+    from src.utils.artifact import load_model
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    units = [unit for unit in metadata["units"][args.worker_index::args.workers]
+             if not os.path.exists(os.path.join(args.output_dir, DONE_DIR, unit["name"]))]
+    if not units:
+        return 0
+    model = load_model(args.model_file, args.device)
+    encoder = encoder_layers(model, metadata["layer"])
+    input_size = model.encoder[0].linear.in_features
+    dataset = None
+    if "shard" not in units[0]:
+        from src.featurizers.featurizer import load_dataset
+        dataset = load_dataset(metadata["source"])
+    array = np.load(os.path.join(args.output_dir, EMBEDDINGS_FILE), mmap_mode="r+")
+    encoded = 0
+    for unit in units:
+        row = unit["start"]
+        for batch in unit_batches(unit, args.batch_size, input_size, dataset):
+            with torch.no_grad():
+                embeddings = encoder(batch.to(args.device)).float().cpu().numpy()
+            array[row:row + len(embeddings)] = embeddings
+            row += len(embeddings)
+        if row != unit["end"]:
+            raise RuntimeError(f"{unit['name']} has {row - unit['start']} molecules, {unit['end'] - unit['start']} were expected.")
+        array.flush()
+        with open(os.path.join(args.output_dir, DONE_DIR, unit["name"]), "w") as fp:
+            fp.write(f"{unit['start']} {unit['end']}\n")
+        encoded += unit["end"] - unit["start"]
+        print(f"Worker {args.worker_index}: {unit['name']} done, rows {unit['start']} to {unit['end']}.")
+    return encoded
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model_file",
+                        type=str,
+                        default=os.path.join(MODEL_DIR, 'sdae1024-512-256-128_model-p3-c3-f5.pt'),
+                        help="Path of the SDAE model file or artifact directory.")
+    parser.add_argument("--library_dir", type=str, default=None, help="Directory of the library shards to encode.")
+    parser.add_argument("--input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/train_file.pt'),
+                        help="Path of the dataset to encode when no library is given.")
+    parser.add_argument("--output_dir",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'embeddings'),
+                        help="Directory of the embeddings, ids and progress.")
+    parser.add_argument("--layer", type=int, default=-1, help="Encoder layer whose output is exported, -1 for the last.")
+    parser.add_argument("--dtype", type=str, default="fp16", choices=["fp16", "fp32"], help="Type of the stored vectors.")
+    parser.add_argument("--batch_size", type=int, default=1024, help="Batch size.")
+    parser.add_argument("--unit_size", type=int, default=100000, help="Rows of a resumable unit of a dataset.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, each exports every workers-th unit.")
+    parser.add_argument("--worker_index", type=int, default=None, help="Run as this worker of a prepared export.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of every worker.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device (cuda or cpu)")
+    args = parser.parse_args()
+    start_time = time.time()
+    if args.worker_index is not None:
+        with open(os.path.join(args.output_dir, METADATA_FILE), "r") as fp:
+            export(args, json.load(fp))
+    else:
+        metadata = prepare(args)
+        if args.workers == 1:
+            args.worker_index = 0
+            export(args, metadata)
+        else:
+            processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--worker_index", str(index)])
+                         for index in range(args.workers)]
+            if any([process.wait() != 0 for process in processes]):
+                raise RuntimeError("An export worker failed, run the export again to resume.")
+        done = len(os.listdir(os.path.join(args.output_dir, DONE_DIR)))
+        print(f"{done} of {len(metadata['units'])} units of {metadata['rows']} molecules exported to {args.output_dir} "
+              f"in {round(time.time() - start_time, 1)} s.")
+    pass
@@ -1,8 +1,11 @@
-from torch.utils.data import Dataset, DataLoader
-import pandas as pd
+from torch.utils.data import Dataset, DataLoader, IterableDataset, Subset
+import os
+import json
+import random
+import numpy as np
 import torch
 from tqdm import tqdm
-from typing import Optional, Tuple, Callable
+from typing import List, Optional, Tuple, Callable
 from src.utils.utils import assert_statistics
 from src.utils.utils import custom_collate_fn
 
@@ -12,6 +15,7 @@ class CSFPDataset(Dataset):
     """
     def __init__(self, input_file: Optional[str]):
         super(CSFPDataset, self).__init__()
+        self.input_file = input_file
         self.dataset = torch.load(input_file)
         self.input_ids, self.labels = self.dataset["one_hots"], self.dataset["label"]
         pass
@@ -45,6 +49,123 @@ class CSFPDataset(Dataset):
     #     return self.dataset.shape[0]
 
 
+class MemmapCSFPDataset(Dataset):
+    """Read-only CSFPDataset over memory-mapped arrays written by export_memmap, so that several processes share
+    the pages of one dataset instead of each loading its own copy.
+    """
+    def __init__(self, prefix: str):
+        super(MemmapCSFPDataset, self).__init__()
+        self.prefix = prefix
+        self.input_file = f"{prefix}.input_ids.npy"
+        self.input_ids = np.load(self.input_file, mmap_mode="r")
+        self.labels = np.load(f"{prefix}.label.npy", mmap_mode="r")
+        pass
+
+    def __getitem__(self, item: Optional[int]):
+        input_ids = torch.from_numpy(np.asarray(self.input_ids[item], dtype=np.float32))
+        label = torch.tensor(int(self.labels[item]))
+        return {"input_ids": input_ids, "label": label}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+
+def export_memmap(dataset: CSFPDataset, prefix: str) -> MemmapCSFPDataset:
+    """
+    Write the fingerprints and labels of a dataset as .npy files, uint8 for binary fingerprints.
+    :param dataset: dataset to export
+    :param prefix: path prefix of the <prefix>.input_ids.npy and <prefix>.label.npy files
+    :return: the memory-mapped dataset
+    """
+    first = np.asarray(dataset.input_ids[0])
+    binary = all(set(np.unique(np.asarray(input_ids)).tolist()) <= {0, 1} for input_ids in dataset.input_ids)
+    input_ids = np.lib.format.open_memmap(f"{prefix}.input_ids.npy.tmp",
+                                          mode="w+",
+                                          dtype=np.uint8 if binary else np.float32,
+                                          shape=(len(dataset), first.shape[0]))
+    for i, row in enumerate(dataset.input_ids):
+        input_ids[i] = np.asarray(row)
+    input_ids.flush()
+    del input_ids
+    np.save(f"{prefix}.label.npy", np.asarray(dataset.labels, dtype=np.int64).reshape(-1))
+    os.replace(f"{prefix}.input_ids.npy.tmp", f"{prefix}.input_ids.npy")
+    return MemmapCSFPDataset(prefix)
+
+
+def load_dataset(input_file: str, index_file: Optional[str] = None) -> Dataset:
+    """
+    Open a memory-mapped dataset if input_file is the prefix of one, otherwise load the .pt dataset.
+    :param input_file: path of the .pt dataset or prefix of the memory-mapped dataset
+    :param index_file: optional .npy file of indices, e.g. a cross-validation fold, the dataset is then a view
+    of these items without copying them
+    """
+    if os.path.exists(f"{input_file}.input_ids.npy"):
+        dataset = MemmapCSFPDataset(input_file)
+    else:
+        dataset = CSFPDataset(input_file)
+    if index_file is not None:
+        dataset = Subset(dataset, np.load(index_file).tolist())
+    return dataset
+
+
+class ShardedFingerprintDataset(IterableDataset):
+    """
+    Stream the molecules of library shards written by FingerPrints.to_shards. Molecules pass a bounded shuffle
+    buffer as sparse indices and are densified one at a time, so memory does not grow with the library. Items
+    have the same form as a TensorDataset of one tensor, DataLoader workers read disjoint shards.
+    """
+    def __init__(self, shard_prefixes: List[str], input_size: int, shuffle_buffer: int = 10000, seed: int = 42):
+        """
+        :param shard_prefixes: paths of the shards without the .indices.npy / .offsets.npy suffix
+        :param input_size: size of the dense encoding, the size of the dictionary
+        :param shuffle_buffer: number of molecules in the shuffle buffer, 0 keeps the shard order
+        :param seed: seed of the shuffle
+        """
+        super(ShardedFingerprintDataset, self).__init__()
+        self.shard_prefixes = shard_prefixes
+        self.input_size = input_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+
+    def _densify(self, indices: np.ndarray):
+        input_ids = torch.zeros(self.input_size)
+        input_ids[torch.from_numpy(np.asarray(indices, dtype=np.int64))] = 1.0
+        return (input_ids,)
+
+    def _sparse_items(self, shard_prefixes: List[str]):
+        for prefix in shard_prefixes:
+            indices = np.load(f"{prefix}.indices.npy", mmap_mode="r")
+            offsets = np.load(f"{prefix}.offsets.npy")
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                yield indices[start:end]
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        shard_prefixes = self.shard_prefixes[worker_id::worker_info.num_workers] if worker_info is not None else self.shard_prefixes
+        rng = random.Random(self.seed + worker_id)
+        buffer = []
+        for item in self._sparse_items(shard_prefixes):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            index = rng.randrange(len(buffer))
+            item, buffer[index] = buffer[index], item
+            yield self._densify(item)
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield self._densify(item)
+
+
+def read_shards(shard_dir: str) -> Tuple[List[str], int]:
+    """
+    :return: shard prefixes and input size of the library shards in shard_dir
+    """
+    with open(os.path.join(shard_dir, "meta.json"), "r") as fp:
+        meta = json.load(fp)
+    return [os.path.join(shard_dir, shard) for shard in meta["shards"]], meta["input_size"]
+
+
 def get_dataloader(train_dataset: Optional[Dataset],
                    batch_size: Optional[int],
                    collate_fn: Optional[Callable],
@@ -1,10 +1,11 @@
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 import os
 import json
 import sys
 from argparse import ArgumentParser
 from tqdm import tqdm
 import torch
+import numpy as np
 try:
     import csfpy
 except ModuleNotFoundError as mnfe:
@@ -12,6 +13,22 @@ except ModuleNotFoundError as mnfe:
 sys.path.append(os.path.dirname(os.path.dirname(os.getcwd())))
 
 
+def load_dictionary(smiles_vocab: str, lower: int = 0, upper: int = 2000000) -> Dict[int, int]:
+    """
+    Dictionary of the fingerprint values to their index in the dense encoding, the same as FingerPrints.dict, from
+    the cached vocab without the labels.
+    """
+    vocab_freq = torch.load(smiles_vocab)
+    vocab_freq_squeezed = [vocab for vocab in vocab_freq if lower < vocab[1] < upper]
+    return {data[0]: index for index, data in enumerate(vocab_freq_squeezed)}
+
+
+def smiles_to_indices(smiles: str, dictionary: Dict[int, int]) -> List[int]:
+    """Indices of the dense encoding set to 1 for a molecule, raises RuntimeError for an invalid smiles."""
+    fingerprint_list = csfpy.csfp(csfpy.Molecule(smiles), 2, 5).toList()
+    return sorted({dictionary[elem] for elem in fingerprint_list if elem in dictionary})
+
+
 class FingerPrints(object):
     """
     instance size:   1936962 (≈190W)
@@ -52,7 +69,7 @@ class FingerPrints(object):
         print(f"Error num: {self.error_num}")
         pass
 
-    def _fingerprints_generator(self, smiles_file, sep=",") -> List[List[int]]:
+    def _fingerprints_generator(self, smiles_file, sep=",", labeled=True) -> List[List[int]]:
         line_num = 0  # len(self.vocab_freq)
         with open(smiles_file, "r") as sf:
             while True:
@@ -66,7 +83,6 @@ class FingerPrints(object):
                 # molecule: <csfpy.Molecule named '0' (id 4294967295, 34 atoms) [0x0000013cd4fa55c0]>
                 try:
                     molecule = csfpy.Molecule(molecule)
-                    self.molecule_names.append(molecule_name)
                 except RuntimeError as re:
                     self.error_num += 1
                     continue
@@ -78,7 +94,8 @@ class FingerPrints(object):
                 # SparsIntVec objects can be converted to lists of integers
                 fingerprint_list = fingerprint.toList()
 
-                yield molecule_name, self.labels_dict[molecule_id], fingerprint_list
+                # molecules of the unlabeled library get the label -1
+                yield molecule_name, self.labels_dict[molecule_id] if labeled else self.labels_dict.get(molecule_id, -1), fingerprint_list
 
     def _molecule_to_list(self, molecule: str):
         molecule = csfpy.Molecule(molecule)
@@ -138,12 +155,14 @@ class FingerPrints(object):
         miss_all, total_all, molecule_names, labels, one_hots = 0, 0, [], [], []
         for molecule_name, label, fp_list in tqdm(self._fingerprints_generator(smiles_file, sep="\t")):
             miss, total, onehot = self._to_onehot(fp_list)
+            # only the in-memory datasets keep the names, not the generator that also streams the library
+            self.molecule_names.append(molecule_name)
             molecule_names.append(molecule_name)
             labels.append(label)
             one_hots.append(onehot)
             miss_all = miss_all + miss
             total_all = total_all + total
-        print(f"Miss rate: {round(miss_all / total_all, 4) * 100}%")
+        print(f"Miss rate: {round(miss_all / max(total_all, 1), 4) * 100}%")
 
         # aaa = self._molecule_to_list('[2H]C(=O)N(C([2H])([2H])[2H])C([2H])([2H])[2H]')
         # bbb = self._molecule_to_list('CN(C)C=O')
@@ -151,6 +170,35 @@ class FingerPrints(object):
         torch.save({"molecule_name": molecule_names, "label": labels, "one_hots": one_hots}, f=saved_file)
         return one_hots
 
+    def to_shards(self, smiles_file, shard_dir, shard_size=100000, sep=","):
+        """
+        Encode a molecule library that does not fit in memory as shards of sparse fingerprints: the dictionary
+        indices of every molecule concatenated in <shard>.indices.npy with their offsets in <shard>.offsets.npy,
+        and the molecule names in <shard>.names.npy. meta.json lists the shards and the input size of the dense encoding.
+        """
+        os.makedirs(shard_dir, exist_ok=True)
+        shards, indices, offsets, names = [], [], [0], []
+
+        def write_shard():
+            prefix = os.path.join(shard_dir, f"shard_{len(shards):05d}")
+            np.save(f"{prefix}.indices.npy", np.asarray(indices, dtype=np.int32))
+            np.save(f"{prefix}.offsets.npy", np.asarray(offsets, dtype=np.int64))
+            np.save(f"{prefix}.names.npy", np.asarray(names, dtype=str))
+            shards.append(os.path.basename(prefix))
+
+        for molecule_name, _, fp_list in tqdm(self._fingerprints_generator(smiles_file, sep=sep, labeled=False), desc="Library shards"):
+            indices.extend(sorted({self.dict[elem] for elem in fp_list if elem in self.dict}))
+            offsets.append(len(indices))
+            names.append(molecule_name)
+            if len(offsets) - 1 == shard_size:
+                write_shard()
+                indices, offsets, names = [], [0], []
+        if len(offsets) > 1:
+            write_shard()
+        with open(os.path.join(shard_dir, "meta.json"), "w") as fp:
+            json.dump({"input_size": len(self.dict), "shards": shards}, fp)
+        return shards
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -190,9 +238,20 @@ if __name__ == "__main__":
                         type=str,
                         default="../../data/vocab/update_smiles_vocab.pt",
                         help="Path of the smiles vocab file.")
+    parser.add_argument("--library_smiles_file",
+                        type=str,
+                        default=None,
+                        help="Path of the unlabeled library smiles file to encode as shards.")
+    parser.add_argument("--shard_dir",
+                        type=str,
+                        default="../../data/library_shards",
+                        help="Output directory of the library shards.")
+    parser.add_argument("--shard_size", type=int, default=100000, help="Molecules per library shard.")
     parser.add_argument("--upper", type=int, default=2000000, help="the upper of squeeze vocab.")
     parser.add_argument("--lower", type=int, default=0, help="the lower of squeeze vocab.")
     args = parser.parse_args()
     fp = FingerPrints(args=args)
     one_hots = fp.to_onehot(args.train_smiles_file, args.train_file)
+    if args.library_smiles_file is not None:
+        fp.to_shards(args.library_smiles_file, args.shard_dir, shard_size=args.shard_size)
     pass
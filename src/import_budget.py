@@ -0,0 +1,70 @@
+"""
+Import-time budget of the scoring entry points: imports each module in a fresh interpreter with python -X importtime
+and fails when it takes longer than importing torch plus the budget, or when it pulls in a training-only dependency.
+"""
+import os
+import sys
+import subprocess
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ["src.inference_server",
+                "src.ensemble",
+                "src.utils.artifact",
+                "src.utils.prediction_cache",
+                "src.models.capsule_model",
+                "src.featurizers.featurizer"]
+TRAINING_ONLY = ["tensorboard", "torch.utils.tensorboard", "sklearn", "pandas", "matplotlib",
+                 "src.trainer", "src.trainer_sdae_model"]
+
+
+def import_time(module: str) -> Tuple[float, List[str]]:
+    """
+    :return: cumulative import time in seconds of the module, and the modules it imported
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_DIR, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=os.path.join(PROJECT_DIR, "src"),
+                            env=env,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    total, modules = 0, []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, nested imports are indented by two spaces
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if len(name) - len(name.lstrip()) == 1:
+            total += int(cumulative)
+        modules.append(name.strip())
+    return total / 1e6, modules
+
+
+def check(entry_points: List[str], budget: float) -> Dict[str, Dict]:
+    baseline, _ = import_time("torch")
+    results = {}
+    for module in entry_points:
+        seconds, modules = import_time(module)
+        heavy = [dependency for dependency in TRAINING_ONLY
+                 if any(name == dependency or name.startswith(dependency + ".") for name in modules)]
+        results[module] = {"seconds": seconds,
+                           "over_torch": seconds - baseline,
+                           "training_only": heavy,
+                           "ok": seconds - baseline <= budget and not heavy}
+        print(f"{module}: {seconds:.3f} s, {seconds - baseline:+.3f} s over torch ({baseline:.3f} s)"
+              f"{', imports ' + ', '.join(heavy) if heavy else ''}{'' if results[module]['ok'] else ' FAILED'}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs="+", default=ENTRY_POINTS, help="Modules to import.")
+    parser.add_argument("--budget", type=float, default=0.5, help="Allowed import seconds beyond importing torch.")
+    args = parser.parse_args()
+    results = check(args.modules, args.budget)
+    if not all(result["ok"] for result in results.values()):
+        sys.exit(1)
+    pass
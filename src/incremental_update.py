@@ -0,0 +1,176 @@
+"""
+Warm-start update of a trained model when new labeled molecules arrive: featurize only the new molecules with the
+existing vocabulary, finetune on them plus a replay sample of the old training set for a bounded number of steps,
+and report how far the validation metrics and predictions drift.
+"""
+import os
+import sys
+import time
+import torch
+import numpy as np
+from argparse import ArgumentParser, Namespace
+from typing import Mapping, Optional, Tuple
+from torch.utils.data import ConcatDataset, DataLoader, Dataset, Subset
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.featurizers.featurizer import CSFPDataset, load_dataset
+from src.utils.metrics import StreamingMetrics
+from src.utils.utils import custom_collate_fn, model_logits, load_pickled
+from src.constants import DATA_DIR, MODEL_DIR
+
+
+def featurize_new_molecules(args) -> Optional[str]:
+    """
+    Encode the molecules of the smiles file that are in neither the old training set nor the validation set with
+    the existing vocabulary. Validation molecules are left out, finetuning on them would distort the drift measured
+    on the validation set.
+    :return: path of the .pt dataset of the new molecules, None if there are none
+    """
+    from src.featurizers.fingerprints import FingerPrints
+    known_molecules = set(torch.load(args.train_input_file)["molecule_name"]) | \
+        set(torch.load(args.validation_input_file)["molecule_name"])
+    new_smiles_file = os.path.splitext(args.new_dataset_file)[0] + ".smi"
+    new_molecules = 0
+    with open(args.smiles_file, "r") as source, open(new_smiles_file, "w") as target:
+        for line in source:
+            if line.strip() and line.strip().split("\t")[0] not in known_molecules:
+                target.write(line)
+                new_molecules += 1
+    if new_molecules == 0:
+        return None
+    fingerprints = FingerPrints(Namespace(labels_vocab=args.labels_vocab,
+                                          labels_file=args.labels_file,
+                                          smiles_vocab=args.smiles_vocab,
+                                          update_smiles_file=None,
+                                          update_smiles_vocab=args.smiles_vocab,
+                                          upper=args.upper,
+                                          lower=args.lower))
+    # the cached labels do not know the new molecules
+    fingerprints.labels_dict = fingerprints._create_labels_dictinary(args.labels_file)
+    fingerprints.to_onehot(new_smiles_file, args.new_dataset_file)
+    return args.new_dataset_file
+
+
+class IncrementalUpdater(object):
+    def __init__(self, args):
+        self.args = args
+        self.model = load_pickled(self.args.model_file, map_location=self.args.device)
+        self.validation_dataset = load_dataset(self.args.validation_input_file)
+
+    def predict(self, dataset: Dataset) -> Tuple[Mapping, np.ndarray]:
+        """
+        :return: metrics and positive class probabilities of the model on the dataset
+        """
+        self.model.eval()
+        dataloader = DataLoader(dataset, batch_size=self.args.batch_size, collate_fn=custom_collate_fn, shuffle=False)
+        streaming_metrics = StreamingMetrics(self.args.device)
+        probabilities = []
+        with torch.no_grad():
+            for batch in dataloader:
+                input_ids, label = batch["input_ids"].to(self.args.device), batch["label"].view(-1).to(self.args.device)
+                logits = model_logits(self.model, input_ids).float()
+                streaming_metrics.update(logits, label, loss=self.model.criterion(logits, label))
+                probabilities.append(torch.softmax(logits, dim=1)[:, 1].cpu())
+        return streaming_metrics.compute(), torch.cat(probabilities).numpy()
+
+    def replay_dataset(self, new_dataset: Dataset) -> Dataset:
+        old_dataset = load_dataset(self.args.train_input_file)
+        replay_size = min(len(old_dataset), int(round(self.args.replay_ratio * len(new_dataset))))
+        indices = np.random.RandomState(self.args.seed).choice(len(old_dataset), replay_size, replace=False)
+        print(f"Finetune on {len(new_dataset)} new and {replay_size} replayed molecules.")
+        return ConcatDataset([new_dataset, Subset(old_dataset, indices.tolist())])
+
+    def finetune(self, dataset: Dataset) -> None:
+        self.model.train()
+        for param_group in self.model.optimizer.param_groups:
+            param_group["lr"] = self.args.lr
+        dataloader = DataLoader(dataset, batch_size=self.args.batch_size, collate_fn=custom_collate_fn, shuffle=True)
+        step = 0
+        while step < self.args.max_steps:
+            for batch in dataloader:
+                input_ids, label = batch["input_ids"].to(self.args.device), batch["label"].view(-1).to(self.args.device)
+                loss = self.model.criterion(model_logits(self.model, input_ids).float(), label)
+                self.model.optimizer.zero_grad()
+                loss.backward()
+                self.model.optimizer.step()
+                step += 1
+                if step >= self.args.max_steps:
+                    break
+
+    def update(self, new_dataset: Dataset) -> None:
+        start_time = time.time()
+        before, before_probabilities = self.predict(self.validation_dataset)
+        self.finetune(self.replay_dataset(new_dataset))
+        after, after_probabilities = self.predict(self.validation_dataset)
+        print(f"{'metric':>10} | {'before':>8} | {'after':>8} | {'drift':>8}")
+        for metric in ("loss", "auc", "f1", "accuracy", "recall", "precision"):
+            print(f"{metric:>10} | {before[metric]:>8.4f} | {after[metric]:>8.4f} | {after[metric] - before[metric]:>+8.4f}")
+        flipped = np.mean((before_probabilities >= 0.5) != (after_probabilities >= 0.5))
+        print(f"Mean absolute probability change {np.abs(after_probabilities - before_probabilities).mean():.4f}, "
+              f"{flipped:.2%} of the validation predictions flipped.")
+        os.makedirs(os.path.dirname(os.path.abspath(self.args.output_model_file)), exist_ok=True)
+        torch.save(self.model, self.args.output_model_file)
+        print(f"Updated model saved to {self.args.output_model_file} in {round(time.time() - start_time, 1)} s.")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model_file",
+                        type=str,
+                        default=os.path.join(MODEL_DIR, 'sdae1024-512-256-128_model-p3-c3-f5.pt'),
+                        help="Path of the model to update.")
+    parser.add_argument("--output_model_file",
+                        type=str,
+                        default=os.path.join(MODEL_DIR, 'sdae1024-512-256-128_model-incremental.pt'),
+                        help="Path to save the updated model.")
+    parser.add_argument("--train_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/train_file.pt'),
+                        help="Path of the old train dataset, the source of the replay sample.")
+    parser.add_argument("--validation_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/validate_file.pt'),
+                        help="Path of the validation dataset.")
+    parser.add_argument("--new_input_file",
+                        type=str,
+                        default=None,
+                        help="Path of the already featurized new molecules, otherwise they are featurized from --smiles_file.")
+    parser.add_argument("--smiles_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'Jiang1823Train.smi'),
+                        help="Path of the smiles file with the new molecules.")
+    parser.add_argument("--labels_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'LabelTrainValidate.csv'),
+                        help="Path of the labels file with the new molecules.")
+    parser.add_argument("--smiles_vocab",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'vocab/update_smiles_vocab.pt'),
+                        help="Path of the smiles vocab the model was trained with.")
+    parser.add_argument("--labels_vocab",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'vocab/labels_vocab.pt'),
+                        help="Path of the labels vocab cache.")
+    parser.add_argument("--new_dataset_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/new_train_file.pt'),
+                        help="Path to save the featurized new molecules.")
+    parser.add_argument("--upper", type=int, default=2000000, help="the upper of squeeze vocab.")
+    parser.add_argument("--lower", type=int, default=0, help="the lower of squeeze vocab.")
+    parser.add_argument("--replay_ratio", type=float, default=2.0, help="Replayed old molecules per new molecule.")
+    parser.add_argument("--max_steps", type=int, default=200, help="Finetuning steps.")
+    parser.add_argument("--lr", type=float, default=0.0001, help="Learning rate of the finetuning.")
+    parser.add_argument("--batch_size", type=int, default=128, help="Batch size.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    parser.add_argument("--device",
+                        type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="Device (cuda or cpu)")
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    new_input_file = args.new_input_file if args.new_input_file is not None else featurize_new_molecules(args)
+    new_dataset = CSFPDataset(new_input_file) if new_input_file is not None else None
+    if new_dataset is None or len(new_dataset) == 0:
+        print("No new molecules.")
+    else:
+        IncrementalUpdater(args).update(new_dataset)
+    pass
@@ -0,0 +1,247 @@
+"""
+Local asyncio HTTP service of toxicity predictions. Concurrent requests are coalesced into micro-batches, bounded
+by --max_batch_size molecules and --max_wait_ms, that run through the model in one forward pass.
+
+POST /predict {"smiles": [...]} or {"indices": [[...], ...]} -> {"probabilities": [...]}
+GET /stats -> latency percentiles, throughput, batch sizes and prediction cache hit rate
+
+Molecules already scored by the same model and vocab are answered from the prediction cache without queuing.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import collections
+import torch
+import numpy as np
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.utils.utils import model_logits
+from src.utils.artifact import check_vocab, load_model
+from src.utils.prediction_cache import PredictionCache, fingerprint_hash, model_version
+from src.constants import DATA_DIR, MODEL_DIR
+
+
+class ServingStats(object):
+    """Latencies of the last requests and counters since start."""
+    def __init__(self, window: int = 10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.start_time = time.time()
+        self.requests, self.molecules, self.batches, self.errors = 0, 0, 0, 0
+
+    def summary(self) -> Dict[str, float]:
+        latencies = np.asarray(self.latencies) * 1000
+        elapsed = time.time() - self.start_time
+        return {"requests": self.requests,
+                "molecules": self.molecules,
+                "batches": self.batches,
+                "errors": self.errors,
+                "mean_batch_size": self.molecules / max(self.batches, 1),
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+                "requests_per_second": self.requests / elapsed,
+                "molecules_per_second": self.molecules / elapsed}
+
+
+class MicroBatcher(object):
+    """
+    Queue of molecules waiting for prediction. A single consumer takes the first waiting molecule, keeps collecting
+    until max_batch_size molecules or max_wait_ms passed, and scores the batch on a worker thread so that the event
+    loop keeps accepting requests.
+    """
+    def __init__(self, model: torch.nn.Module, input_size: int, device: str, max_batch_size: int, max_wait_ms: float, stats: ServingStats):
+        self.model = model
+        self.input_size = input_size
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats
+        # created by start() in the running event loop
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def predict(self, indices: List[List[int]]) -> List[float]:
+        loop = asyncio.get_event_loop()
+        futures = []
+        for molecule_indices in indices:
+            future = loop.create_future()
+            await self.queue.put((molecule_indices, future))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+
+    def _forward(self, indices: List[List[int]]) -> List[float]:
+        input_ids = torch.zeros(len(indices), self.input_size)
+        for row, molecule_indices in enumerate(indices):
+            input_ids[row, molecule_indices] = 1.0
+        with torch.no_grad():
+            logits = model_logits(self.model, input_ids.to(self.device)).float()
+        return torch.softmax(logits, dim=1)[:, 1].cpu().tolist()
+
+    def start(self) -> asyncio.Future:
+        self.queue = asyncio.Queue()
+        return asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            indices, futures = zip(*batch)
+            try:
+                probabilities = await loop.run_in_executor(self.executor, self._forward, list(indices))
+                for future, probability in zip(futures, probabilities):
+                    future.set_result(probability)
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+            self.stats.batches += 1
+            self.stats.molecules += len(batch)
+
+
+class InferenceServer(object):
+    def __init__(self, args):
+        self.args = args
+        # an artifact fed fingerprints of another vocab would answer with wrong predictions
+        check_vocab(self.args.model_file, self.args.smiles_vocab)
+        self.model = load_model(self.args.model_file, self.args.device)
+        self.dictionary = None
+        if self.args.smiles_vocab is not None and os.path.exists(self.args.smiles_vocab):
+            from src.featurizers.fingerprints import load_dictionary
+            self.dictionary = load_dictionary(self.args.smiles_vocab, self.args.lower, self.args.upper)
+        self.input_size = self.args.input_size if self.args.input_size is not None else len(self.dictionary)
+        self.stats = ServingStats()
+        self.cache = PredictionCache(self.args.cache_entries, int(self.args.cache_mb * 1024 ** 2)) \
+            if self.args.cache_entries > 0 else None
+        self.version = model_version(self.model, self.args.smiles_vocab) if self.cache is not None else None
+        self.batcher = MicroBatcher(self.model, self.input_size, self.args.device, self.args.max_batch_size, self.args.max_wait_ms, self.stats)
+
+    def encode(self, payload: Dict) -> List[List[int]]:
+        """
+        Validate a request before it joins a micro-batch, one bad molecule would fail the whole batch.
+        :return: indices of every molecule
+        """
+        if not isinstance(payload, dict):
+            raise ValueError("The request must be a JSON object.")
+        if "indices" in payload:
+            indices = payload["indices"]
+            if not isinstance(indices, list) or not all(
+                    isinstance(molecule_indices, list) and all(
+                        isinstance(index, int) and not isinstance(index, bool) and 0 <= index < self.input_size
+                        for index in molecule_indices)
+                    for molecule_indices in indices):
+                raise ValueError(f"indices must be a list of lists of integers in [0, {self.input_size}).")
+            return indices
+        smiles_list = payload.get("smiles")
+        if not isinstance(smiles_list, list) or not all(isinstance(smiles, str) for smiles in smiles_list):
+            raise ValueError("smiles must be a list of strings.")
+        if self.dictionary is None:
+            raise ValueError("Smiles requests need the smiles vocab.")
+        from src.featurizers.fingerprints import smiles_to_indices
+        return [smiles_to_indices(smiles, self.dictionary) for smiles in smiles_list]
+
+    async def predict(self, indices: List[List[int]]) -> List[float]:
+        if self.cache is None:
+            return await self.batcher.predict(indices)
+        fingerprints = [fingerprint_hash(molecule_indices) for molecule_indices in indices]
+        probabilities = [self.cache.get(fingerprint, self.version) for fingerprint in fingerprints]
+        missing = [row for row, probability in enumerate(probabilities) if probability is None]
+        if missing:
+            for row, probability in zip(missing, await self.batcher.predict([indices[row] for row in missing])):
+                probabilities[row] = probability
+                self.cache.put(fingerprints[row], self.version, probability)
+        return probabilities
+
+    async def handle_request(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        if method == "GET" and path == "/stats":
+            return 200, {**self.stats.summary(), **(self.cache.stats() if self.cache is not None else {})}
+        if method == "POST" and path == "/predict":
+            start_time = time.time()
+            try:
+                indices = self.encode(json.loads(body))
+            except (ValueError, RuntimeError) as error:
+                self.stats.errors += 1
+                return 400, {"error": str(error)}
+            try:
+                probabilities = await self.predict(indices)
+            except Exception as error:
+                self.stats.errors += 1
+                return 500, {"error": str(error)}
+            self.stats.requests += 1
+            self.stats.latencies.append(time.time() - start_time)
+            return 200, {"probabilities": probabilities}
+        return 404, {"error": f"{method} {path} not found"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Minimal HTTP/1.1 with keep-alive, enough for local clients and the load generator."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self.handle_request(method, path, body)
+                payload = json.dumps(response).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        batcher = self.batcher.start()
+        server = await asyncio.start_server(self.handle_connection, self.args.host, self.args.port)
+        print(f"Serving {self.args.model_file} on http://{self.args.host}:{self.args.port}")
+        async with server:
+            await server.serve_forever()
+        batcher.cancel()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model_file",
+                        type=str,
+                        default=os.path.join(MODEL_DIR, 'sdae1024-512-256-128_model-p3-c3-f5.pt'),
+                        help="Path of the saved Softmax, DNN, SDAE or Capsule model, or of a model artifact directory.")
+    parser.add_argument("--smiles_vocab",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'vocab/update_smiles_vocab.pt'),
+                        help="Path of the smiles vocab the model was trained with, needed for smiles requests.")
+    parser.add_argument("--input_size", type=int, default=None, help="Input size of the model, defaults to the vocab size.")
+    parser.add_argument("--upper", type=int, default=2000000, help="the upper of squeeze vocab.")
+    parser.add_argument("--lower", type=int, default=0, help="the lower of squeeze vocab.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="Maximum molecules per forward pass.")
+    parser.add_argument("--max_wait_ms", type=float, default=5.0, help="Maximum wait for a micro-batch to fill.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of the forward pass.")
+    parser.add_argument("--cache_entries", type=int, default=1000000, help="Entries of the prediction cache, 0 disables it.")
+    parser.add_argument("--cache_mb", type=float, default=512, help="Size bound of the prediction cache in MB.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device (cuda or cpu)")
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    asyncio.run(InferenceServer(args).serve())
+    pass
@@ -0,0 +1,94 @@
+"""
+Load generator of inference_server.py: concurrent keep-alive clients send prediction requests of fingerprint
+index lists from a dataset, and report client-side latency percentiles and throughput next to the server stats.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import numpy as np
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.constants import DATA_DIR
+
+
+async def http_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str, payload: Dict = None) -> Dict:
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    return json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+async def client(args, molecules: List[List[int]], latencies: List[float], deadline: float, seed: int) -> None:
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while time.time() < deadline:
+            payload = {"indices": [molecules[rng.randrange(len(molecules))] for _ in range(args.molecules_per_request)]}
+            start_time = time.time()
+            await http_request(reader, writer, "POST", "/predict", payload)
+            latencies.append(time.time() - start_time)
+    finally:
+        writer.close()
+
+
+def load_molecules(args) -> List[List[int]]:
+    if args.input_size is None:
+        from src.featurizers.featurizer import load_dataset
+        dataset = load_dataset(args.input_file)
+        return [np.flatnonzero(np.asarray(dataset.input_ids[item])).tolist() for item in range(len(dataset))]
+    # random sparse fingerprints of about the density of the real ones
+    rng = random.Random(args.seed)
+    return [sorted(rng.sample(range(args.input_size), args.active_bits)) for _ in range(1000)]
+
+
+async def main(args) -> Tuple[Dict, Dict]:
+    molecules = load_molecules(args)
+    latencies = []
+    start_time = time.time()
+    await asyncio.gather(*(client(args, molecules, latencies, start_time + args.duration, args.seed + index)
+                           for index in range(args.concurrency)))
+    elapsed = time.time() - start_time
+    latencies = np.asarray(latencies) * 1000
+    client_stats = {"requests": len(latencies),
+                    "p50_ms": float(np.percentile(latencies, 50)),
+                    "p99_ms": float(np.percentile(latencies, 99)),
+                    "requests_per_second": len(latencies) / elapsed,
+                    "molecules_per_second": len(latencies) * args.molecules_per_request / elapsed}
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    server_stats = await http_request(reader, writer, "GET", "/stats")
+    writer.close()
+    return client_stats, server_stats
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host of the server.")
+    parser.add_argument("--port", type=int, default=8080, help="Port of the server.")
+    parser.add_argument("--input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/validate_file.pt'),
+                        help="Dataset whose fingerprints are sent.")
+    parser.add_argument("--input_size", type=int, default=None, help="Send random fingerprints of this input size instead of the dataset.")
+    parser.add_argument("--active_bits", type=int, default=100, help="Active bits of random fingerprints.")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients.")
+    parser.add_argument("--molecules_per_request", type=int, default=1, help="Molecules per request.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    args = parser.parse_args()
+    client_stats, server_stats = asyncio.run(main(args))
+    print(f"Client: {json.dumps(client_stats)}")
+    print(f"Server: {json.dumps(server_stats)}")
+    pass
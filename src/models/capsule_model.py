@@ -7,7 +7,7 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
-from src.trainer_sdae_model import MODEL_DIR
+from src.constants import MODEL_DIR
 
 class CapsuleConvLayer(nn.Module):
     def __init__(self, in_channels, out_channels):
@@ -0,0 +1,169 @@
+"""
+Hyperparameter sweep of the SDAE model: trials of trainer_sdae_model.py run in parallel processes on one shared
+memory-mapped copy of the datasets, and successive halving stops the losing trials after each rung.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import itertools
+import subprocess
+import pandas as pd
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Mapping
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.featurizers.featurizer import CSFPDataset, export_memmap
+from src.constants import PROJECT_DIR, DATA_DIR
+
+SWEEP_DIR = os.path.join(PROJECT_DIR, 'sweep')
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SPACE = {"dimensions": [[1024, 512, 256, 128], [512, 256, 128], [1024, 256, 64]],
+                 "pretrain_epochs": [3, 5],
+                 "classifier_epochs": [3],
+                 "classifier_lr": [0.001, 0.0003],
+                 "dropout": [0.1, 0.2, 0.3]}
+
+
+def sample_trials(space: Mapping[str, List[Any]], search: str = "grid", num_trials: int = 16, seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    :param space: candidate values of every hyperparameter, named as the arguments of trainer_sdae_model.py
+    :param search: "grid" for every combination, "random" for num_trials distinct random combinations
+    :return: hyperparameters of every trial
+    """
+    names = sorted(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if search == "grid":
+        return grid
+    elif search == "random":
+        return random.Random(seed).sample(grid, min(num_trials, len(grid)))
+    raise ValueError(f"Unsupported search: {search}.")
+
+
+def prepare_memmap(input_file: str, memmap_dir: str) -> str:
+    """Export a .pt dataset to memory-mapped arrays once, later sweeps reuse them.
+    :return: the prefix to pass as input file of the trials
+    """
+    os.makedirs(memmap_dir, exist_ok=True)
+    prefix = os.path.join(memmap_dir, os.path.splitext(os.path.basename(input_file))[0])
+    if not os.path.exists(f"{prefix}.input_ids.npy"):
+        export_memmap(CSFPDataset(input_file), prefix)
+    return prefix
+
+
+class SweepRunner(object):
+    """
+    Successive halving over the finetune epochs: every trial of a rung trains to the rung budget, the best
+    1 / eta of the trials on the validation metric are promoted, and resume from their checkpoint with eta
+    times the budget in the next rung.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.train_input_file = prepare_memmap(self.args.train_input_file, self.args.memmap_dir)
+        self.validation_input_file = prepare_memmap(self.args.validation_input_file, self.args.memmap_dir)
+        self.results = []
+
+    def trial_dir(self, trial: int) -> str:
+        return os.path.join(self.args.sweep_dir, f"trial_{trial}")
+
+    def run_trial(self, trial: int, params: Mapping[str, Any], finetune_epochs: int, resume: bool) -> Dict[str, Any]:
+        trial_dir = self.trial_dir(trial)
+        os.makedirs(trial_dir, exist_ok=True)
+        metrics_file = os.path.join(trial_dir, f"metrics_f{finetune_epochs}.json")
+        command = [sys.executable, os.path.join(SRC_DIR, "trainer_sdae_model.py"),
+                   "--train_input_file", self.train_input_file,
+                   "--validation_input_file", self.validation_input_file,
+                   "--model_dir", trial_dir,
+                   "--checkpoint_dir", trial_dir,
+                   "--visualization_dir", trial_dir,
+                   "--log_path", os.path.join(trial_dir, "log"),
+                   "--finetune_epochs", str(finetune_epochs),
+                   "--num_workers", "0",
+                   "--num_threads", str(self.args.threads_per_trial),
+                   "--metrics_file", metrics_file]
+        for name, value in params.items():
+            command += [f"--{name}"] + ([str(v) for v in value] if isinstance(value, list) else [str(value)])
+        if resume:
+            command.append("--resume")
+        command += self.args.trainer_args
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.args.threads_per_trial), MKL_NUM_THREADS=str(self.args.threads_per_trial))
+        start_time = time.time()
+        with open(os.path.join(trial_dir, "output.log"), "a") as log:
+            returncode = subprocess.call(command, env=env, cwd=SRC_DIR, stdout=log, stderr=subprocess.STDOUT)
+        result = {"trial": trial, **{name: str(value) for name, value in params.items()},
+                  "finetune_epochs": finetune_epochs, "seconds": round(time.time() - start_time, 1),
+                  "status": "ok" if returncode == 0 and os.path.exists(metrics_file) else "failed"}
+        if result["status"] == "ok":
+            with open(metrics_file, "r") as fp:
+                metrics = json.load(fp)
+            result.update({name: value for name, value in metrics.items() if name != "confusion_matrix"})
+        return result
+
+    def run(self, trials: List[Mapping[str, Any]]) -> pd.DataFrame:
+        alive = list(range(len(trials)))
+        for rung in range(self.args.rungs):
+            finetune_epochs = self.args.min_finetune_epochs * self.args.eta ** rung
+            print(f"Rung {rung}: {len(alive)} trials with {finetune_epochs} finetune epochs.")
+            with ThreadPoolExecutor(max_workers=self.args.parallel) as executor:
+                futures = [executor.submit(self.run_trial, trial, trials[trial], finetune_epochs, rung > 0) for trial in alive]
+                rung_results = [future.result() for future in futures]
+            for result in rung_results:
+                result["rung"] = rung
+            self.results.extend(rung_results)
+            finished = [result for result in rung_results if result["status"] == "ok"]
+            # loss is minimized and every other metric maximized
+            finished.sort(key=lambda result: result[self.args.metric], reverse=self.args.metric != "loss")
+            alive = [result["trial"] for result in finished[:max(1, math.ceil(len(finished) / self.args.eta))]]
+            if len(alive) <= 1 or rung == self.args.rungs - 1:
+                break
+        table = pd.DataFrame(self.results)
+        table["stopped"] = ~table["trial"].isin(alive)
+        return table
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--train_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/train_file.pt'),
+                        help="Path of the train dataset.")
+    parser.add_argument("--validation_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/validate_file.pt'),
+                        help="Path of the validation dataset.")
+    parser.add_argument("--memmap_dir",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'memmap'),
+                        help="Directory of the memory-mapped datasets shared by the trials.")
+    parser.add_argument("--sweep_dir", type=str, default=SWEEP_DIR, help="Output directory of the trials.")
+    parser.add_argument("--space",
+                        type=str,
+                        default=None,
+                        help="JSON file mapping trainer_sdae_model.py arguments to candidate values, defaults to DEFAULT_SPACE.")
+    parser.add_argument("--search", type=str, default="grid", choices=["grid", "random"], help="Search strategy.")
+    parser.add_argument("--num_trials", type=int, default=16, help="Number of trials of the random search.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the random search.")
+    parser.add_argument("--parallel", type=int, default=max(1, (os.cpu_count() or 1) // 4), help="Concurrent trials.")
+    parser.add_argument("--threads_per_trial", type=int, default=4, help="Intra-op threads of every trial.")
+    parser.add_argument("--metric",
+                        type=str,
+                        default="auc",
+                        choices=["loss", "auc", "f1", "accuracy", "recall", "precision"],
+                        help="Validation metric to rank the trials.")
+    parser.add_argument("--min_finetune_epochs", type=int, default=1, help="Finetune epochs of the first rung.")
+    parser.add_argument("--eta", type=int, default=3, help="Budget multiplier and inverse promoted fraction per rung.")
+    parser.add_argument("--rungs", type=int, default=3, help="Maximum number of rungs.")
+    parser.add_argument("--output_file", type=str, default=None, help="CSV of the results, defaults to <sweep_dir>/results.csv.")
+    args, args.trainer_args = parser.parse_known_args()
+    space = DEFAULT_SPACE
+    if args.space is not None:
+        with open(args.space, "r") as fp:
+            space = json.load(fp)
+    runner = SweepRunner(args)
+    table = runner.run(sample_trials(space, args.search, args.num_trials, args.seed))
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    table.to_csv(args.output_file or os.path.join(args.sweep_dir, "results.csv"), index=False)
+    print(table.sort_values(["rung", args.metric], ascending=[False, args.metric == "loss"]).to_string(index=False))
+    pass
@@ -2,27 +2,30 @@
 Triner for Softmax model, DNN model and Capsule Networks Model.
 """
 import os
-os.environ["CUDA_VISIBLE_DEVICES"] = '4'
+import json
 import sys
 import torch
 import time
 from tqdm import tqdm
-from torch.utils.tensorboard import SummaryWriter
 from argparse import ArgumentParser
 import numpy as np
-from typing import Mapping
+import torch.distributed as dist
+from typing import List, Mapping, Optional
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 sys.path.append(os.path.dirname(os.getcwd()))
-from src.utils.metrics import Metrics
-from src.featurizers.featurizer import CSFPDataset, get_dataloader
+from src.utils.metrics import Metrics, StreamingMetrics
+from src.featurizers.featurizer import get_dataloader, load_dataset
 from src.models.softmax_model import SoftmaxModel
 from src.models.dnn_model import DNNModel
 from src.models.capsule_model import CapsuleModel
-from src.utils.utils import custom_collate_fn
-
-PROJECT_DIR = os.path.dirname(os.getcwd())  # get current working directory
-DATA_DIR = os.path.join(PROJECT_DIR, 'data')
-VISUALIZATION_DIR = os.path.join(DATA_DIR, 'visualization')
-LOG_DIR = os.path.join(PROJECT_DIR, 'log')
+from src.utils.utils import custom_collate_fn, autocast_context, peak_memory_mb, apply_perf_profile
+from src.utils.logger import AsyncStepLogger
+from src.utils.checkpoint import AsyncCheckpointer, rng_state, set_rng_state
+from src.utils.validation import EarlyStopping
+from src.utils.evaluation import AsyncEvaluator
+from src.constants import DATA_DIR, VISUALIZATION_DIR, LOG_DIR, MODEL_DIR, CHECKPOINT_DIR
 
 
 class Trainer:
@@ -30,35 +33,82 @@ class Trainer:
         self.args = args
         self.set_seed(42)
         self.metrics = Metrics()
-        self.train_dataset = CSFPDataset(self.args.train_input_file)
-        self.validation_dataset = CSFPDataset(self.args.validation_input_file)
+        # distributed data parallel, the process group is initialized by the launcher, see __main__
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.is_main = self.rank == 0
+        self.train_dataset = load_dataset(self.args.train_input_file, self.args.train_index_file)
+        self.validation_dataset = load_dataset(self.args.validation_input_file, self.args.validation_index_file)
         self.train_dataloader, self.validation_dataloader = get_dataloader(train_dataset=self.train_dataset,
                                                                            validation_dataset=self.validation_dataset,
                                                                            collate_fn=custom_collate_fn,
                                                                            batch_size=self.args.batch_size,
                                                                            num_workers=self.args.num_workers,
                                                                            shuffle=True)
+        self.train_sampler = None
+        if self.distributed:
+            # every process trains on its own shard of the train dataset, batch_size is per process
+            self.train_sampler = DistributedSampler(self.train_dataset, shuffle=True, seed=self.args.seed)
+            self.train_dataloader = DataLoader(dataset=self.train_dataset,
+                                               batch_size=self.args.batch_size,
+                                               collate_fn=custom_collate_fn,
+                                               sampler=self.train_sampler,
+                                               num_workers=self.args.num_workers)
+            # every process validates every world_size-th item, DistributedSampler would pad the shards with repeated
+            # items, so the metrics summed over the processes count each validation item exactly once
+            self.validation_dataloader = DataLoader(dataset=Subset(self.validation_dataset,
+                                                                   range(self.rank, len(self.validation_dataset), self.world_size)),
+                                                    batch_size=self.args.batch_size,
+                                                    collate_fn=custom_collate_fn,
+                                                    num_workers=self.args.num_workers)
+        # validation metrics are summed in their own group, the asynchronous evaluation runs its collectives on a
+        # background thread next to the gradient all-reduce of training
+        self.eval_group = dist.new_group(backend="gloo") if self.distributed else None
         self.train_total, self.validation_total = len(self.train_dataset), len(self.validation_dataset)
         self.train_input_size = next(iter(self.train_dataloader))["input_ids"].shape[1]
         self.validation_input_size = next(iter(self.validation_dataloader))["input_ids"].shape[1]
-        if self.args.model_name == "DNN":
-            self.classifier_model = DNNModel(input_size=self.train_input_size).to(self.args.device)
-        elif self.args.model_name == "Softmax":
-            self.classifier_model = SoftmaxModel(input_size=self.train_input_size).to(self.args.device)
-        elif self.args.model_name == "Capsule":
-            self.classifier_model = CapsuleModel(conv_inputs=1,
-                                                 conv_outputs=1,      # 256,
-                                                 num_primary_units=8,
-                                                 primary_unit_size=8*61,  # fixme get from conv2d  61(128)---253(512)--509(1024)
-                                                 num_output_units=2,           # one for each MNIST digit
-                                                 output_unit_size=2).to(self.args.device)
-        else:
-            raise ValueError("Please input the right model type.")
-        self.writer = SummaryWriter(self.args.log_path)
+        # several models are trained on the same batches, each with its own optimizer, metrics and outputs
+        self.model_names = self.args.model_names if self.args.model_names else [self.args.model_name]
+        self.classifier_models = {model_name: self.build_model(model_name) for model_name in self.model_names}
+        # gradients are all-reduced by the DistributedDataParallel wrapper, the Capsule model has unused layers
+        self.train_models = {model_name: DistributedDataParallel(classifier_model,
+                                                                 find_unused_parameters=model_name == "Capsule")
+                             if self.distributed else classifier_model
+                             for model_name, classifier_model in self.classifier_models.items()}
+        # metrics, tensorboard and outputs only on rank 0
+        # tensorboard is only imported for training
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(self.args.log_path) if self.is_main else None
+        self.step_logger = AsyncStepLogger(self.writer, flush_every=self.args.log_every)
+        self.early_stoppings = {model_name: EarlyStopping(metric=self.args.early_stopping_metric,
+                                                          patience=self.args.patience,
+                                                          min_delta=self.args.min_delta) if self.args.early_stopping_metric else None
+                                for model_name in self.model_names}
+        self.checkpointers = {model_name: AsyncCheckpointer(self.args.checkpoint_dir, name=f"{model_name}_checkpoint.pt")
+                              for model_name in self.model_names}
+        self.validation_metrics = {}
+        # validation of an epoch on a background thread while the next one trains
+        self.async_evaluator = AsyncEvaluator(self.classifier_models, self.eval) if self.args.async_eval else None
         # self.writer.add_graph(model=self.classifier_model,
         #                       input_to_model=next(iter(self.train_dataloader))["input_ids"].to(self.args.device))
         pass
 
+    def build_model(self, model_name: str) -> torch.nn.Module:
+        if model_name == "DNN":
+            return DNNModel(input_size=self.train_input_size).to(self.args.device)
+        elif model_name == "Softmax":
+            return SoftmaxModel(input_size=self.train_input_size).to(self.args.device)
+        elif model_name == "Capsule":
+            return CapsuleModel(conv_inputs=1,
+                                conv_outputs=1,      # 256,
+                                num_primary_units=8,
+                                primary_unit_size=8*61,  # fixme get from conv2d  61(128)---253(512)--509(1024)
+                                num_output_units=2,           # one for each MNIST digit
+                                output_unit_size=2).to(self.args.device)
+        else:
+            raise ValueError("Please input the right model type.")
+
     def set_seed(self, seed):
         np.random.seed(seed)
         torch.manual_seed(seed)
@@ -67,128 +117,299 @@ class Trainer:
             torch.backends.cudnn.deterministic = True
             torch.backends.cudnn.benchmark = False
 
-    def to_serialization(self, visualization: Mapping):
+    def log(self, message: str) -> None:
+        if self.is_main:
+            print(message)
+
+    def to_serialization(self, model_name: str, visualization: Mapping):
         if not os.path.exists(self.args.visualization_dir):
             os.mkdir(self.args.visualization_dir)
-        torch.save(visualization, os.path.join(self.args.visualization_dir, f"visualization_{self.args.model_name}_ext.pt"))
+        torch.save(visualization, os.path.join(self.args.visualization_dir, f"visualization_{model_name}_ext.pt"))
+
+    def forward(self, model_name: str, model: torch.nn.Module, input_ids: torch.Tensor, label: torch.Tensor):
+        """
+        :return: raw prediction for visualization, class scores for the metrics and the loss
+        """
+        classifier_model = self.classifier_models[model_name]
+        if model_name == "Capsule":
+            prediction, sdae_encoded = model(input_ids)
+            # classifier_model_loss = classifier_model.criterion(sdae_encoded, prediction, label)
 
-    def eval(self, epoch):
-        self.classifier_model.eval()
-        predictions_vis, predictions, labels = [], [], []
-        for i, batch in enumerate(tqdm(self.validation_dataloader, desc=f"Eval: ")):
+            predict = torch.sqrt((prediction.float() ** 2).sum(dim=2))
+            classifier_model_loss = classifier_model.criterion(predict, label)
+        else:
+            prediction = model(input_ids)
+            predict = prediction.float()
+            classifier_model_loss = classifier_model.criterion(predict, label)
+        return prediction.float(), predict, classifier_model_loss
+
+    def eval(self, epoch, models: Optional[Mapping[str, torch.nn.Module]] = None):
+        """
+        Score the models on the validation set in one shared pass.
+        :param epoch: epoch of the weights
+        :param models: models by name, defaults to all classifier models, or their shadow copies when evaluating
+        asynchronously
+        """
+        models = models if models is not None else self.classifier_models
+        model_names = list(models)
+        for model_name in model_names:
+            models[model_name].eval()
+        streaming_metrics = {model_name: StreamingMetrics(self.args.device) for model_name in model_names}
+        predictions_vis, labels = {model_name: [] for model_name in model_names}, []
+        for i, batch in enumerate(tqdm(self.validation_dataloader, desc=f"Eval: ", disable=not self.is_main)):
             batch = {key: value.to(self.args.device) for key, value in batch.items()}
             input_ids, label = batch["input_ids"], batch["label"].view(-1)
-            with torch.no_grad():
-                # Softmax model
-                if self.args.model_name == "Capsule":
-                    prediction, sdae_encoded = self.classifier_model(input_ids)
-                    # classifier_model_loss = self.classifier_model.criterion(sdae_encoded, prediction, label)
-
-                    predict = torch.sqrt((prediction ** 2).sum(dim=2))
-                    classifier_model_loss = self.classifier_model.criterion(predict, label)
-                else:
-                    prediction = self.classifier_model(input_ids)
-                    classifier_model_loss = self.classifier_model.criterion(prediction, label)
-                # for tensorboard
-                self.writer.add_scalar(tag=f"{self.args.model_name} Model Validation Loss",
-                                       scalar_value=classifier_model_loss.item(),
-                                       global_step=epoch * len(self.validation_dataloader) + i)
-                # for visualization
-                predictions_vis.append(prediction.detach())
-                labels.append(label)
-                # for metric
-                if self.args.model_name == "Capsule":
-                    prediction = torch.sqrt((prediction ** 2).sum(dim=2)).max(1)[1]
-                else:
-                    prediction = prediction.data.max(1, keepdim=True)[1]
-                predictions.append(prediction)
-        predictions_vis = torch.cat(predictions_vis, dim=0).cpu().numpy()
-        predictions = torch.cat(predictions, dim=0).cpu().numpy()
+            labels.append(label)
+            for model_name in model_names:
+                with torch.no_grad(), autocast_context(self.args.device, self.args.precision):
+                    prediction, predict, classifier_model_loss = self.forward(model_name, models[model_name], input_ids, label)
+                    # for tensorboard
+                    self.step_logger.add_scalar(tag=f"{model_name} Model Validation Loss",
+                                                scalar_value=classifier_model_loss,
+                                                global_step=epoch * len(self.validation_dataloader) + i)
+                    # for visualization
+                    predictions_vis[model_name].append(prediction.detach())
+                    # for metric
+                    streaming_metrics[model_name].update(predict, label, loss=classifier_model_loss)
+        # only the validation tags, training may be logging concurrently
+        for model_name in model_names:
+            self.step_logger.flush(f"{model_name} Model Validation Loss")
         labels = torch.cat(labels, dim=0).cpu().numpy()
-        validation_recall = f"Recall of validation epoch {epoch}: {round(self.metrics.calculate_recall(labels, predictions), 4)}"
-        validation_precision = f"Precision of validation epoch {epoch}: {round(self.metrics.calculate_precision(labels, predictions), 4)}"
-        validation_f1 = f"F1 of validation epoch {epoch}: {round(self.metrics.calculate_f1(labels, predictions), 4)}"
-        validation_auc = f"Auc of validation epoch {epoch}: {round(self.metrics.calculate_auc(labels, predictions), 4)}"
-        validation_accuracy = f"Accuracy of validation epoch {epoch}: {round(self.metrics.calculate_accuracy(labels, predictions), 4)}"
-        confusion_matrix = f"Confusion matrix of validation epoch {epoch}: {self.metrics.calculate_confusion_matrix(labels, predictions)}"
-        print(f"Validation loss: {round(classifier_model_loss.cpu().item(), 4)}")
-        print(validation_accuracy)
-        return validation_recall, validation_precision, validation_f1, validation_auc, validation_accuracy, confusion_matrix, predictions_vis, labels
+        outputs = {}
+        for model_name in model_names:
+            if self.distributed:
+                # every process ends with the metrics of the whole validation set, so early stopping agrees
+                streaming_metrics[model_name].all_reduce(group=self.eval_group)
+            validation = streaming_metrics[model_name].compute()
+            self.validation_metrics[model_name] = validation
+            validation_recall = f"Recall of validation epoch {epoch}: {round(validation['recall'], 4)}"
+            validation_precision = f"Precision of validation epoch {epoch}: {round(validation['precision'], 4)}"
+            validation_f1 = f"F1 of validation epoch {epoch}: {round(validation['f1'], 4)}"
+            validation_auc = f"Auc of validation epoch {epoch}: {round(validation['auc'], 4)}"
+            validation_accuracy = f"Accuracy of validation epoch {epoch}: {round(validation['accuracy'], 4)}"
+            confusion_matrix = f"Confusion matrix of validation epoch {epoch}: {validation['confusion_matrix']}"
+            self.log(f"{model_name} validation loss: {round(validation['loss'], 4)}")
+            self.log(validation_accuracy)
+            outputs[model_name] = (validation_recall, validation_precision, validation_f1, validation_auc, validation_accuracy,
+                                   confusion_matrix, torch.cat(predictions_vis[model_name], dim=0).cpu().numpy(), labels)
+        return outputs
+
+    def record_validation(self,
+                          epoch: int,
+                          outputs: Mapping,
+                          models: Mapping[str, torch.nn.Module],
+                          start_epochs: Mapping[str, int]) -> List[str]:
+        """
+        Add the validation results of an epoch to its visualization data and TensorBoard, and step early stopping.
+        :param epoch: evaluated epoch
+        :param outputs: output of eval by model name
+        :param models: evaluated models by name, whose weights early stopping keeps if they are the best
+        :param start_epochs: first epoch to train of every model, set past the last epoch for stopped models
+        :return: names of the models that stop
+        """
+        stopped = []
+        for model_name, output in outputs.items():
+            validation_recall, validation_precision, validation_f1, validation_auc, validation_accuracy, validation_confusion_matrix, validation_predictions_vis, validation_labels = output
+            self.visualization_data[model_name].setdefault(f"epoch{epoch}", {}).update(
+                {"validation_classifier": validation_predictions_vis,
+                 "validation_labels": validation_labels,
+                 "validation_recall": validation_recall,
+                 "validation_precision": validation_precision,
+                 "validation_f1": validation_f1,
+                 "validation_auc": validation_auc,
+                 "validation_accuracy": validation_accuracy,
+                 "validation_confusion_matrix": validation_confusion_matrix})
+            if self.writer is not None:
+                for metric in ("loss", "auc", "f1", "accuracy"):
+                    self.writer.add_scalar(tag=f"{model_name} Model Validation Epoch {metric.capitalize()}",
+                                           scalar_value=self.validation_metrics[model_name][metric],
+                                           global_step=epoch)
+            early_stopping = self.early_stoppings[model_name]
+            if early_stopping is not None and \
+                    early_stopping.step(self.validation_metrics[model_name][self.args.early_stopping_metric], epoch, models[model_name],
+                                        metrics=self.validation_metrics[model_name]):
+                self.log(f"Early stopping {model_name} at epoch {epoch}, validation {self.args.early_stopping_metric} "
+                         f"did not improve for {self.args.patience} epochs.")
+                start_epochs[model_name] = self.args.epochs
+                stopped.append(model_name)
+        return stopped
+
+    def save_checkpoint(self, model_name: str, epoch: int, visualization_data: Mapping, stopped: bool = False,
+                        validated: bool = True):
+        """
+        :param validated: False if the validation of the epoch is not yet recorded, as with --async_eval
+        """
+        classifier_model, early_stopping = self.classifier_models[model_name], self.early_stoppings[model_name]
+        self.checkpointers[model_name].save({"epoch": epoch,
+                                             "model": classifier_model.state_dict(),
+                                             "optimizer": classifier_model.optimizer.state_dict(),
+                                             "rng": rng_state(),
+                                             "visualization_data": visualization_data,
+                                             "early_stopping": vars(early_stopping) if early_stopping is not None else None,
+                                             "stopped": stopped,
+                                             "validated": validated})
+
+    def resume_checkpoint(self, model_name: str) -> int:
+        """
+        Restore model, optimizer, RNG and visualization data of a model from its last checkpoint.
+        :return: epoch to start training the model from
+        """
+        checkpoint = self.checkpointers[model_name].load(map_location=self.args.device)
+        if checkpoint is None:
+            self.log(f"No checkpoint of {model_name} found in {self.args.checkpoint_dir}, train from scratch.")
+            return 0
+        classifier_model, early_stopping = self.classifier_models[model_name], self.early_stoppings[model_name]
+        classifier_model.load_state_dict(checkpoint["model"])
+        classifier_model.optimizer.load_state_dict(checkpoint["optimizer"])
+        set_rng_state(checkpoint["rng"])
+        self.visualization_data[model_name] = checkpoint["visualization_data"]
+        if early_stopping is not None and checkpoint.get("early_stopping") is not None:
+            vars(early_stopping).update(checkpoint["early_stopping"])
+        self.log(f"Resume {model_name} from epoch {checkpoint['epoch']}.")
+        if not checkpoint.get("stopped") and not checkpoint.get("validated", True):
+            self.unvalidated_epochs[model_name] = checkpoint["epoch"]
+        return self.args.epochs if checkpoint.get("stopped") else checkpoint["epoch"] + 1
 
     def train(self):
         self.set_seed(self.args.seed)
-        visualization_data = {}
-        for epoch in range(self.args.epochs):
-            self.classifier_model.train()
+        self.visualization_data = {model_name: {} for model_name in self.model_names}
+        self.unvalidated_epochs = {}
+        start_epochs = {model_name: self.resume_checkpoint(model_name) if self.args.resume else 0 for model_name in self.model_names}
+        visualization_data = self.visualization_data
+        # checkpoints written by --async_eval before the validation of their epoch was collected, that validation
+        # is run again so that early stopping and the visualization data miss no epoch
+        for epoch in sorted(set(self.unvalidated_epochs.values())):
+            models = {model_name: self.classifier_models[model_name]
+                      for model_name, unvalidated_epoch in self.unvalidated_epochs.items() if unvalidated_epoch == epoch}
+            stopped = self.record_validation(epoch, self.eval(epoch=epoch, models=models), self.classifier_models, start_epochs)
+            for model_name in models if self.is_main else []:
+                self.save_checkpoint(model_name, epoch, visualization_data[model_name], stopped=model_name in stopped)
+        for epoch in range(min(start_epochs.values()), self.args.epochs):
+            # models that early stopped or resumed from a later epoch sit the epoch out
+            model_names = [model_name for model_name in self.model_names if start_epochs[model_name] <= epoch]
+            if not model_names:
+                break
+            for model_name in model_names:
+                self.classifier_models[model_name].train()
+            if self.train_sampler is not None:
+                self.train_sampler.set_epoch(epoch)
             start_time = time.time()
-            predictions_vis, predictions, labels = [], [], []
-            for i, batch in enumerate(tqdm(self.train_dataloader, desc=f"Epoch {epoch}: ")):
+            step_time = 0.0
+            streaming_metrics = {model_name: StreamingMetrics(self.args.device) for model_name in model_names}
+            predictions_vis, labels = {model_name: [] for model_name in model_names}, []
+            for i, batch in enumerate(tqdm(self.train_dataloader, desc=f"Epoch {epoch}: ", disable=not self.is_main)):
+                step_start_time = time.time()
                 batch = {key: value.to(self.args.device) for key, value in batch.items()}
                 input_ids, label = batch["input_ids"], batch["label"]
                 label = label.view(-1)
-
-                # Classifier model
-                if self.args.model_name == "Capsule":
-                    prediction, sdae_encoded = self.classifier_model(input_ids)
-                    # classifier_model_loss = self.classifier_model.criterion(sdae_encoded, prediction, label)
-
-                    predict = torch.sqrt((prediction ** 2).sum(dim=2))
-                    classifier_model_loss = self.classifier_model.criterion(predict, label)
-                else:
-                    prediction = self.classifier_model(input_ids)
-                    classifier_model_loss = self.classifier_model.criterion(prediction, label)
-                self.classifier_model.optimizer.zero_grad()
-                classifier_model_loss.backward()
-                self.classifier_model.optimizer.step()
-
-                # for tensorboard
-                self.writer.add_scalar(tag=f"{self.args.model_name} Model Train Loss",
-                                       scalar_value=classifier_model_loss.item(),
-                                       global_step=epoch * len(self.train_dataloader) + i)
-                # for visualization
-                predictions_vis.append(prediction.detach())
                 labels.append(label)
-                # for metrics
-                if self.args.model_name == "Capsule":
-                    prediction = torch.sqrt((prediction ** 2).sum(dim=2)).max(1)[1]
-                else:
-                    prediction = prediction.data.max(1, keepdim=True)[1]
-                predictions.append(prediction)
-            predictions_vis = torch.cat(predictions_vis, dim=0).cpu().numpy()
-            predictions = torch.cat(predictions, dim=0).cpu().numpy()
+
+                # Classifier models, all fed from the same batch
+                for model_name in model_names:
+                    classifier_model = self.classifier_models[model_name]
+                    with autocast_context(self.args.device, self.args.precision):
+                        prediction, predict, classifier_model_loss = self.forward(model_name, self.train_models[model_name], input_ids, label)
+                    classifier_model.optimizer.zero_grad()
+                    classifier_model_loss.backward()
+                    classifier_model.optimizer.step()
+
+                    # for tensorboard
+                    self.step_logger.add_scalar(tag=f"{model_name} Model Train Loss",
+                                                scalar_value=classifier_model_loss,
+                                                global_step=epoch * len(self.train_dataloader) + i)
+                    # for visualization
+                    predictions_vis[model_name].append(prediction.detach())
+                    # for metrics
+                    streaming_metrics[model_name].update(predict, label, loss=classifier_model_loss)
+                step_time += time.time() - step_start_time
+            # wall time of the epoch, with data loading, which step_time leaves out
+            epoch_time = time.time() - start_time
+            for model_name in model_names:
+                self.step_logger.flush(f"{model_name} Model Train Loss")
             labels = torch.cat(labels, dim=0).cpu().numpy()
-            train_recall = f"Recall of train epoch {epoch}: {round(self.metrics.calculate_recall(labels, predictions), 4)}"
-            train_precision = f"Precision of train epoch {epoch}: {round(self.metrics.calculate_precision(labels, predictions), 4)}"
-            train_f1 = f"F1 of train epoch {epoch}: {round(self.metrics.calculate_f1(labels, predictions), 4)}"
-            train_auc = f"Auc of train epoch {epoch}: {round(self.metrics.calculate_auc(labels, predictions), 4)}"
-            train_accuracy = f"Accuracy of train epoch {epoch}: {round(self.metrics.calculate_accuracy(labels, predictions), 4)}"
-            train_confusion_matrix = f"Confusion matrix of train epoch {epoch}: {self.metrics.calculate_confusion_matrix(labels, predictions)}"
-            validation_recall, validation_precision, validation_f1, validation_auc, validation_accuracy, validation_confusion_matrix, validation_predictions_vis, validation_labels = self.eval(epoch=epoch)
-            print(f"Train loss: {round(classifier_model_loss.cpu().item(), 4)}")
-            print(train_accuracy)
-            visualization_data[f"epoch{epoch}"] = {"train_classifier": predictions_vis,
-                                                   "train_labels": labels,
-                                                   "train_recall": train_recall,
-                                                   "train_precision": train_precision,
-                                                   "train_f1": train_f1,
-                                                   "train_auc": train_auc,
-                                                   "train_accuracy": train_accuracy,
-                                                   "train_confusion_matrix": train_confusion_matrix,
-                                                   "validation_classifier": validation_predictions_vis,
-                                                   "validation_labels": validation_labels,
-                                                   "validation_recall": validation_recall,
-                                                   "validation_precision": validation_precision,
-                                                   "validation_f1": validation_f1,
-                                                   "validation_auc": validation_auc,
-                                                   "validation_accuracy": validation_accuracy,
-                                                   "validation_confusion_matrix": validation_confusion_matrix}
+            train_step_time = step_time / len(self.train_dataloader) * 1000
+            train_peak_memory = peak_memory_mb(self.args.device)
+            self.log(f"Precision {self.args.precision}: {round(train_step_time, 2)} ms/step of {len(model_names)} models, "
+                     f"peak memory {round(train_peak_memory, 1)} MB")
+            self.log(f"Throughput of {self.world_size} processes: {round(self.train_total / epoch_time, 1)} samples/s")
+            for model_name in model_names:
+                if self.distributed:
+                    streaming_metrics[model_name].all_reduce()
+                train = streaming_metrics[model_name].compute()
+                train_recall = f"Recall of train epoch {epoch}: {round(train['recall'], 4)}"
+                train_precision = f"Precision of train epoch {epoch}: {round(train['precision'], 4)}"
+                train_f1 = f"F1 of train epoch {epoch}: {round(train['f1'], 4)}"
+                train_auc = f"Auc of train epoch {epoch}: {round(train['auc'], 4)}"
+                train_accuracy = f"Accuracy of train epoch {epoch}: {round(train['accuracy'], 4)}"
+                train_confusion_matrix = f"Confusion matrix of train epoch {epoch}: {train['confusion_matrix']}"
+                self.log(f"{model_name} train loss: {round(train['loss'], 4)}")
+                self.log(train_accuracy)
+                visualization_data[model_name][f"epoch{epoch}"] = {"train_classifier": torch.cat(predictions_vis[model_name], dim=0).cpu().numpy(),
+                                                                   "train_labels": labels,
+                                                                   "train_recall": train_recall,
+                                                                   "train_precision": train_precision,
+                                                                   "train_f1": train_f1,
+                                                                   "train_auc": train_auc,
+                                                                   "train_accuracy": train_accuracy,
+                                                                   "train_confusion_matrix": train_confusion_matrix,
+                                                                   "precision": self.args.precision,
+                                                                   "train_step_time_ms": train_step_time,
+                                                                   "train_peak_memory_mb": train_peak_memory}
+            if self.async_evaluator is not None:
+                # the validation of the previous epoch ran while this one trained, early stopping lags one epoch
+                previous = self.async_evaluator.collect()
+                stopped = self.record_validation(*previous, self.async_evaluator.models, start_epochs) if previous is not None else []
+                self.async_evaluator.submit(epoch, {model_name: self.classifier_models[model_name]
+                                                    for model_name in model_names if model_name not in stopped})
+            else:
+                stopped = self.record_validation(epoch, self.eval(epoch=epoch, models={model_name: self.classifier_models[model_name]
+                                                                                       for model_name in model_names}),
+                                                 self.classifier_models, start_epochs)
+            for model_name in model_names:
+                if self.is_main and ((epoch + 1) % self.args.checkpoint_every == 0 or epoch == self.args.epochs - 1 or model_name in stopped):
+                    self.save_checkpoint(model_name, epoch, visualization_data[model_name], stopped=model_name in stopped,
+                                         validated=self.async_evaluator is None or model_name in stopped)
 
             total_time = time.time() - start_time
-        # save for visualization
-        self.to_serialization(visualization_data)
+        last = self.async_evaluator.collect() if self.async_evaluator is not None else None
+        if last is not None:
+            self.record_validation(*last, self.async_evaluator.models, start_epochs)
+            if self.is_main:
+                for model_name in last[1]:
+                    self.save_checkpoint(model_name, last[0], visualization_data[model_name])
+        for model_name in self.model_names:
+            early_stopping = self.early_stoppings[model_name]
+            if early_stopping is not None and early_stopping.best_epoch is not None:
+                # export the best model instead of the last one
+                early_stopping.restore(self.classifier_models[model_name])
+                if early_stopping.best_metrics is not None:
+                    # the exported metrics are those of the restored weights
+                    self.validation_metrics[model_name] = early_stopping.best_metrics
+                visualization_data[model_name]["best_epoch"] = f"epoch{early_stopping.best_epoch}"
+                self.log(f"Best epoch of {model_name} {early_stopping.best_epoch}: validation {self.args.early_stopping_metric} "
+                         f"{round(early_stopping.best_value, 4)}")
+        self.step_logger.close()
+        for checkpointer in self.checkpointers.values():
+            checkpointer.wait()
+        if not self.is_main:
+            return
+        os.makedirs(self.args.model_dir, exist_ok=True)
+        for model_name, classifier_model in self.classifier_models.items():
+            torch.save(classifier_model, os.path.join(self.args.model_dir, f"{model_name}_model.pt"))
+            # save for visualization, on rank 0 the train and validation predictions cover its own shard only
+            self.to_serialization(model_name, visualization_data[model_name])
+        if self.args.metrics_file is not None:
+            metrics = {model_name: {key: value.tolist() if isinstance(value, np.ndarray) else value
+                                    for key, value in validation.items()}
+                       for model_name, validation in self.validation_metrics.items()}
+            with open(self.args.metrics_file, "w") as fp:
+                # a single model keeps the flat layout read by sweep.py and cross_validation.py
+                json.dump(metrics[self.model_names[0]] if len(self.model_names) == 1 else metrics, fp)
 
 
 if __name__ == "__main__":
+    # before cuda is initialized, and only when run as a script rather than on import
+    os.environ["CUDA_VISIBLE_DEVICES"] = '4'
     parser = ArgumentParser()
     parser.add_argument("--train_input_file",
                         type=str,
@@ -214,6 +435,19 @@ if __name__ == "__main__":
                         type=str,
                         default="Softmax",  # or Softmax / DNN / Capsule
                         help="Model name.")
+    parser.add_argument("--model_names",
+                        type=str,
+                        nargs="+",
+                        default=None,
+                        help="Train several models from the same batches, e.g. Softmax DNN Capsule, overrides --model_name.")
+    parser.add_argument("--model_dir",
+                        type=str,
+                        default=MODEL_DIR,
+                        help="Save the trained model.")
+    parser.add_argument("--checkpoint_dir",
+                        type=str,
+                        default=CHECKPOINT_DIR,
+                        help="Directory of the training checkpoints.")
     parser.add_argument("--device",
                         type=str,
                         default="cuda" if torch.cuda.is_available() else "cpu",
@@ -225,7 +459,39 @@ if __name__ == "__main__":
     parser.add_argument("--epochs", type=int, default=5, help="Number of training epochs")
     parser.add_argument("--num_workers", type=int, default=0, help="Number of subprocesses for data loading.")
     parser.add_argument("--warmup_steps", type=int, default=0, help="The steps of warm up.")
+    parser.add_argument("--early_stopping_metric",
+                        type=str,
+                        default=None,
+                        choices=["loss", "auc", "f1", "accuracy", "recall", "precision"],
+                        help="Validation metric for early stopping, None trains all epochs.")
+    parser.add_argument("--patience", type=int, default=3, help="Epochs without improvement before early stopping.")
+    parser.add_argument("--min_delta", type=float, default=0.0, help="Minimum change that counts as an improvement.")
+    parser.add_argument("--checkpoint_every", type=int, default=1, help="Epochs between checkpoints.")
+    parser.add_argument("--resume", action="store_true", help="Resume training from the last checkpoint.")
+    parser.add_argument("--log_every", type=int, default=50, help="Steps between flushes of the buffered losses to TensorBoard.")
+    parser.add_argument("--precision",
+                        type=str,
+                        default="fp32",
+                        choices=["fp32", "bf16"],
+                        help="Compute precision of forward and loss, bf16 autocasts while keeping fp32 weights.")
+    parser.add_argument("--train_index_file", type=str, default=None, help="Optional .npy indices of the train items.")
+    parser.add_argument("--validation_index_file", type=str, default=None, help="Optional .npy indices of the validation items.")
+    parser.add_argument("--metrics_file", type=str, default=None, help="Path to write the final validation metrics as JSON.")
+    parser.add_argument("--async_eval",
+                        action="store_true",
+                        help="Validate each epoch on a background thread while the next epoch trains.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads per process, e.g. cores per socket.")
+    parser.add_argument("--perf_profile", type=str, default=None, help="Profile of autotune.py for threads, batch size and workers.")
     args = parser.parse_args()
+    apply_perf_profile(args, args.model_name)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    # launched with torchrun, e.g. one process per socket:
+    # OMP_NUM_THREADS=16 torchrun --nproc_per_node=2 trainer.py --model_name DNN --device cpu --num_threads 16
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1:
+        dist.init_process_group(backend="gloo")
     trainer = Trainer(args=args)
     trainer.train()
+    if dist.is_initialized():
+        dist.destroy_process_group()
     pass
@@ -0,0 +1,167 @@
+"""
+Distill a trained SDAE or Capsule Networks teacher into a Softmax or DNN student model.
+"""
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+from tqdm import tqdm
+from argparse import ArgumentParser
+from typing import Mapping, Tuple
+from torch.utils.data import Dataset, DataLoader
+sys.path.append(os.path.dirname(os.getcwd()))
+from src.utils.metrics import Metrics
+from src.utils.utils import custom_collate_fn, model_logits, load_pickled
+from src.featurizers.featurizer import CSFPDataset
+from src.models.softmax_model import SoftmaxModel
+from src.models.dnn_model import DNNModel
+from src.constants import DATA_DIR, MODEL_DIR
+
+
+class DistillationDataset(Dataset):
+    """Dataset of the molecules with the soft targets of the teacher.
+    """
+    def __init__(self, dataset: Dataset, teacher_logits: torch.Tensor):
+        super(DistillationDataset, self).__init__()
+        self.dataset = dataset
+        self.teacher_logits = teacher_logits
+
+    def __getitem__(self, item: int):
+        instance = self.dataset[item]
+        instance["teacher_logits"] = self.teacher_logits[item]
+        return instance
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+
+class DistillationTrainer(object):
+    def __init__(self, args):
+        self.args = args
+        self.set_seed(self.args.seed)
+        self.metrics = Metrics()
+        self.train_dataset = CSFPDataset(self.args.train_input_file)
+        self.validation_dataset = CSFPDataset(self.args.validation_input_file)
+        self.input_size = len(self.train_dataset.input_ids[0])
+        self.teacher_model = load_pickled(self.args.teacher_model_file, map_location=self.args.device).eval()
+        if self.args.student_name == "Softmax":
+            self.student_model = SoftmaxModel(input_size=self.input_size).to(self.args.device)
+        elif self.args.student_name == "DNN":
+            self.student_model = DNNModel(input_size=self.input_size).to(self.args.device)
+        else:
+            raise ValueError("Please input the right student model type.")
+        self.optimizer = torch.optim.Adam(self.student_model.parameters(), lr=self.args.student_lr)
+        pass
+
+    def set_seed(self, seed):
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        if torch.cuda.is_available():
+            torch.cuda.manual_seed_all(seed)
+
+    def dataloader(self, dataset: Dataset, shuffle: bool) -> DataLoader:
+        return DataLoader(dataset,
+                          batch_size=self.args.batch_size,
+                          collate_fn=custom_collate_fn,
+                          shuffle=shuffle,
+                          num_workers=self.args.num_workers)
+
+    def predict(self, model: nn.Module, dataset: Dataset) -> Tuple[torch.Tensor, np.ndarray, float]:
+        """
+        Run the model over the dataset in order.
+        :return: logits, labels and mean forward latency per molecule in ms
+        """
+        model.eval()
+        logits, labels, forward_time = [], [], 0.0
+        for batch in self.dataloader(dataset, shuffle=False):
+            input_ids = batch["input_ids"].to(self.args.device)
+            with torch.no_grad():
+                start_time = time.time()
+                logits.append(model_logits(model, input_ids).cpu())
+                forward_time += time.time() - start_time
+            labels.append(batch["label"].view(-1))
+        return torch.cat(logits), torch.cat(labels).numpy(), forward_time / len(dataset) * 1000
+
+    def distillation_loss(self, student_logits, teacher_logits, label):
+        """
+        Hinton et al. knowledge distillation loss: alpha * T^2 * KL(student_T || teacher_T) + (1 - alpha) * CE.
+        """
+        temperature, alpha = self.args.temperature, self.args.alpha
+        soft_loss = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                             F.softmax(teacher_logits / temperature, dim=1),
+                             reduction="batchmean") * temperature ** 2
+        hard_loss = F.cross_entropy(student_logits, label)
+        return alpha * soft_loss + (1.0 - alpha) * hard_loss
+
+    def report(self, name: str, logits: torch.Tensor, labels: np.ndarray, latency: float) -> Mapping:
+        predictions = logits.max(1)[1].numpy()
+        probabilities = torch.softmax(logits, dim=1)[:, 1].numpy()
+        report = {"recall": self.metrics.calculate_recall(labels, predictions),
+                  "precision": self.metrics.calculate_precision(labels, predictions),
+                  "f1": self.metrics.calculate_f1(labels, predictions),
+                  "auc": self.metrics.calculate_auc(labels, probabilities),
+                  "accuracy": self.metrics.calculate_accuracy(labels, predictions),
+                  "latency_ms": latency}
+        print(f"{name:>8} | " + " | ".join(f"{key} {round(value, 4)}" for key, value in report.items()))
+        return report
+
+    def train(self):
+        teacher_logits, _, _ = self.predict(self.teacher_model, self.train_dataset)
+        dataloader = self.dataloader(DistillationDataset(self.train_dataset, teacher_logits), shuffle=True)
+        for epoch in range(self.args.epochs):
+            self.student_model.train()
+            for batch in tqdm(dataloader, desc=f"Epoch {epoch}: "):
+                batch = {key: value.to(self.args.device) for key, value in batch.items()}
+                student_logits = self.student_model(batch["input_ids"])
+                loss = self.distillation_loss(student_logits, batch["teacher_logits"], batch["label"].view(-1))
+                self.optimizer.zero_grad()
+                loss.backward()
+                self.optimizer.step()
+            print(f"Distillation loss of epoch {epoch}: {round(loss.item(), 4)}")
+        teacher_report = self.report("Teacher", *self.predict(self.teacher_model, self.validation_dataset))
+        student_report = self.report("Student", *self.predict(self.student_model, self.validation_dataset))
+        print(f"Student speedup: x{round(teacher_report['latency_ms'] / student_report['latency_ms'], 2)}, "
+              f"auc drop {round(teacher_report['auc'] - student_report['auc'], 4)}")
+        torch.save(self.student_model, self.args.student_model_file)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--train_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/train_file.pt'),
+                        help="Path of the train dataset.")
+    parser.add_argument("--validation_input_file",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'dataset/validate_file.pt'),
+                        help="Path of the validation dataset.")
+    parser.add_argument("--teacher_model_file",
+                        type=str,
+                        default=os.path.join(MODEL_DIR, 'sdae1024-512-256-128_model-p3-c3-f5.pt'),
+                        help="Path of the saved SDAE or Capsule teacher model.")
+    parser.add_argument("--student_model_file",
+                        type=str,
+                        default=os.path.join(MODEL_DIR, 'softmax_student_model.pt'),
+                        help="Path to save the student model.")
+    parser.add_argument("--student_name",
+                        type=str,
+                        default="Softmax",  # or Softmax / DNN
+                        help="Student model name.")
+    parser.add_argument("--device",
+                        type=str,
+                        default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="Device (cuda or cpu)")
+    parser.add_argument("--temperature", type=float, default=2.0, help="Softmax temperature of the soft targets.")
+    parser.add_argument("--alpha", type=float, default=0.7, help="Weight of the soft target loss, 1 - alpha for labels.")
+    parser.add_argument("--batch_size", type=int, default=128, help="Batch size for training.")
+    parser.add_argument("--student_lr", type=float, default=0.001, help="Learning rate of the student.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed.")
+    parser.add_argument("--epochs", type=int, default=5, help="Number of training epochs")
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of subprocesses for data loading.")
+    args = parser.parse_args()
+    trainer = DistillationTrainer(args=args)
+    trainer.train()
+    pass
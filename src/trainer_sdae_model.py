@@ -1,5 +1,4 @@
 import os
-os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 import sys
 sys.path.append(os.path.dirname(os.getcwd()))
 from typing import Any, Callable, Optional, Mapping
@@ -10,20 +9,25 @@ from argparse import ArgumentParser
 from torch.optim import SGD, Adam
 import numpy as np
 from torch.optim.lr_scheduler import StepLR
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, TensorDataset, Subset
 from tqdm import tqdm
-from src.utils.utils import custom_collate_fn
-from src.utils.metrics import Metrics
-from torch.utils.tensorboard import SummaryWriter
+import gc
+import json
+import time
+from src.utils.utils import custom_collate_fn, autocast_context, peak_memory_mb, current_memory_mb, MemorySampler, reset_peak_memory, apply_perf_profile, load_pickled
+from src.utils.metrics import Metrics, StreamingMetrics
+from src.utils.logger import AsyncStepLogger
+from src.utils.checkpoint import AsyncCheckpointer, rng_state, set_rng_state
+from src.utils.encoding_cache import EncodingCache, MemmapDataset
+from src.utils.validation import ValidationScheduler, EarlyStopping, stratified_subsample
+from src.utils.evaluation import AsyncEvaluator
+from src.utils.artifact import save_artifact
 from src.models.sdae_model import AutoencoderLayer, StackedAutoEncoderModel
 from src.models.softmax_model import SoftmaxModel
-from src.featurizers.featurizer import CSFPDataset, get_dataloader
+from src.featurizers.featurizer import ShardedFingerprintDataset, get_dataloader, load_dataset, read_shards
+from src.constants import DATA_DIR, MODEL_DIR, VISUALIZATION_DIR, LOG_DIR, CHECKPOINT_DIR
 
-PROJECT_DIR = os.path.dirname(os.getcwd())  # get current working directory
-DATA_DIR = os.path.join(PROJECT_DIR, 'data')
-MODEL_DIR = os.path.join(PROJECT_DIR, 'model')
-VISUALIZATION_DIR = os.path.join(DATA_DIR, 'visualization')
-LOG_DIR = os.path.join(PROJECT_DIR, 'log')
+STAGES = ["pretrain", "classifier", "finetune"]
 
 
 class Trainer(object):
@@ -46,8 +50,24 @@ class Trainer(object):
         #self.train_input_size = next(iter(self.train_dataloader))["input_ids"].shape[1]
         #self.validation_input_size = next(iter(self.validation_dataloader))["input_ids"].shape[1]
         #self.sdae_model = StackedAutoEncoderModel(dimensions=[self.train_input_size, 2048, 1024, 512, 256, 128], final_activation=None).to(self.args.device)
-        self.softmax_layer = SoftmaxModel(input_size=128).to(self.args.device)
+        self.softmax_layer = SoftmaxModel(input_size=self.args.dimensions[-1]).to(self.args.device)
+        for param_group in self.softmax_layer.optimizer.param_groups:
+            param_group["lr"] = self.args.classifier_lr
+        # tensorboard is only imported for training
+        from torch.utils.tensorboard import SummaryWriter
         self.writer = SummaryWriter(self.args.log_path)
+        self.step_logger = AsyncStepLogger(self.writer, flush_every=self.args.log_every)
+        # pretraining stops on the reconstruction loss of each layer, finetuning on the chosen metric
+        self.pretrain_early_stopping = EarlyStopping(metric="loss",
+                                                     patience=self.args.patience,
+                                                     min_delta=self.args.min_delta) if self.args.early_stopping_metric else None
+        self.early_stopping = EarlyStopping(metric=self.args.early_stopping_metric,
+                                            patience=self.args.patience,
+                                            min_delta=self.args.min_delta) if self.args.early_stopping_metric else None
+        self.checkpointer = AsyncCheckpointer(self.args.checkpoint_dir, name="SDAE_checkpoint.pt")
+        self.resume_state = self.checkpointer.load(map_location=self.args.device) if self.args.resume else None
+        self.encoding_cache = EncodingCache(self.args.encoding_cache_dir, int(self.args.encoding_cache_gb * 1024 ** 3)) \
+            if self.args.encoding_cache_dir is not None else None
         # self.writer.add_graph(model=self.sdae_model,
         #                      input_to_model=next(iter(self.train_dataloader))["input_ids"].to(self.args.device))
         pass
@@ -65,6 +85,45 @@ class Trainer(object):
             torch.backends.cudnn.deterministic = True
             torch.backends.cudnn.benchmark = False
 
+    def save_checkpoint(self, stage: str, autoencoder: torch.nn.Module, epoch: int, **state) -> None:
+        """
+        Checkpoint the SDAE model, the softmax layer, their optimizers and the RNG at the end of an epoch of a stage.
+        :param stage: one of STAGES
+        :param autoencoder: the StackedAutoEncoderModel
+        :param epoch: last finished epoch of the stage
+        :param state: stage specific state, e.g. the sub-autoencoder being pretrained
+        """
+        self.checkpointer.save({"stage": stage,
+                                "epoch": epoch,
+                                "sdae_model": autoencoder.state_dict(),
+                                "sdae_optimizer": autoencoder.optimizer.state_dict(),
+                                "softmax_layer": self.softmax_layer.state_dict(),
+                                "softmax_optimizer": self.softmax_layer.optimizer.state_dict(),
+                                "rng": rng_state(),
+                                **state})
+
+    def resume_stage(self, stage: str) -> Optional[Mapping]:
+        """
+        :return: the checkpoint if training resumes inside the given stage, otherwise None
+        """
+        if self.resume_state is not None and self.resume_state["stage"] == stage:
+            return self.resume_state
+        return None
+
+    def stage_completed(self, stage: str) -> bool:
+        return self.resume_state is not None and STAGES.index(self.resume_state["stage"]) > STAGES.index(stage)
+
+    def restore(self, autoencoder: torch.nn.Module) -> None:
+        """Load the model and optimizer states of the resumed checkpoint."""
+        if self.resume_state is None:
+            return
+        autoencoder.load_state_dict(self.resume_state["sdae_model"])
+        autoencoder.optimizer.load_state_dict(self.resume_state["sdae_optimizer"])
+        self.softmax_layer.load_state_dict(self.resume_state["softmax_layer"])
+        self.softmax_layer.optimizer.load_state_dict(self.resume_state["softmax_optimizer"])
+        set_rng_state(self.resume_state["rng"])
+        print(f"Resume from stage {self.resume_state['stage']} epoch {self.resume_state['epoch']}.")
+
     def to_serialization(self, visualization: Mapping):
         if not os.path.exists(self.args.visualization_dir):
             os.mkdir(self.args.visualization_dir)
@@ -84,7 +143,10 @@ class Trainer(object):
                              update_freq: Optional[int] = 1,
                              update_callback: Optional[Callable[[float, float], None]] = None,
                              num_workers: Optional[int] = None,
-                             epoch_callback: Optional[Callable[[int, torch.nn.Module], None]] = None) -> None:
+                             epoch_callback: Optional[Callable[[int, torch.nn.Module], None]] = None,
+                             start_epoch: int = 0,
+                             validation_scheduler: Optional[ValidationScheduler] = None,
+                             early_stopping: Optional[EarlyStopping] = None) -> None:
         """
         Function to train an autoencoder using the provided dataset. If the dataset consists of 2-tuples or lists of
         (feature, prediction), then the prediction is stripped away.
@@ -102,8 +164,14 @@ class Trainer(object):
         :param update_callback: optional function of loss and validation loss to update
         :param num_workers: optional number of workers to use for data loading
         :param epoch_callback: optional function of epoch and model
+        :param start_epoch: first epoch to train, used when resuming, defaults to 0
+        :param validation_scheduler: optional scheduler of extra validations inside an epoch, defaults to None
+        :param early_stopping: optional early stopping on the validation loss, the best weights are restored at
+        the end, defaults to None
         :return: None
         """
+        if early_stopping is not None:
+            early_stopping.reset()
         dataloader = DataLoader(
             dataset,
             batch_size=batch_size,
@@ -126,7 +194,7 @@ class Trainer(object):
         autoencoder.train()
         validation_loss_value = -1
         loss_value = 0
-        for epoch in range(epochs):
+        for epoch in range(start_epoch, epochs):
             if scheduler is not None:
                 scheduler.step()
             data_iterator = tqdm(
@@ -135,49 +203,50 @@ class Trainer(object):
                 unit="batch",
                 postfix={"epo": epoch, "lss": "%.6f" % 0.0, "vls": "%.6f" % -1, },
                 disable=silent)
+            step_time = 0.0
+            # early stopping only sees a loss of the weights at the end of this epoch
+            epoch_validated = False
             for index, batch in enumerate(data_iterator):
+                step_start_time = time.time()
                 if isinstance(batch, dict):
                     batch = {key: value.to(self.args.device) for key, value in batch.items()}
                     input_ids, label = batch["input_ids"], batch["label"]
                 elif isinstance(batch, list):
                     input_ids = batch[0].to(self.args.device)
+                input_ids = input_ids.float()
                 # run the batch through the autoencoder and obtain the output
-                if dropout is not None:
-                    output = autoencoder(F.dropout(input_ids, dropout))
-                else:
-                    output = autoencoder(input_ids)
-                loss = loss_function(output, input_ids)
+                with autocast_context(self.args.device, self.args.precision):
+                    if dropout is not None:
+                        output = autoencoder(F.dropout(input_ids, dropout))
+                    else:
+                        output = autoencoder(input_ids)
+                loss = loss_function(output.float(), input_ids)
                 # accuracy = pretrain_accuracy(output, batch)
                 loss_value = float(loss.item())
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step(closure=None)
+                step_time += time.time() - step_start_time
+                if validation_loader is not None and validation_scheduler is not None and validation_scheduler.due(index):
+                    validation_loss_value = self._reconstruction_loss(autoencoder, validation_loader)
+                    validation_scheduler.reset()
                 data_iterator.set_postfix(
                     epo=epoch, lss="%.6f" % loss_value, vls="%.6f" % validation_loss_value,
                 )
+            if not silent:
+                print(f"Precision {self.args.precision}: {round(step_time / len(dataloader) * 1000, 2)} ms/step, "
+                      f"peak memory {round(peak_memory_mb(self.args.device), 1)} MB")
             if update_freq is not None and epoch % update_freq == 0:
                 if validation_loader is not None:
-                    validation_output = self.inference(validation, autoencoder, batch_size, silent=True, encode=False)
-                    validation_inputs = []
-                    for val_batch in validation_loader:
-                        if isinstance(val_batch, dict):
-                            val_batch = {key: value for key, value in val_batch.items()}
-                            input_ids, label = val_batch["input_ids"], val_batch["label"]
-                        elif isinstance(val_batch, list):
-                            input_ids = val_batch[0].to(self.args.device)
-                        validation_inputs.append(input_ids)
-                    validation_actual = torch.cat(validation_inputs)
-                    validation_actual = validation_actual.to(self.args.device)
-                    validation_output = validation_output.to(self.args.device)
-                    validation_loss = loss_function(validation_output, validation_actual)
-                    # validation_accuracy = pretrain_accuracy(validation_output, validation_actual)
-                    validation_loss_value = float(validation_loss.item())
+                    validation_loss_value = self._reconstruction_loss(autoencoder, validation_loader)
+                    epoch_validated = True
+                    if validation_scheduler is not None:
+                        validation_scheduler.reset()
                     data_iterator.set_postfix(
                         epo=epoch,
                         lss="%.6f" % loss_value,
                         vls="%.6f" % validation_loss_value,
                     )
-                    autoencoder.train()
                 else:
                     validation_loss_value = -1
                     # validation_accuracy = -1
@@ -195,6 +264,31 @@ class Trainer(object):
                 autoencoder.eval()
                 epoch_callback(epoch, autoencoder)
                 autoencoder.train()
+            if early_stopping is not None and epoch_validated and \
+                    early_stopping.step(validation_loss_value, epoch, autoencoder):
+                if not silent:
+                    print(f"Early stopping at epoch {epoch}, best epoch {early_stopping.best_epoch}.")
+                break
+        if early_stopping is not None:
+            early_stopping.restore(autoencoder)
+
+    def _reconstruction_loss(self, autoencoder: torch.nn.Module, validation_loader: DataLoader) -> float:
+        """
+        Mean squared reconstruction error over the validation loader, accumulated chunk by chunk on the device so
+        that neither the validation outputs nor the targets are materialized as a whole.
+        """
+        autoencoder.eval()
+        squared_error, count = torch.zeros((), device=self.args.device), 0
+        with torch.no_grad():
+            for val_batch in validation_loader:
+                input_ids = val_batch["input_ids"] if isinstance(val_batch, dict) else val_batch[0]
+                input_ids = input_ids.to(self.args.device).float()
+                with autocast_context(self.args.device, self.args.precision):
+                    output = autoencoder(input_ids)
+                squared_error += F.mse_loss(output.float(), input_ids, reduction="sum")
+                count += input_ids.numel()
+        autoencoder.train()
+        return float(squared_error.item() / max(count, 1))
 
     def pretrain_sdae_layers(self,
                              dataset,
@@ -210,7 +304,11 @@ class Trainer(object):
                              update_freq: Optional[int] = 1,
                              update_callback: Optional[Callable[[float, float], None]] = None,
                              num_workers: Optional[int] = None,
-                             epoch_callback: Optional[Callable[[int, torch.nn.Module], None]] = None) -> None:
+                             epoch_callback: Optional[Callable[[int, torch.nn.Module], None]] = None,
+                             low_memory: bool = False,
+                             start_layer: int = 0,
+                             validation_scheduler: Optional[ValidationScheduler] = None,
+                             validation_subsample: Optional[int] = None) -> None:
         """
         Given an autoencoder, train it using the data provided in the dataset; for simplicity the accuracy is reported only
         on the training dataset. If the training dataset is a 2-tuple or list of (feature, prediction), then the prediction
@@ -229,31 +327,75 @@ class Trainer(object):
         :param update_callback: function of loss and validation loss to update
         :param num_workers: optional number of workers to use for data loading
         :param epoch_callback: function of epoch and model
+        :param low_memory: use tied sub-autoencoders, free each one with its optimizer after copying the weights and
+        keep the intermediate encodings as fp16, defaults to False
+        :param start_layer: first sub-autoencoder to pretrain, the encoder layers before it are kept as they are,
+        defaults to 0
+        :param validation_scheduler: optional scheduler of extra validations inside an epoch, defaults to None
+        :param validation_subsample: optional size of a fixed subsample, stratified by label when the validation
+        dataset has labels, used for validation of every layer, defaults to None
         :return: None
         """
+        validation_indices = None
+        if validation is not None and validation_subsample is not None:
+            validation_indices = stratified_subsample(validation_subsample, len(validation), getattr(validation, "labels", None))
+        memory_table = []
         current_dataset = dataset
         current_validation = validation
         number_of_subautoencoders = len(autoencoder.dimensions) - 1
-        for index in range(number_of_subautoencoders):
+        encoding_dtype = torch.float16 if low_memory else torch.float32
+        resume = self.resume_stage("pretrain")
+        start_index = resume["layer"] if resume is not None else start_layer
+        if start_index > 0:
+            # the encoder already holds the weights of the pretrained layers, re-encode the inputs of the start layer
+            encoder = autoencoder.encoder[:start_index]
+            current_dataset = self.encode_dataset(dataset, encoder, dataset, encoder, batch_size, silent=silent, encode=False, dtype=encoding_dtype)
+            if current_validation is not None:
+                current_validation = self.encode_dataset(validation, encoder, validation, encoder, batch_size, silent=silent, encode=False, dtype=encoding_dtype)
+        for index in range(start_index, number_of_subautoencoders):
             encoder, decoder = autoencoder.get_stack(index)
             embedding_dimension = autoencoder.dimensions[index]
             hidden_dimension = autoencoder.dimensions[index + 1]
             # manual override to prevent dropout for the last subautoencoder
             if index == (number_of_subautoencoders - 1):
                 dropout = None
+            reset_peak_memory(self.args.device)
+            memory_before = current_memory_mb(self.args.device)
+            memory_sampler = MemorySampler(self.args.device).start()
             # initialise the subautoencoder
             sub_autoencoder = AutoencoderLayer(embedding_dimension=embedding_dimension,
                                                hidden_dimension=hidden_dimension,
                                                activation=torch.nn.ReLU() if index != (number_of_subautoencoders - 1) else None,
-                                               dropout=nn.Dropout(dropout) if dropout is not None else None).to(self.args.device)
+                                               dropout=nn.Dropout(dropout) if dropout is not None else None,
+                                               tied=low_memory).to(self.args.device)
+            parameters_size = sum(parameter.numel() * parameter.element_size() for parameter in sub_autoencoder.parameters())
             ae_optimizer = optimizer(sub_autoencoder)
             ae_scheduler = scheduler(ae_optimizer) if scheduler is not None else scheduler
+            start_epoch = 0
+            if resume is not None and index == resume["layer"]:
+                sub_autoencoder.load_state_dict(resume["sub_autoencoder"])
+                ae_optimizer.load_state_dict(resume["ae_optimizer"])
+                if ae_scheduler is not None:
+                    ae_scheduler.load_state_dict(resume["ae_scheduler"])
+                start_epoch = resume["epoch"] + 1
+
+            def checkpoint_callback(epoch, model, index=index, ae_optimizer=ae_optimizer, ae_scheduler=ae_scheduler):
+                if epoch_callback is not None:
+                    epoch_callback(epoch, model)
+                self.save_checkpoint("pretrain",
+                                     autoencoder,
+                                     epoch,
+                                     layer=index,
+                                     sub_autoencoder=model.state_dict(),
+                                     ae_optimizer=ae_optimizer.state_dict(),
+                                     ae_scheduler=ae_scheduler.state_dict() if ae_scheduler is not None else None)
+
             self._pretrain_sdae_layer(current_dataset,
                                       sub_autoencoder,
                                       epochs if index != 0 else 1,
                                       batch_size,
                                       ae_optimizer,
-                                      validation=current_validation,
+                                      validation=Subset(current_validation, validation_indices) if current_validation is not None and validation_indices is not None else current_validation,
                                       dropout=None,  # already have dropout in the DAE
                                       scheduler=ae_scheduler,
                                       sampler=sampler,
@@ -261,24 +403,261 @@ class Trainer(object):
                                       update_freq=update_freq,
                                       update_callback=update_callback,
                                       num_workers=num_workers,
-                                      epoch_callback=epoch_callback)
+                                      epoch_callback=checkpoint_callback,
+                                      start_epoch=start_epoch,
+                                      validation_scheduler=validation_scheduler,
+                                      early_stopping=self.pretrain_early_stopping)
             # Copy the weights to sdae model.
             sub_autoencoder.copy_weights(encoder, decoder)
             # pass the dataset through the encoder part of the subautoencoder
             if index != (number_of_subautoencoders - 1):
-                current_dataset = TensorDataset(self.inference(current_dataset, sub_autoencoder, batch_size, silent=silent))
+                encoder = autoencoder.encoder[:index + 1]
+                current_dataset = self.encode_dataset(dataset, encoder, current_dataset, sub_autoencoder, batch_size, silent=silent, dtype=encoding_dtype)
                 if current_validation is not None:
-                    current_validation = TensorDataset(self.inference(current_validation, sub_autoencoder, batch_size, silent=silent))
+                    current_validation = self.encode_dataset(validation, encoder, current_validation, sub_autoencoder, batch_size, silent=silent, dtype=encoding_dtype)
             else:
                 current_dataset = None  # minor optimisation on the last subautoencoder
                 current_validation = None
+            memory_peak = memory_sampler.stop()
+            memory_after = current_memory_mb(self.args.device)
+            memory_table.append((index,
+                                 f"{embedding_dimension}-{hidden_dimension}",
+                                 parameters_size / 1024 ** 2,
+                                 self._encodings_mb(current_dataset) + self._encodings_mb(current_validation),
+                                 memory_after - memory_before if memory_after is not None else None,
+                                 peak_memory_mb(self.args.device) if str(self.args.device).startswith("cuda") else memory_peak))
+            if low_memory:
+                del sub_autoencoder, ae_optimizer, ae_scheduler, checkpoint_callback
+                gc.collect()
+        if not silent:
+            # on cpu the peak is the sampled maximum of the resident set size while the layer was pretrained and
+            # its encodings computed, on cuda the allocator peak
+            print(f"{'layer':>5} | {'dimensions':>14} | {'params MB':>10} | {'encodings MB':>12} | {'delta MB':>10} | {'peak MB':>10}")
+            for index, dimensions, parameters_size, encodings_size, memory_delta, peak_memory in memory_table:
+                print(f"{index:>5} | {dimensions:>14} | {parameters_size:>10.1f} | {encodings_size:>12.1f} | "
+                      f"{memory_delta if memory_delta is not None else float('nan'):>10.1f} | "
+                      f"{peak_memory if peak_memory is not None else float('nan'):>10.1f}")
+
+    @staticmethod
+    def _encodings_mb(dataset) -> float:
+        """Size in MB of the in-memory or memory-mapped encodings of a layer, 0 for any other dataset."""
+        if isinstance(dataset, Subset):
+            dataset = dataset.dataset
+        if isinstance(dataset, TensorDataset):
+            return sum(tensor.numel() * tensor.element_size() for tensor in dataset.tensors) / 1024 ** 2
+        if isinstance(dataset, MemmapDataset):
+            return dataset.array.nbytes / 1024 ** 2
+        return 0.0
+
+    def pretrain_sdae_layers_jointly(self,
+                                     dataset,
+                                     autoencoder: StackedAutoEncoderModel,
+                                     epochs: int,
+                                     batch_size: int,
+                                     optimizer: Callable[[torch.nn.Module], torch.optim.Optimizer],
+                                     scheduler: Optional[Callable[[torch.optim.Optimizer], Any]] = None,
+                                     validation: Optional[torch.utils.data.Dataset] = None,
+                                     dropout: Optional[float] = None,
+                                     silent: bool = False,
+                                     num_workers: Optional[int] = None,
+                                     low_memory: bool = False,
+                                     shuffle_buffer: int = 10000) -> None:
+        """
+        Train all sub-autoencoders in one pass over the dataset per epoch: every batch goes up the stack once, each
+        layer reconstructs the detached clean encoding of the layer below, so that no gradient flows between layers
+        as in the greedy layer-wise schedule, without re-encoding the dataset between layers. As in the sequential
+        schedule the first layer trains a single epoch, it is frozen afterwards.
+        :param dataset: instance of Dataset to use for training, or the shard prefixes of a library that does not fit
+        in memory, streamed in chunks of one shard per data loading worker with a checkpoint after every chunk
+        :param autoencoder: instance of an autoencoder to train
+        :param epochs: number of training epochs
+        :param batch_size: batch size for training
+        :param optimizer: function taking model and returning optimizer
+        :param scheduler: function taking optimizer and returning scheduler, or None to disable
+        :param validation: instance of Dataset to use for validation
+        :param dropout: proportion of masking dropout of the encodings, set to None to disable, defaults to None
+        :param silent: set to True to prevent printing out summary statistics, defaults to False
+        :param num_workers: optional number of workers to use for data loading
+        :param low_memory: use tied sub-autoencoders, defaults to False
+        :param shuffle_buffer: molecules in the shuffle buffer when streaming shards, defaults to 10000
+        :return: None
+        """
+        number_of_subautoencoders = len(autoencoder.dimensions) - 1
+        sub_autoencoders = nn.ModuleList([
+            AutoencoderLayer(embedding_dimension=autoencoder.dimensions[index],
+                             hidden_dimension=autoencoder.dimensions[index + 1],
+                             activation=torch.nn.ReLU() if index != (number_of_subautoencoders - 1) else None,
+                             dropout=nn.Dropout(dropout) if dropout is not None and index != (number_of_subautoencoders - 1) else None,
+                             tied=low_memory)
+            for index in range(number_of_subautoencoders)]).to(self.args.device)
+        ae_optimizer = optimizer(sub_autoencoders)
+        ae_scheduler = scheduler(ae_optimizer) if scheduler is not None else scheduler
+        # an in-memory dataset is a single chunk, a streamed library chunks of one shard per worker, the
+        # ShardedFingerprintDataset of a chunk gives every DataLoader worker its own shard
+        streaming = isinstance(dataset, (list, tuple))
+        shards_per_chunk = max(num_workers or 0, 1)
+        chunks = [list(dataset[start:start + shards_per_chunk]) for start in range(0, len(dataset), shards_per_chunk)] \
+            if streaming else [dataset]
+        resume = self.resume_stage("pretrain")
+        start_epoch, start_chunk, global_step = 0, 0, 0
+        if resume is not None and resume.get("joint"):
+            sub_autoencoders.load_state_dict(resume["sub_autoencoders"])
+            ae_optimizer.load_state_dict(resume["ae_optimizer"])
+            if ae_scheduler is not None:
+                ae_scheduler.load_state_dict(resume["ae_scheduler"])
+            global_step = resume.get("global_step", 0)
+            if resume.get("shard") is not None and resume.get("shards_per_chunk", 1) != shards_per_chunk:
+                # the chunks of the checkpoint were cut for another number of workers
+                start_epoch = resume["epoch"]
+            elif resume.get("shard") is not None and resume["shard"] + 1 < len(chunks):
+                start_epoch, start_chunk = resume["epoch"], resume["shard"] + 1
+            else:
+                start_epoch = resume["epoch"] + 1
+            if not silent:
+                print(f"Resume joint pretraining from epoch {start_epoch} chunk {start_chunk}.")
+        validation_loader = DataLoader(validation, batch_size=batch_size, pin_memory=False, shuffle=False) \
+            if validation is not None else None
+
+        def layer_losses(input_ids: torch.Tensor, frozen: int = 0):
+            losses = []
+            for index, sub_autoencoder in enumerate(sub_autoencoders):
+                with torch.set_grad_enabled(torch.is_grad_enabled() and index >= frozen):
+                    with autocast_context(self.args.device, self.args.precision):
+                        encoded = F.linear(input_ids, sub_autoencoder.encoder_weight, sub_autoencoder.encoder_bias)
+                        if sub_autoencoder.activation is not None:
+                            encoded = sub_autoencoder.activation(encoded)
+                        corrupted = sub_autoencoder.dropout(encoded) if sub_autoencoder.dropout is not None else encoded
+                        output = sub_autoencoder.decode(corrupted)
+                    losses.append(F.mse_loss(output.float(), input_ids))
+                # stop-gradient, the next layer learns to reconstruct the clean encoding of this one
+                input_ids = encoded.detach().float()
+            return losses
+
+        def save_checkpoint(epoch: int, shard: Optional[int]):
+            self.save_checkpoint("pretrain",
+                                 autoencoder,
+                                 epoch,
+                                 joint=True,
+                                 shard=shard,
+                                 shards_per_chunk=shards_per_chunk,
+                                 global_step=global_step,
+                                 sub_autoencoders=sub_autoencoders.state_dict(),
+                                 ae_optimizer=ae_optimizer.state_dict(),
+                                 ae_scheduler=ae_scheduler.state_dict() if ae_scheduler is not None else None)
+
+        for epoch in range(start_epoch, epochs):
+            sub_autoencoders.train()
+            # the first layer, by far the largest, trains a single epoch as in the sequential schedule
+            frozen = 1 if epoch > 0 else 0
+            for parameter in sub_autoencoders[0].parameters():
+                parameter.requires_grad_(frozen == 0)
+            if scheduler is not None and (epoch > start_epoch or start_chunk == 0):
+                ae_scheduler.step()
+            reset_peak_memory(self.args.device)
+            step_time, steps = 0.0, 0
+            for chunk_index in range(start_chunk if epoch == start_epoch else 0, len(chunks)):
+                if streaming:
+                    dataloader = DataLoader(ShardedFingerprintDataset(chunks[chunk_index],
+                                                                      autoencoder.dimensions[0],
+                                                                      shuffle_buffer=shuffle_buffer,
+                                                                      seed=self.args.seed + epoch * len(chunks) + chunk_index),
+                                            batch_size=batch_size,
+                                            pin_memory=False,
+                                            num_workers=min(num_workers or 0, len(chunks[chunk_index])))
+                else:
+                    dataloader = DataLoader(chunks[chunk_index],
+                                            batch_size=batch_size,
+                                            pin_memory=False,
+                                            shuffle=True,
+                                            num_workers=num_workers if num_workers is not None else 0)
+                data_iterator = tqdm(dataloader, leave=True, unit="batch", desc=f"Joint pretrain epoch {epoch} chunk {chunk_index}: ", disable=silent)
+                for batch in data_iterator:
+                    step_start_time = time.time()
+                    input_ids = (batch["input_ids"] if isinstance(batch, dict) else batch[0]).to(self.args.device).float()
+                    losses = layer_losses(input_ids, frozen=frozen)
+                    loss = sum(losses[frozen:])
+                    # gradients of the frozen layer stay None, so that momentum does not keep moving it
+                    ae_optimizer.zero_grad(set_to_none=True)
+                    loss.backward()
+                    ae_optimizer.step()
+                    for layer, layer_loss in enumerate(losses):
+                        self.step_logger.add_scalar(tag=f"SDAE Joint Pretrain Loss Layer {layer}",
+                                                    scalar_value=layer_loss.detach(),
+                                                    global_step=global_step)
+                    global_step += 1
+                    steps += 1
+                    step_time += time.time() - step_start_time
+                if streaming:
+                    self.step_logger.flush()
+                    for index, sub_autoencoder in enumerate(sub_autoencoders):
+                        sub_autoencoder.copy_weights(*autoencoder.get_stack(index))
+                    save_checkpoint(epoch, chunk_index)
+            self.step_logger.flush()
+            if validation_loader is not None:
+                sub_autoencoders.eval()
+                squared_errors, count = torch.zeros(number_of_subautoencoders, device=self.args.device), 0
+                with torch.no_grad():
+                    for batch in validation_loader:
+                        input_ids = (batch["input_ids"] if isinstance(batch, dict) else batch[0]).to(self.args.device).float()
+                        squared_errors += torch.stack(layer_losses(input_ids)) * len(input_ids)
+                        count += len(input_ids)
+                validation_losses = (squared_errors / max(count, 1)).cpu().tolist()
+                if not silent:
+                    print(f"Validation reconstruction loss per layer: {[round(value, 6) for value in validation_losses]}")
+            if not silent:
+                print(f"Precision {self.args.precision}: {round(step_time / max(steps, 1) * 1000, 2)} ms/step, "
+                      f"peak memory {round(peak_memory_mb(self.args.device), 1)} MB")
+            for index, sub_autoencoder in enumerate(sub_autoencoders):
+                sub_autoencoder.copy_weights(*autoencoder.get_stack(index))
+            save_checkpoint(epoch, None)
+        for index, sub_autoencoder in enumerate(sub_autoencoders):
+            sub_autoencoder.copy_weights(*autoencoder.get_stack(index))
+
+    def encode_dataset(self,
+                       raw_dataset: torch.utils.data.Dataset,
+                       encoder: torch.nn.Module,
+                       dataset: torch.utils.data.Dataset,
+                       model: torch.nn.Module,
+                       batch_size: int,
+                       silent: bool = False,
+                       encode: bool = True,
+                       dtype: torch.dtype = torch.float32) -> torch.utils.data.Dataset:
+        """
+        Encode the dataset with the model. With an encoding cache the encodings are looked up by the raw dataset
+        and the encoder layers that produce them, and on a miss streamed into a new fp16 memory-mapped entry.
+        :param raw_dataset: dataset of the raw fingerprints, identifies the cache entry
+        :param encoder: encoder layers from the raw fingerprints up to the encoded layer, identifies the cache entry
+        :param dataset: input of the model, the raw dataset or the encodings of the previous layer
+        :param model: model computing the encodings from the dataset
+        :param batch_size: batch size
+        :param silent: set to True to prevent printing out summary statistics, defaults to False
+        :param encode: whether to call model.encode or the model itself
+        :param dtype: dtype of the in-memory encodings when there is no cache
+        :return: dataset of the encodings
+        """
+        # keyed on the weights that compute the encodings, a dataset without a source file is not cached
+        key = self.encoding_cache.key(raw_dataset, [EncodingCache.layer_digest(layer) for layer in encoder], self.args.precision) \
+            if self.encoding_cache is not None else None
+        if key is None:
+            # streamed into the encodings of the requested dtype, the fp32 encodings are never held as a whole
+            output = torch.empty(len(dataset), encoder[-1].linear.out_features, dtype=dtype)
+            return TensorDataset(self.inference(dataset, model, batch_size, silent=silent, encode=encode, output=output))
+        array = self.encoding_cache.get(key)
+        if array is None:
+            output = self.encoding_cache.create(key, (len(dataset), encoder[-1].linear.out_features))
+            self.inference(dataset, model, batch_size, silent=silent, encode=encode, output=output)
+            array = self.encoding_cache.commit(key, output)
+        elif not silent:
+            print(f"Load encodings of layer {len(encoder) - 1} from the encoding cache.")
+        return MemmapDataset(array)
 
     def inference(self,
                   dataset: torch.utils.data.Dataset,
                   model: torch.nn.Module,
                   batch_size: int,
                   silent: bool = False,
-                  encode: bool = True) -> torch.Tensor:
+                  encode: bool = True,
+                  output: Optional[np.ndarray] = None):
         """
         Given a dataset, run the model in evaluation mode with the inputs in batches and concatenate the
         output.
@@ -287,11 +666,13 @@ class Trainer(object):
         :param batch_size: batch size
         :param silent: set to True to prevent printing out summary statistics, defaults to False
         :param encode: whether to encode or use the full autoencoder
-        :return: predicted features from the Dataset
+        :param output: optional preallocated array or tensor, e.g. a memmap, the batches are streamed into instead of
+        concatenated, defaults to None
+        :return: predicted features from the Dataset, or output when given
         """
         dataloader = DataLoader(dataset, batch_size=batch_size, pin_memory=False, shuffle=False)
         data_iterator = tqdm(dataloader, leave=False, unit="batch", disable=silent)
-        features = []
+        features, offset = [], 0
         if isinstance(model, torch.nn.Module):
             model.eval()
         for batch in data_iterator:
@@ -300,12 +681,18 @@ class Trainer(object):
                 input_ids, label = batch["input_ids"], batch["label"]
             elif isinstance(batch, list):
                 input_ids = batch[0].to(self.args.device)
-            if encode:
-                output = model.encode(input_ids)
+            with torch.no_grad(), autocast_context(self.args.device, self.args.precision):
+                if encode:
+                    output_batch = model.encode(input_ids.float())
+                else:
+                    output_batch = model(input_ids.float())
+            features_batch = output_batch.detach().float().cpu()  # move to the CPU to prevent out of memory on the GPU
+            if output is not None:
+                output[offset:offset + len(features_batch)] = features_batch if isinstance(output, torch.Tensor) else features_batch.numpy()
+                offset += len(features_batch)
             else:
-                output = model(input_ids)
-            features.append(output.detach().cpu())  # move to the CPU to prevent out of memory on the GPU
-        return torch.cat(features)
+                features.append(features_batch)
+        return output if output is not None else torch.cat(features)
 
     def train_softmax_layer_or_sdae_model(self,
                                           dataset,
@@ -316,7 +703,12 @@ class Trainer(object):
                                           validation: Optional[torch.utils.data.Dataset] = None,
                                           sampler: Optional[torch.utils.data.sampler.Sampler] = None,
                                           num_workers: Optional[int] = None):
-        visualization_data = {}
+        stage = "finetune" if train_sdae else "classifier"
+        resume = self.resume_stage(stage)
+        visualization_data = resume.get("visualization_data", {}) if resume is not None else {}
+        if resume is not None and self.early_stopping is not None and resume.get("early_stopping") is not None:
+            vars(self.early_stopping).update(resume["early_stopping"])
+        start_epoch = resume["epoch"] + 1 if resume is not None else 0
         dataloader = DataLoader(dataset,
                                 batch_size=batch_size,
                                 pin_memory=False,
@@ -326,55 +718,80 @@ class Trainer(object):
             autoencoder.eval()
         else:
             autoencoder.train()
-        for epoch in range(epochs):
+        # validation of an epoch on a background thread while the next one trains
+        async_evaluator = AsyncEvaluator({"SDAE": autoencoder},
+                                         lambda epoch, models: self.eval_sdae_model(epoch, models["SDAE"], batch_size, validation)) \
+            if train_sdae and self.args.async_eval else None
+        if train_sdae and resume is not None and not resume.get("validated", True):
+            # written by --async_eval before the validation of its epoch was collected, run that validation again so
+            # that early stopping and the visualization data miss no epoch
+            stop = self.record_validation(visualization_data,
+                                          resume["epoch"],
+                                          self.eval_sdae_model(epoch=resume["epoch"],
+                                                               autoencoder=autoencoder,
+                                                               batch_size=batch_size,
+                                                               validation=validation),
+                                          autoencoder)
+            autoencoder.train()
+            self.save_checkpoint(stage, autoencoder, resume["epoch"], visualization_data=visualization_data,
+                                 early_stopping=vars(self.early_stopping) if self.early_stopping is not None else None)
+            if stop:
+                print(f"Early stopping at epoch {resume['epoch']}, validation {self.args.early_stopping_metric} did not "
+                      f"improve for {self.args.patience} epochs.")
+                start_epoch = epochs
+        for epoch in range(start_epoch, epochs):
             if not train_sdae:
                 self.softmax_layer.train()
-            predictions_vis, predictions, labels = [], [], []
+            predictions_vis, labels = [], []
+            streaming_metrics = StreamingMetrics(self.args.device)
+            step_time = 0.0
             for i, batch in enumerate(tqdm(dataloader, desc=f"Epoch {epoch}: ")):
+                step_start_time = time.time()
                 batch = {key: value.to(self.args.device) for key, value in batch.items()}
                 input_ids, label = batch["input_ids"], batch["label"].view(-1)
 
                 if train_sdae:
-                    prediction = autoencoder(input_ids)
+                    with autocast_context(self.args.device, self.args.precision):
+                        prediction = autoencoder(input_ids)
+                    prediction = prediction.float()
                     classifier_model_loss = autoencoder.criterion(prediction, label)
                     autoencoder.optimizer.zero_grad()
                     classifier_model_loss.backward()
                     autoencoder.optimizer.step()
                     # for tensorboard
-                    self.writer.add_scalar(tag="SDAE Model with Classifier Head Train Loss",
-                                           scalar_value=classifier_model_loss.item(),
-                                           global_step=epoch * len(dataloader) + i)
+                    self.step_logger.add_scalar(tag="SDAE Model with Classifier Head Train Loss",
+                                                scalar_value=classifier_model_loss,
+                                                global_step=epoch * len(dataloader) + i)
                     # for visualization
                     predictions_vis.append(prediction.detach())
                     labels.append(label)
                     # for metrics
-                    prediction = prediction.data.max(1, keepdim=True)[1].view(-1)
-                    predictions.append(prediction)
+                    streaming_metrics.update(prediction, label, loss=classifier_model_loss)
                 else:
-                    with torch.no_grad():
+                    with torch.no_grad(), autocast_context(self.args.device, self.args.precision):
                         input_ids = autoencoder.encoder(input_ids)
                     # Softmax layer
-                    prediction = self.softmax_layer(input_ids)
-                    classifier_model_loss = self.softmax_layer.criterion(prediction, label)
+                    with autocast_context(self.args.device, self.args.precision):
+                        prediction = self.softmax_layer(input_ids)
+                    classifier_model_loss = self.softmax_layer.criterion(prediction.float(), label)
                     self.softmax_layer.optimizer.zero_grad()
                     classifier_model_loss.backward()
                     self.softmax_layer.optimizer.step()
+                step_time += time.time() - step_start_time
+            self.step_logger.flush("SDAE Model with Classifier Head Train Loss")
+            print(f"Precision {self.args.precision}: {round(step_time / len(dataloader) * 1000, 2)} ms/step, "
+                  f"peak memory {round(peak_memory_mb(self.args.device), 1)} MB")
             if train_sdae:
+                train = streaming_metrics.compute()
+                print(f"Train loss: {round(train['loss'], 4)}")
                 predictions_vis = torch.cat(predictions_vis, dim=0).cpu().numpy()
-                predictions = torch.cat(predictions, dim=0).cpu().numpy()
                 labels = torch.cat(labels, dim=0).cpu().numpy()
-                train_recall = f"Recall of train epoch {epoch}: {round(self.metrics.calculate_recall(labels, predictions), 4)}"
-                train_precision = f"Precision of train epoch {epoch}: {round(self.metrics.calculate_precision(labels, predictions), 4)}"
-                train_f1 = f"F1 of train epoch {epoch}: {round(self.metrics.calculate_f1(labels, predictions), 4)}"
-                train_auc = f"Auc of train epoch {epoch}: {round(self.metrics.calculate_auc(labels, predictions), 4)}"
-                train_accuracy = f"Accuracy of train epoch {epoch}: {round(self.metrics.calculate_accuracy(labels, predictions), 4)}"
-                train_confusion_matrix = f"Confusion matrix of train epoch {epoch}: {self.metrics.calculate_confusion_matrix(labels, predictions)}"
-                validation_recall, validation_precision, validation_f1,\
-                validation_auc, validation_accuracy, validation_confusion_matrix, \
-                validation_predictions_vis, validation_labels = self.eval_sdae_model(epoch=epoch,
-                                                                                     autoencoder=autoencoder,
-                                                                                     batch_size=batch_size,
-                                                                                     validation=validation)
+                train_recall = f"Recall of train epoch {epoch}: {round(train['recall'], 4)}"
+                train_precision = f"Precision of train epoch {epoch}: {round(train['precision'], 4)}"
+                train_f1 = f"F1 of train epoch {epoch}: {round(train['f1'], 4)}"
+                train_auc = f"Auc of train epoch {epoch}: {round(train['auc'], 4)}"
+                train_accuracy = f"Accuracy of train epoch {epoch}: {round(train['accuracy'], 4)}"
+                train_confusion_matrix = f"Confusion matrix of train epoch {epoch}: {train['confusion_matrix']}"
                 visualization_data[f"epoch{epoch}"] = {"train_classifier": predictions_vis,
                                                        "train_labels": labels,
                                                        "train_recall": train_recall,
@@ -382,15 +799,47 @@ class Trainer(object):
                                                        "train_f1": train_f1,
                                                        "train_auc": train_auc,
                                                        "train_accuracy": train_accuracy,
-                                                       "train_confusion_matrix": train_confusion_matrix,
-                                                       "validation_classifier": validation_predictions_vis,
-                                                       "validation_labels": validation_labels,
-                                                       "validation_recall": validation_recall,
-                                                       "validation_precision": validation_precision,
-                                                       "validation_f1": validation_f1,
-                                                       "validation_auc": validation_auc,
-                                                       "validation_accuracy": validation_accuracy,
-                                                       "validation_confusion_matrix": validation_confusion_matrix}
+                                                       "train_confusion_matrix": train_confusion_matrix}
+                if async_evaluator is not None:
+                    # the validation of the previous epoch ran while this one trained, early stopping lags one epoch
+                    previous = async_evaluator.collect()
+                    stop = previous is not None and \
+                        self.record_validation(visualization_data, *previous, async_evaluator.models["SDAE"])
+                    if not stop:
+                        async_evaluator.submit(epoch, {"SDAE": autoencoder})
+                else:
+                    stop = self.record_validation(visualization_data,
+                                                  epoch,
+                                                  self.eval_sdae_model(epoch=epoch,
+                                                                       autoencoder=autoencoder,
+                                                                       batch_size=batch_size,
+                                                                       validation=validation),
+                                                  autoencoder)
+                    autoencoder.train()
+            else:
+                stop = False
+            # with --async_eval the validation of this epoch is still running, see the resume above
+            self.save_checkpoint(stage, autoencoder, epoch, visualization_data=visualization_data,
+                                 early_stopping=vars(self.early_stopping) if self.early_stopping is not None else None,
+                                 validated=async_evaluator is None)
+            if stop:
+                print(f"Early stopping at epoch {epoch}, validation {self.args.early_stopping_metric} did not improve "
+                      f"for {self.args.patience} epochs.")
+                break
+        last = async_evaluator.collect() if async_evaluator is not None else None
+        if last is not None:
+            self.record_validation(visualization_data, *last, async_evaluator.models["SDAE"])
+            self.save_checkpoint(stage, autoencoder, last[0], visualization_data=visualization_data,
+                                 early_stopping=vars(self.early_stopping) if self.early_stopping is not None else None)
+        if train_sdae and self.early_stopping is not None and self.early_stopping.best_epoch is not None:
+            # export the best model instead of the last one
+            self.early_stopping.restore(autoencoder)
+            if self.early_stopping.best_metrics is not None:
+                # the exported metrics are those of the restored weights
+                self.validation_metrics = self.early_stopping.best_metrics
+            visualization_data["best_epoch"] = f"epoch{self.early_stopping.best_epoch}"
+            print(f"Best epoch {self.early_stopping.best_epoch}: validation {self.args.early_stopping_metric} "
+                  f"{round(self.early_stopping.best_value, 4)}")
         # Copy the weights to sdae model.
         if not train_sdae:
             self.softmax_layer.copy_weights(autoencoder.softmax_layer)
@@ -398,6 +847,35 @@ class Trainer(object):
         if train_sdae:
             self.to_serialization(visualization_data)
 
+    def record_validation(self, visualization_data: Mapping, epoch: int, outputs, autoencoder: torch.nn.Module) -> bool:
+        """
+        Add the validation results of a finetune epoch to its visualization data and TensorBoard, and step early
+        stopping.
+        :param visualization_data: visualization data of the stage
+        :param epoch: evaluated epoch
+        :param outputs: output of eval_sdae_model
+        :param autoencoder: evaluated model, whose weights early stopping keeps if they are the best
+        :return: True if training should stop
+        """
+        validation_recall, validation_precision, validation_f1,\
+        validation_auc, validation_accuracy, validation_confusion_matrix, \
+        validation_predictions_vis, validation_labels = outputs
+        visualization_data.setdefault(f"epoch{epoch}", {}).update({"validation_classifier": validation_predictions_vis,
+                                                                   "validation_labels": validation_labels,
+                                                                   "validation_recall": validation_recall,
+                                                                   "validation_precision": validation_precision,
+                                                                   "validation_f1": validation_f1,
+                                                                   "validation_auc": validation_auc,
+                                                                   "validation_accuracy": validation_accuracy,
+                                                                   "validation_confusion_matrix": validation_confusion_matrix})
+        for metric in ("loss", "auc", "f1", "accuracy"):
+            self.writer.add_scalar(tag=f"SDAE Model Validation Epoch {metric.capitalize()}",
+                                   scalar_value=self.validation_metrics[metric],
+                                   global_step=epoch)
+        return self.early_stopping is not None and \
+            self.early_stopping.step(self.validation_metrics[self.args.early_stopping_metric], epoch, autoencoder,
+                                     metrics=self.validation_metrics)
+
     def eval_sdae_model(self,
                         epoch,
                         autoencoder: torch.nn.Module,
@@ -405,36 +883,44 @@ class Trainer(object):
                         validation: Optional[torch.utils.data.Dataset] = None):
         autoencoder.eval()
         dataloader = DataLoader(validation, batch_size=batch_size, pin_memory=False, shuffle=False)
-        predictions_vis, predictions, labels = [], [], []
+        streaming_metrics = StreamingMetrics(self.args.device)
+        predictions_vis, labels = [], []
         for i, batch in enumerate(tqdm(dataloader, desc=f"Eval: ")):
             batch = {key: value.to(self.args.device) for key, value in batch.items()}
             input_ids, label = batch["input_ids"], batch["label"]
             with torch.no_grad():
-                prediction = autoencoder(input_ids)
+                with autocast_context(self.args.device, self.args.precision):
+                    prediction = autoencoder(input_ids)
+                prediction = prediction.float()
                 classifier_model_loss = autoencoder.criterion(prediction, label)
                 # for tensorboard
-                self.writer.add_scalar(tag="SDAE Model with Classifier Head Validation Loss",
-                                       scalar_value=classifier_model_loss.item(),
-                                       global_step=epoch * len(dataloader) + i)
+                self.step_logger.add_scalar(tag="SDAE Model with Classifier Head Validation Loss",
+                                            scalar_value=classifier_model_loss,
+                                            global_step=epoch * len(dataloader) + i)
                 # for visualization
                 predictions_vis.append(prediction.detach())
                 labels.append(label)
                 # for metric
-                prediction = prediction.data.max(1, keepdim=True)[1]
-                predictions.append(prediction)
+                streaming_metrics.update(prediction, label, loss=classifier_model_loss)
+        # only the validation tag, training may be logging concurrently
+        self.step_logger.flush("SDAE Model with Classifier Head Validation Loss")
+        validation = streaming_metrics.compute()
+        self.validation_metrics = validation
+        print(f"Validation loss: {round(validation['loss'], 4)}")
         predictions_vis = torch.cat(predictions_vis, dim=0).cpu().numpy()
-        predictions = torch.cat(predictions, dim=0).cpu().numpy()
         labels = torch.cat(labels, dim=0).cpu().numpy()
-        validation_recall = f"Recall of validation epoch {epoch}: {round(self.metrics.calculate_recall(labels, predictions), 4)}"
-        validation_precision = f"Precision of validation epoch {epoch}: {round(self.metrics.calculate_precision(labels, predictions), 4)}"
-        validation_f1 = f"F1 of validation epoch {epoch}: {round(self.metrics.calculate_f1(labels, predictions), 4)}"
-        validation_auc = f"Auc of validation epoch {epoch}: {round(self.metrics.calculate_auc(labels, predictions), 4)}"
-        validation_accuracy = f"Accuracy of validation epoch {epoch}: {round(self.metrics.calculate_accuracy(labels, predictions), 4)}"
-        confusion_matrix = f"Confusion matrix of validation epoch {epoch}: {self.metrics.calculate_confusion_matrix(labels, predictions)}"
+        validation_recall = f"Recall of validation epoch {epoch}: {round(validation['recall'], 4)}"
+        validation_precision = f"Precision of validation epoch {epoch}: {round(validation['precision'], 4)}"
+        validation_f1 = f"F1 of validation epoch {epoch}: {round(validation['f1'], 4)}"
+        validation_auc = f"Auc of validation epoch {epoch}: {round(validation['auc'], 4)}"
+        validation_accuracy = f"Accuracy of validation epoch {epoch}: {round(validation['accuracy'], 4)}"
+        confusion_matrix = f"Confusion matrix of validation epoch {epoch}: {validation['confusion_matrix']}"
         return validation_recall, validation_precision, validation_f1, validation_auc, validation_accuracy, confusion_matrix, predictions_vis, labels
 
 
 if __name__ == "__main__":
+    # before cuda is initialized, and only when run as a script rather than on import
+    os.environ["CUDA_VISIBLE_DEVICES"] = '0'
     parser = ArgumentParser()
     parser.add_argument("--train_input_file",
                         type=str,
@@ -460,6 +946,10 @@ if __name__ == "__main__":
                         type=str,
                         default=MODEL_DIR,
                         help="Save sdae model.")
+    parser.add_argument("--checkpoint_dir",
+                        type=str,
+                        default=CHECKPOINT_DIR,
+                        help="Directory of the training checkpoints.")
     parser.add_argument("--device",
                         type=str,
                         default="cuda" if torch.cuda.is_available() else "cpu",
@@ -473,10 +963,75 @@ if __name__ == "__main__":
     parser.add_argument("--finetune_epochs", type=int, default=5, help="Number of training epochs")
     parser.add_argument("--num_workers", type=int, default=2, help="Number of subprocesses for data loading.")
     parser.add_argument("--warmup_steps", type=int, default=500, help="The steps of warm up.")
+    parser.add_argument("--encoding_cache_dir",
+                        type=str,
+                        default=None,
+                        help="Directory of the cached layer-wise encodings, None disables the cache.")
+    parser.add_argument("--encoding_cache_gb", type=float, default=20.0, help="Size bound of the encoding cache in GB.")
+    parser.add_argument("--init_model",
+                        type=str,
+                        default=None,
+                        help="Saved sdae model whose encoder layers before --pretrain_start_layer are reused.")
+    parser.add_argument("--pretrain_start_layer", type=int, default=0, help="First sub-autoencoder to pretrain.")
+    parser.add_argument("--validation_every_steps", type=int, default=None, help="Steps between pretraining validations inside an epoch.")
+    parser.add_argument("--validation_interval_seconds", type=float, default=None, help="Seconds between pretraining validations inside an epoch.")
+    parser.add_argument("--validation_subsample", type=int, default=None, help="Size of the stratified validation subsample for pretraining.")
+    parser.add_argument("--early_stopping_metric",
+                        type=str,
+                        default=None,
+                        choices=["loss", "auc", "f1", "accuracy", "recall", "precision"],
+                        help="Validation metric for early stopping of finetuning, pretraining stops on the reconstruction loss. None trains all epochs.")
+    parser.add_argument("--patience", type=int, default=3, help="Epochs without improvement before early stopping.")
+    parser.add_argument("--min_delta", type=float, default=0.0, help="Minimum change that counts as an improvement.")
+    parser.add_argument("--resume", action="store_true", help="Resume training from the last checkpoint.")
+    parser.add_argument("--log_every", type=int, default=50, help="Steps between flushes of the buffered losses to TensorBoard.")
+    parser.add_argument("--precision",
+                        type=str,
+                        default="fp32",
+                        choices=["fp32", "bf16"],
+                        help="Compute precision of forward and loss, bf16 autocasts while keeping fp32 weights.")
+    parser.add_argument("--dimensions",
+                        type=int,
+                        nargs="+",
+                        default=[1024, 512, 256, 128],
+                        help="Hidden dimensions of the sdae model after the input layer.")
+    parser.add_argument("--dropout", type=float, default=0.2, help="Masking dropout of the pretraining, 0 disables.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Intra-op threads of the process.")
+    parser.add_argument("--train_index_file", type=str, default=None, help="Optional .npy indices of the train items.")
+    parser.add_argument("--validation_index_file", type=str, default=None, help="Optional .npy indices of the validation items.")
+    parser.add_argument("--metrics_file", type=str, default=None, help="Path to write the final validation metrics as JSON.")
+    parser.add_argument("--artifact",
+                        action="store_true",
+                        help="Also save the model as an artifact directory of memory-mappable weights and metadata.")
+    parser.add_argument("--smiles_vocab",
+                        type=str,
+                        default=os.path.join(DATA_DIR, 'vocab/update_smiles_vocab.pt'),
+                        help="Path of the smiles vocab the datasets were featurized with, recorded in the artifact.")
+    parser.add_argument("--async_eval",
+                        action="store_true",
+                        help="Validate each finetune epoch on a background thread while the next epoch trains.")
+    parser.add_argument("--pretrain_schedule",
+                        type=str,
+                        default="sequential",
+                        choices=["sequential", "joint"],
+                        help="Pretrain the sub-autoencoders one after another, or all in one pass per epoch.")
+    parser.add_argument("--pretrain_library_dir",
+                        type=str,
+                        default=None,
+                        help="Directory of the library shards of fingerprints.py, pretrains out of core on the library with the joint schedule.")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000, help="Molecules in the shuffle buffer of the library stream.")
+    parser.add_argument("--low_memory_pretrain",
+                        action="store_true",
+                        help="Pretrain with tied sub-autoencoders, freed after each layer, and fp16 intermediate encodings.")
+    parser.add_argument("--perf_profile", type=str, default=None, help="Profile of autotune.py for threads, batch size and workers.")
     args = parser.parse_args()
+    apply_perf_profile(args, "SDAE")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
 
-    train_dataset = CSFPDataset(args.train_input_file)
-    validation_dataset = CSFPDataset(args.validation_input_file)
+    # a dataset prefix written by featurizer.export_memmap is memory-mapped instead of loaded
+    train_dataset = load_dataset(args.train_input_file, args.train_index_file)
+    validation_dataset = load_dataset(args.validation_input_file, args.validation_index_file)
     train_dataloader, validation_dataloader = get_dataloader(train_dataset=train_dataset,
                                                              validation_dataset=validation_dataset,
                                                              collate_fn=custom_collate_fn,
@@ -486,25 +1041,63 @@ if __name__ == "__main__":
     train_total, validation_total = len(train_dataset), len(validation_dataset)
     train_input_size = next(iter(train_dataloader))["input_ids"].shape[1]
     validation_input_size = next(iter(validation_dataloader))["input_ids"].shape[1]
-    sdae_model = StackedAutoEncoderModel(dimensions=[train_input_size, 1024, 512, 256, 128],
+    sdae_model = StackedAutoEncoderModel(dimensions=[train_input_size] + args.dimensions,
                                          final_activation=None).to(args.device)
     trainer = Trainer(args=args)
+    if args.init_model is not None:
+        sdae_model.load_state_dict(load_pickled(args.init_model, map_location=args.device).state_dict())
+    trainer.restore(sdae_model)
     print("Pretraining sdae layers stage.")
-    trainer.pretrain_sdae_layers(train_dataset,
-                                 sdae_model,
-                                 validation=validation_dataset,
-                                 epochs=args.pretrain_epochs,
-                                 batch_size=args.batch_size,
-                                 optimizer=lambda model: SGD(model.parameters(), lr=0.001, momentum=0.9),
-                                 scheduler=lambda x: StepLR(x, 100, gamma=0.1),
-                                 dropout=0.2)
+    pretrain_start_time = time.time()
+    if not trainer.stage_completed("pretrain") and args.pretrain_library_dir is not None:
+        # out of core over the unlabeled library, only the joint schedule needs no re-encoding between layers
+        library_shards, library_input_size = read_shards(args.pretrain_library_dir)
+        if library_input_size != train_input_size:
+            raise ValueError(f"The library shards have input size {library_input_size}, the datasets {train_input_size}.")
+        trainer.pretrain_sdae_layers_jointly(library_shards,
+                                             sdae_model,
+                                             validation=validation_dataset,
+                                             epochs=args.pretrain_epochs,
+                                             batch_size=args.batch_size,
+                                             optimizer=lambda model: SGD(model.parameters(), lr=0.001, momentum=0.9),
+                                             scheduler=lambda x: StepLR(x, 100, gamma=0.1),
+                                             dropout=args.dropout if args.dropout > 0 else None,
+                                             num_workers=args.num_workers,
+                                             low_memory=args.low_memory_pretrain,
+                                             shuffle_buffer=args.shuffle_buffer)
+    elif not trainer.stage_completed("pretrain") and args.pretrain_schedule == "joint":
+        trainer.pretrain_sdae_layers_jointly(train_dataset,
+                                             sdae_model,
+                                             validation=validation_dataset,
+                                             epochs=args.pretrain_epochs,
+                                             batch_size=args.batch_size,
+                                             optimizer=lambda model: SGD(model.parameters(), lr=0.001, momentum=0.9),
+                                             scheduler=lambda x: StepLR(x, 100, gamma=0.1),
+                                             dropout=args.dropout if args.dropout > 0 else None,
+                                             num_workers=args.num_workers,
+                                             low_memory=args.low_memory_pretrain)
+    elif not trainer.stage_completed("pretrain"):
+        trainer.pretrain_sdae_layers(train_dataset,
+                                     sdae_model,
+                                     validation=validation_dataset,
+                                     epochs=args.pretrain_epochs,
+                                     batch_size=args.batch_size,
+                                     optimizer=lambda model: SGD(model.parameters(), lr=0.001, momentum=0.9),
+                                     scheduler=lambda x: StepLR(x, 100, gamma=0.1),
+                                     dropout=args.dropout if args.dropout > 0 else None,
+                                     low_memory=args.low_memory_pretrain,
+                                     start_layer=args.pretrain_start_layer,
+                                     validation_scheduler=ValidationScheduler(args.validation_every_steps, args.validation_interval_seconds),
+                                     validation_subsample=args.validation_subsample)
+    print(f"Pretraining ({args.pretrain_schedule}) took {round(time.time() - pretrain_start_time, 1)} s.")
     print("Training softmax layer stage.")
-    trainer.train_softmax_layer_or_sdae_model(train_dataset,
-                                              sdae_model,
-                                              batch_size=args.batch_size,
-                                              epochs=args.classifier_epochs,
-                                              train_sdae=False,
-                                              validation=validation_dataset)
+    if not trainer.stage_completed("classifier"):
+        trainer.train_softmax_layer_or_sdae_model(train_dataset,
+                                                  sdae_model,
+                                                  batch_size=args.batch_size,
+                                                  epochs=args.classifier_epochs,
+                                                  train_sdae=False,
+                                                  validation=validation_dataset)
     print("Finetuning sdae model stage.")
     trainer.train_softmax_layer_or_sdae_model(train_dataset,
                                               sdae_model,
@@ -512,5 +1105,18 @@ if __name__ == "__main__":
                                               epochs=args.finetune_epochs,
                                               train_sdae=True,
                                               validation=validation_dataset)
-    torch.save(sdae_model, os.path.join(args.model_dir, f"sdae1024-512-256-128_model-p{args.pretrain_epochs}-c{args.classifier_epochs}-f{args.finetune_epochs}.pt"))
+    trainer.step_logger.close()
+    trainer.checkpointer.wait()
+    sdae_name = "sdae" + "-".join(str(dimension) for dimension in args.dimensions)
+    model_file = os.path.join(args.model_dir, f"{sdae_name}_model-p{args.pretrain_epochs}-c{args.classifier_epochs}-f{args.finetune_epochs}.pt")
+    torch.save(sdae_model, model_file)
+    if args.artifact:
+        save_artifact(sdae_model,
+                      os.path.splitext(model_file)[0],
+                      vocab_file=args.smiles_vocab,
+                      metrics=trainer.validation_metrics)
+    if args.metrics_file is not None:
+        with open(args.metrics_file, "w") as fp:
+            json.dump({key: value.tolist() if isinstance(value, np.ndarray) else value
+                       for key, value in trainer.validation_metrics.items()}, fp)
     pass
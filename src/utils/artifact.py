@@ -0,0 +1,178 @@
+"""
+Model artifact: a directory with metadata.json and the state_dict as one .npy file per tensor.
+
+metadata.json holds the model class and its constructor arguments, the vocab version and csfp arguments the
+inputs are encoded with, and the metrics of the model. Loading builds the model without allocating or initialising
+its weights where torch supports the meta device, and maps the tensors copy-on-write from the page cache, so worker
+processes that load the same artifact share the weight pages and need neither the pickled module nor its optimizer.
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import importlib
+import functools
+import contextlib
+import numpy as np
+import torch
+from argparse import ArgumentParser
+from typing import Dict, Mapping, Optional
+
+ARTIFACT_FORMAT = 1
+METADATA_FILE = "metadata.json"
+WEIGHTS_DIR = "weights"
+# csfpy.csfp(molecule, 2, 5) of the featurizer
+CSFP_ARGUMENTS = [2, 5]
+
+
+def vocab_version(vocab_file: Optional[str]) -> Optional[str]:
+    """sha1 of the content of the vocab file, None without one."""
+    if vocab_file is None or not os.path.exists(vocab_file):
+        return None
+    sha1 = hashlib.sha1()
+    with open(vocab_file, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 ** 2), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def model_kwargs(model: torch.nn.Module) -> Dict:
+    """Constructor arguments that rebuild the architecture of a Softmax, DNN or SDAE model."""
+    model_name = type(model).__name__
+    if model_name == "StackedAutoEncoderModel":
+        kwargs = {"dimensions": [int(dimension) for dimension in model.dimensions]}
+        if not hasattr(model.decoder[-1], "activation"):
+            kwargs["final_activation"] = None
+        return kwargs
+    elif model_name == "SoftmaxModel":
+        return {"input_size": model.softmax_model.in_features}
+    elif model_name == "DNNModel":
+        return {"input_size": model.dnn_model[0].in_features}
+    raise ValueError(f"Pass the constructor arguments of {model_name} explicitly.")
+
+
+def save_artifact(model: torch.nn.Module,
+                  artifact_dir: str,
+                  kwargs: Optional[Mapping] = None,
+                  vocab_file: Optional[str] = None,
+                  metrics: Optional[Mapping] = None) -> None:
+    """
+    :param model: model to save, its class must be importable and rebuildable from JSON constructor arguments
+    :param artifact_dir: directory of the artifact, replaced if it exists
+    :param kwargs: constructor arguments of the model, derived by model_kwargs() for the Softmax, DNN and SDAE models
+    :param vocab_file: smiles vocab the inputs of the model are encoded with
+    :param metrics: metrics of the model, numpy arrays are stored as lists
+    """
+    temporary_dir = artifact_dir.rstrip(os.sep) + ".tmp"
+    if os.path.exists(temporary_dir):
+        shutil.rmtree(temporary_dir)
+    os.makedirs(os.path.join(temporary_dir, WEIGHTS_DIR))
+    tensors = {}
+    for name, tensor in model.state_dict().items():
+        if not isinstance(tensor, torch.Tensor) or tensor.is_quantized:
+            raise ValueError(f"{name} is not a dense tensor, the model cannot be saved as an artifact.")
+        array = tensor.detach().cpu().numpy()
+        np.save(os.path.join(temporary_dir, WEIGHTS_DIR, f"{name}.npy"), array)
+        tensors[name] = {"shape": list(array.shape), "dtype": str(array.dtype)}
+    metadata = {"format": ARTIFACT_FORMAT,
+                "model_class": f"{type(model).__module__}.{type(model).__qualname__}",
+                "model_kwargs": dict(kwargs) if kwargs is not None else model_kwargs(model),
+                "vocab_version": vocab_version(vocab_file),
+                "csfp_arguments": CSFP_ARGUMENTS,
+                "metrics": {key: value.tolist() if isinstance(value, np.ndarray) else value
+                            for key, value in (metrics or {}).items()},
+                "torch_version": torch.__version__,
+                "tensors": tensors}
+    with open(os.path.join(temporary_dir, METADATA_FILE), "w") as fp:
+        json.dump(metadata, fp, indent=2)
+    if os.path.exists(artifact_dir):
+        shutil.rmtree(artifact_dir)
+    os.replace(temporary_dir, artifact_dir)
+
+
+def read_metadata(artifact_dir: str) -> Dict:
+    with open(os.path.join(artifact_dir, METADATA_FILE), "r") as fp:
+        metadata = json.load(fp)
+    if metadata.get("format") != ARTIFACT_FORMAT:
+        raise ValueError(f"Unsupported artifact format {metadata.get('format')} of {artifact_dir}.")
+    return metadata
+
+
+def check_vocab(model_file: str, vocab_file: Optional[str]) -> None:
+    """Raise if model_file is an artifact trained with another vocab than the content of vocab_file."""
+    if not os.path.isdir(model_file):
+        return
+    expected, actual = read_metadata(model_file).get("vocab_version"), vocab_version(vocab_file)
+    if expected is not None and actual is not None and expected != actual:
+        raise ValueError(f"{model_file} was trained with vocab version {expected}, {vocab_file} has version {actual}.")
+
+
+def _skeleton_device():
+    """Construct modules on the meta device (torch >= 2.0), so the weights are neither allocated nor initialised."""
+    try:
+        meta = torch.device("meta")
+    except RuntimeError:
+        return contextlib.nullcontext()
+    return meta if hasattr(meta, "__enter__") else contextlib.nullcontext()
+
+
+def load_artifact(artifact_dir: str, device: str = "cpu", trainable: bool = False) -> torch.nn.Module:
+    """
+    :param artifact_dir: directory written by save_artifact
+    :param device: device of the model, weights are only copied for a device other than the cpu
+    :param trainable: keep gradients and give the model a fresh optimizer of the class it was built with
+    :return: the model in eval mode
+    """
+    metadata = read_metadata(artifact_dir)
+    module_name, _, class_name = metadata["model_class"].rpartition(".")
+    model_class = getattr(importlib.import_module(module_name), class_name)
+    with _skeleton_device():
+        model = model_class(**metadata["model_kwargs"])
+    for name in metadata["tensors"]:
+        # copy-on-write mapping: the pages are shared until a process writes to them, never written back
+        tensor = torch.from_numpy(np.load(os.path.join(artifact_dir, WEIGHTS_DIR, f"{name}.npy"), mmap_mode="c"))
+        module_path, _, attribute = name.rpartition(".")
+        module = functools.reduce(getattr, module_path.split("."), model) if module_path else model
+        if attribute in module._parameters:
+            module._parameters[attribute] = torch.nn.Parameter(tensor, requires_grad=trainable)
+        else:
+            module._buffers[attribute] = tensor
+    if any(getattr(tensor, "is_meta", False) for tensor in list(model.parameters()) + list(model.buffers())):
+        raise ValueError(f"The artifact {artifact_dir} does not hold every tensor of {metadata['model_class']}.")
+    optimizer = getattr(model, "optimizer", None)
+    if isinstance(optimizer, torch.optim.Optimizer):
+        # the optimizer of the constructor holds the skeleton parameters
+        model.optimizer = type(optimizer)(model.parameters(), **optimizer.defaults) if trainable else None
+    if str(device) != "cpu":
+        model = model.to(device)
+    return model.eval()
+
+
+def load_model(model_file: str, device: str = "cpu") -> torch.nn.Module:
+    """Load an artifact directory or a pickled model file."""
+    # imported here, the module also runs as a script from src/utils
+    from src.utils.utils import load_pickled
+    if os.path.isdir(model_file):
+        return load_artifact(model_file, device)
+    return load_pickled(model_file, map_location=device).eval()
+
+
+if __name__ == "__main__":
+    # convert a pickled model, run from src/utils like the other scripts of this directory
+    sys.path.append(os.path.dirname(os.path.dirname(os.getcwd())))
+    parser = ArgumentParser()
+    parser.add_argument("--model_file", type=str, required=True, help="Path of the pickled model.")
+    parser.add_argument("--artifact_dir", type=str, default=None, help="Directory of the artifact, next to the model by default.")
+    parser.add_argument("--smiles_vocab", type=str, default=None, help="Path of the smiles vocab the model was trained with.")
+    parser.add_argument("--metrics_file", type=str, default=None, help="JSON metrics of the model.")
+    args = parser.parse_args()
+    metrics = None
+    if args.metrics_file is not None:
+        with open(args.metrics_file, "r") as fp:
+            metrics = json.load(fp)
+    artifact_dir = args.artifact_dir or os.path.splitext(args.model_file)[0]
+    from src.utils.utils import load_pickled
+    save_artifact(load_pickled(args.model_file, map_location="cpu"), artifact_dir, vocab_file=args.smiles_vocab, metrics=metrics)
+    print(f"Artifact written to {artifact_dir}")
+    pass
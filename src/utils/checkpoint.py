@@ -0,0 +1,69 @@
+import os
+import random
+import threading
+import numpy as np
+import torch
+from typing import Any, Mapping, Optional
+from src.utils.utils import load_pickled
+
+
+def snapshot(state: Any) -> Any:
+    """Recursively copy every tensor of a (nested) state to the CPU, so that training can keep updating the
+    originals while the snapshot is written."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().cpu().clone()
+    elif isinstance(state, Mapping):
+        return {key: snapshot(value) for key, value in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def rng_state() -> Mapping:
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Mapping) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class AsyncCheckpointer(object):
+    """
+    Write checkpoints from a background thread. save() takes a CPU snapshot of the state on the calling thread
+    and returns, the file is written to a temporary path and atomically renamed so that a crash never leaves a
+    partial checkpoint. At most one write is in flight, a new save waits for the previous one.
+    """
+    def __init__(self, checkpoint_dir: str, name: str = "checkpoint.pt"):
+        self.checkpoint_dir = checkpoint_dir
+        self.path = os.path.join(checkpoint_dir, name)
+        self.thread = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def _write(self, state: Mapping) -> None:
+        temporary_path = self.path + ".tmp"
+        torch.save(state, temporary_path)
+        os.replace(temporary_path, self.path)
+
+    def save(self, state: Mapping) -> None:
+        state = snapshot(state)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state,))
+        self.thread.start()
+
+    def wait(self) -> None:
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def load(self, map_location: Optional[str] = "cpu") -> Optional[Mapping]:
+        if not os.path.exists(self.path):
+            return None
+        # the rng state holds numpy arrays and python objects
+        return load_pickled(self.path, map_location=map_location)
@@ -0,0 +1,120 @@
+import os
+import json
+import uuid
+import hashlib
+import numpy as np
+import torch
+from typing import List, Optional, Tuple
+from torch.utils.data import Dataset, Subset
+
+
+def dataset_fingerprint(dataset: Dataset) -> Optional[str]:
+    """Identify a dataset by its source file (path, size and modification time), a Subset, e.g. a cross-validation
+    fold, by the fingerprint of its dataset and its indices.
+    :return: the fingerprint, None for a dataset without a source file, which cannot be identified"""
+    if isinstance(dataset, Subset):
+        fingerprint = dataset_fingerprint(dataset.dataset)
+        indices = hashlib.sha1(np.asarray(dataset.indices, dtype=np.int64).tobytes()).hexdigest()
+        return f"{fingerprint}[{indices}]" if fingerprint is not None else None
+    input_file = getattr(dataset, "input_file", None)
+    if input_file is not None and os.path.exists(input_file):
+        stat = os.stat(input_file)
+        return f"{os.path.abspath(input_file)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+
+class MemmapDataset(Dataset):
+    """Dataset over a memory-mapped array of encodings, items have the same form as a TensorDataset of one tensor.
+    """
+    def __init__(self, array: np.ndarray):
+        super(MemmapDataset, self).__init__()
+        self.array = array
+
+    def __getitem__(self, item: int):
+        return (torch.from_numpy(np.asarray(self.array[item], dtype=np.float32)),)
+
+    def __len__(self) -> int:
+        return self.array.shape[0]
+
+
+class EncodingCache(object):
+    """
+    Disk cache of layer-wise SDAE encodings stored as fp16 memory-mapped arrays. An entry is keyed by the dataset
+    fingerprint, the digests of the weights of the encoder layers that produced it and the compute precision, and the
+    least recently used entries are evicted once the cache grows beyond max_bytes.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def layer_digest(layer: torch.nn.Module) -> str:
+        sha1 = hashlib.sha1()
+        for name, parameter in layer.state_dict().items():
+            sha1.update(name.encode("utf-8"))
+            sha1.update(parameter.detach().cpu().float().numpy().tobytes())
+        return sha1.hexdigest()
+
+    @staticmethod
+    def key(dataset: Dataset, layer_digests: List[str], precision: str = "fp32") -> Optional[str]:
+        """
+        :param dataset: dataset of the raw fingerprints
+        :param layer_digests: layer_digest of every encoder layer from the raw fingerprints up to the encoded layer
+        :param precision: compute precision of the encoding, fp32 or bf16
+        :return: the key, None if the dataset cannot be identified
+        """
+        fingerprint = dataset_fingerprint(dataset)
+        if fingerprint is None:
+            return None
+        sha1 = hashlib.sha1(f"{fingerprint}:{precision}".encode("utf-8"))
+        for digest in layer_digests:
+            sha1.update(digest.encode("utf-8"))
+        return sha1.hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return os.path.join(self.cache_dir, f"{key}.dat"), os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        data_path, meta_path = self._paths(key)
+        if not (os.path.exists(data_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path, "r") as fp:
+            shape = tuple(json.load(fp)["shape"])
+        os.utime(meta_path)  # mark as recently used
+        return np.memmap(data_path, dtype=np.float16, mode="r", shape=shape)
+
+    def create(self, key: str, shape: Tuple[int, int]) -> np.ndarray:
+        data_path, _ = self._paths(key)
+        # unique per writer, concurrent sweep or cross validation trials may create the same entry
+        return np.memmap(f"{data_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp", dtype=np.float16, mode="w+", shape=shape)
+
+    def commit(self, key: str, array: np.memmap) -> np.ndarray:
+        data_path, meta_path = self._paths(key)
+        shape, tmp_path = array.shape, array.filename
+        array.flush()
+        del array
+        os.replace(tmp_path, data_path)
+        with open(meta_path, "w") as fp:
+            json.dump({"shape": list(shape)}, fp)
+        self.evict(keep=key)
+        return self.get(key)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".json"):
+                key = file_name[:-len(".json")]
+                data_path, meta_path = self._paths(key)
+                size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+                entries.append((os.path.getmtime(meta_path), key, size))
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
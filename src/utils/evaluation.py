@@ -0,0 +1,62 @@
+import copy
+import threading
+import torch
+from typing import Any, Callable, Mapping, Optional, Tuple
+
+
+def shadow_copy(model: torch.nn.Module) -> torch.nn.Module:
+    """Copy of a model for evaluation, without the optimizer the models of this repo carry and without gradients."""
+    memo = {id(model.optimizer): None} if hasattr(model, "optimizer") else {}
+    shadow = copy.deepcopy(model, memo)
+    for parameter in shadow.parameters():
+        parameter.requires_grad_(False)
+    return shadow.eval()
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluate on a background thread while the next epoch trains. submit() copies the weights into shadow models
+    and starts the evaluation, collect() waits for it and returns its result. At most one evaluation is in flight,
+    the shadow models keep the evaluated weights until the next submit.
+    """
+    def __init__(self, models: Mapping[str, torch.nn.Module], evaluate: Callable[[int, Mapping[str, torch.nn.Module]], Any]):
+        """
+        :param models: models whose weights are evaluated, by name
+        :param evaluate: function of epoch and shadow models by name returning the evaluation result
+        """
+        self.shadows = {name: shadow_copy(model) for name, model in models.items()}
+        self.evaluate = evaluate
+        self.thread = None
+        self.epoch, self.models, self.result, self.error = None, None, None, None
+
+    def _run(self) -> None:
+        try:
+            self.result = self.evaluate(self.epoch, self.models)
+        except Exception as error:
+            self.error = error
+
+    def submit(self, epoch: int, models: Mapping[str, torch.nn.Module]) -> None:
+        """
+        :param epoch: epoch of the weights
+        :param models: the models, or a subset of them, to evaluate
+        """
+        if self.thread is not None:
+            raise RuntimeError("Collect the pending evaluation before submitting a new one.")
+        for name, model in models.items():
+            self.shadows[name].load_state_dict(model.state_dict())
+        self.epoch, self.result, self.error = epoch, None, None
+        self.models = {name: self.shadows[name] for name in models}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def collect(self) -> Optional[Tuple[int, Any]]:
+        """
+        :return: epoch and result of the pending evaluation, None if there is none
+        """
+        if self.thread is None:
+            return None
+        self.thread.join()
+        self.thread = None
+        if self.error is not None:
+            raise self.error
+        return self.epoch, self.result
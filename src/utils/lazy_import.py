@@ -0,0 +1,25 @@
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on the first attribute access, e.g. sklearn or pandas that only
+    some code paths of a module need."""
+    def __init__(self, name: str):
+        super(LazyModule, self).__init__(name)
+        self._module = None
+
+    def __getattr__(self, attribute: str):
+        if attribute == "_module":
+            raise AttributeError(attribute)
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return getattr(self._module, attribute)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    :param name: full name of the module, e.g. "sklearn.metrics"
+    :return: a module that is imported when it is first used
+    """
+    return LazyModule(name)
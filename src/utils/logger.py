@@ -0,0 +1,51 @@
+import queue
+import threading
+import torch
+from typing import Optional
+
+
+class AsyncStepLogger(object):
+    """Buffer per-step scalars as device tensors and write them to TensorBoard from a background thread.
+    Buffers are moved to the CPU in one transfer every flush_every steps or on flush(), and the written
+    curves are the same as calling writer.add_scalar(value.item()) on every step. A writer of None disables
+    logging, e.g. on the non-zero ranks of distributed training.
+    """
+    def __init__(self, writer, flush_every: int = 50):
+        self.writer = writer
+        self.flush_every = flush_every
+        self.buffers = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag: str, scalar_value: torch.Tensor, global_step: int) -> None:
+        if self.writer is None:
+            return
+        buffer = self.buffers.setdefault(tag, [])
+        buffer.append((global_step, scalar_value.detach()))
+        if len(buffer) >= self.flush_every:
+            self.flush(tag)
+
+    def flush(self, tag: Optional[str] = None) -> None:
+        for buffer_tag in ([tag] if tag is not None else list(self.buffers)):
+            buffer = self.buffers.pop(buffer_tag, [])
+            if buffer:
+                steps = [global_step for global_step, _ in buffer]
+                values = torch.stack([value.float() for _, value in buffer]).cpu().tolist()
+                self.queue.put((buffer_tag, steps, values))
+
+    def _write(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            tag, steps, values = item
+            for global_step, value in zip(steps, values):
+                self.writer.add_scalar(tag=tag, scalar_value=value, global_step=global_step)
+
+    def close(self) -> None:
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.writer is not None:
+            self.writer.flush()
@@ -1,6 +1,11 @@
-from sklearn import metrics
-from typing import List
-import pandas as pd
+from typing import List, Mapping, Optional
+import numpy as np
+import torch
+import torch.distributed
+from src.utils.lazy_import import lazy_import
+# only the epoch metrics and the cross-validation summary need them
+metrics = lazy_import("sklearn.metrics")
+pd = lazy_import("pandas")
 
 
 class Metrics(object):
@@ -28,3 +33,81 @@ class Metrics(object):
 
     def calculate_confusion_matrix(self, y_true: List, y_pred: List):
         return metrics.confusion_matrix(y_true, y_pred)
+
+    def aggregate(self, fold_metrics: List[Mapping]) -> "pd.DataFrame":
+        """
+        Mean and standard deviation of every scalar metric over the folds of a cross-validation.
+        :param fold_metrics: metrics of every fold, e.g. the output of StreamingMetrics.compute
+        :return: data frame indexed by metric with mean and std columns
+        """
+        table = pd.DataFrame([{key: value for key, value in fold.items() if np.isscalar(value)} for fold in fold_metrics])
+        return pd.DataFrame({"mean": table.mean(), "std": table.std(ddof=1) if len(table) > 1 else 0.0})
+
+
+class StreamingMetrics(object):
+    """
+    Binary classification metrics updated per batch on the device of the model, with constant memory: a 2x2
+    confusion matrix, a fixed-bin histogram of the positive class probability per true class, and the loss sum.
+    Recall, precision, F1, accuracy and ROC-AUC are derived from these counters in O(num_bins), the AUC from
+    probabilities rather than argmax labels.
+    """
+    def __init__(self, device: str, num_bins: int = 1000):
+        self.device = device
+        self.num_bins = num_bins
+        self.reset()
+
+    def reset(self) -> None:
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.count = torch.zeros((), dtype=torch.long, device=self.device)
+        self.confusion = torch.zeros(2, 2, dtype=torch.long, device=self.device)
+        self.histogram = torch.zeros(2, self.num_bins, dtype=torch.long, device=self.device)
+
+    def update(self, logits: torch.Tensor, labels: torch.Tensor, loss: Optional[torch.Tensor] = None) -> None:
+        """
+        :param logits: two-class logits of the batch, [batch_size, 2]
+        :param labels: true class of every sample, [batch_size]
+        :param loss: optional mean loss of the batch
+        """
+        labels = labels.view(-1)
+        probabilities = torch.softmax(logits.detach().float(), dim=1)
+        predictions = probabilities.argmax(dim=1)
+        bins = (probabilities[:, 1] * self.num_bins).long().clamp_(max=self.num_bins - 1)
+        self.confusion += torch.bincount(labels * 2 + predictions, minlength=4).view(2, 2)
+        self.histogram += torch.bincount(labels * self.num_bins + bins, minlength=2 * self.num_bins).view(2, self.num_bins)
+        self.count += labels.numel()
+        if loss is not None:
+            self.loss_sum += loss.detach().float() * labels.numel()
+
+    def all_reduce(self, group=None) -> None:
+        """
+        Sum the counters over all processes of distributed training.
+        :param group: process group, defaults to the global one
+        """
+        for counter in (self.loss_sum, self.count, self.confusion, self.histogram):
+            torch.distributed.all_reduce(counter, group=group)
+
+    def compute(self) -> Mapping:
+        """
+        :return: loss, recall, precision, f1, auc, accuracy and confusion matrix (rows are true classes)
+        """
+        confusion, histogram = self.confusion.cpu().numpy(), self.histogram.cpu().numpy()
+        count = int(self.count.item())
+        (tn, fp), (fn, tp) = confusion
+        recall = tp / (tp + fn) if tp + fn > 0 else 0.0
+        precision = tp / (tp + fp) if tp + fp > 0 else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        accuracy = (tp + tn) / count if count > 0 else 0.0
+        # P(score of a positive > score of a negative), ties within a bin count one half
+        negatives, positives = histogram[0][::-1].astype(np.float64), histogram[1][::-1].astype(np.float64)
+        positives_above = np.cumsum(positives) - positives
+        if negatives.sum() > 0 and positives.sum() > 0:
+            auc = float((negatives * (positives_above + 0.5 * positives)).sum() / (negatives.sum() * positives.sum()))
+        else:
+            auc = float("nan")
+        return {"loss": self.loss_sum.item() / max(count, 1),
+                "recall": float(recall),
+                "precision": float(precision),
+                "f1": float(f1),
+                "auc": auc,
+                "accuracy": float(accuracy),
+                "confusion_matrix": confusion}
@@ -0,0 +1,86 @@
+import hashlib
+import threading
+import collections
+import numpy as np
+import torch
+from typing import Dict, Iterable, Optional
+from src.utils.artifact import vocab_version
+
+
+def fingerprint_hash(indices: Iterable[int]) -> str:
+    """Canonical hash of a fingerprint: its set of active indices, independent of the molecule name and order."""
+    return hashlib.sha1(np.unique(np.asarray(list(indices), dtype=np.int64)).tobytes()).hexdigest()
+
+
+def model_version(model: torch.nn.Module, vocab_file: Optional[str] = None) -> str:
+    """Identify a model by its weights and the content of the vocab its inputs are encoded with."""
+    sha1 = hashlib.sha1()
+    for name, parameter in model.state_dict().items():
+        sha1.update(name.encode("utf-8"))
+        sha1.update(parameter.detach().cpu().float().numpy().tobytes())
+    vocab = vocab_version(vocab_file)
+    if vocab is not None:
+        sha1.update(vocab.encode("utf-8"))
+    return sha1.hexdigest()
+
+
+class PredictionCache(object):
+    """
+    In-memory LRU cache of predictions keyed by model version and fingerprint hash, bounded by the number of entries
+    and their approximate size in bytes. Predictions of another model version or vocab never hit, and are evicted as
+    the least recently used entries or at once with invalidate().
+    """
+    # dictionary slot, key tuple and strings, and the value object of an entry
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_entries: int = 1000000, max_bytes: int = 512 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def _size(self, value) -> int:
+        return self.ENTRY_OVERHEAD + (value.nbytes if isinstance(value, np.ndarray) else 0)
+
+    def get(self, fingerprint: str, version: str):
+        """
+        :return: the cached prediction, None on a miss
+        """
+        key = (version, fingerprint)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, fingerprint: str, version: str, value) -> None:
+        key = (version, fingerprint)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self._size(self.entries.pop(key))
+            self.entries[key] = value
+            self.bytes += self._size(value)
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= self._size(evicted)
+                self.evictions += 1
+
+    def invalidate(self, version: Optional[str] = None) -> None:
+        """Drop the predictions of a model version, or all of them."""
+        with self.lock:
+            for key in [key for key in self.entries if version is None or key[0] == version]:
+                self.bytes -= self._size(self.entries.pop(key))
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {"cache_entries": len(self.entries),
+                "cache_bytes": self.bytes,
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "cache_evictions": self.evictions,
+                "cache_hit_rate": self.hits / lookups if lookups else 0.0}
@@ -1,9 +1,16 @@
-import pandas as pd
-from collections import Mapping
+import os
+import sys
+import json
+import inspect
+import resource
+import threading
+import contextlib
+from collections.abc import Mapping
+from typing import Any, List, Optional
 import torch
 
 
-def assert_statistics(features: pd.DataFrame, labels: pd.DataFrame, dataset: pd.DataFrame):
+def assert_statistics(features: "pd.DataFrame", labels: "pd.DataFrame", dataset: "pd.DataFrame"):
     print(f"Features shape: {features.shape}")  # 1452
     print(f"Labels shape: {labels.shape}")      # 1458
     feature_names = set(features.index)
@@ -21,6 +28,16 @@ def assert_statistics(features: pd.DataFrame, labels: pd.DataFrame, dataset: pd.
     pass
 
 
+def load_pickled(path: str, map_location: Optional[str] = None) -> Any:
+    """
+    torch.load of a file holding python objects, e.g. a pickled model or a checkpoint, which torch>=2.6 refuses to
+    unpickle by default. Only load files of this project, unpickling runs arbitrary code.
+    """
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+
 def custom_collate_fn(batch):
     elem = batch[0]
     columns = ["input_ids", "label"]
@@ -30,3 +47,128 @@ def custom_collate_fn(batch):
         return torch.stack(batch, dim=0)
     else:
         return batch
+
+
+def autocast_context(device: str, precision: str = "fp32"):
+    """
+    Autocast context for the forward pass and loss. With precision "bf16" the matmuls run in bfloat16 while the
+    parameters (master weights) and optimizer state stay in fp32; "fp32" returns an empty context, so fp32
+    training also runs on torch versions without torch.autocast.
+    :param device: device string, e.g. cpu or cuda
+    :param precision: fp32 or bf16
+    """
+    if precision not in ("fp32", "bf16"):
+        raise ValueError(f"Unsupported precision: {precision}.")
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if not hasattr(torch, "autocast"):
+        raise RuntimeError(f"bf16 needs torch.autocast of torch>=1.10, torch {torch.__version__} is installed.")
+    device_type = "cuda" if str(device).startswith("cuda") else "cpu"
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+
+
+def peak_memory_mb(device: str) -> float:
+    """Peak memory of the process in MB, allocator peak for cuda and max resident set size for cpu."""
+    if str(device).startswith("cuda"):
+        return torch.cuda.max_memory_allocated() / 1024 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_memory_mb(device: str) -> Optional[float]:
+    """
+    Memory in use now in MB, allocated by the cuda allocator or the resident set size of a cpu process read from
+    /proc/self/statm. Unlike the max resident set size it also goes down, so differences measure a step.
+    :return: the memory, or None where /proc is not available
+    """
+    if str(device).startswith("cuda"):
+        return torch.cuda.memory_allocated() / 1024 ** 2
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            resident_pages = int(fp.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+class MemorySampler(object):
+    """
+    Peak of current_memory_mb over a span of work, sampled on a background thread. The max resident set size of a
+    cpu process cannot be reset, so this is the peak of a span on cpu; transients shorter than the interval can be
+    missed.
+    """
+    def __init__(self, device: str, interval: float = 0.05):
+        self.device = device
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _sample(self) -> None:
+        memory = current_memory_mb(self.device)
+        if memory is not None and (self.peak is None or memory > self.peak):
+            self.peak = memory
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def start(self) -> "MemorySampler":
+        self.peak = None
+        self.stopped.clear()
+        self._sample()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> Optional[float]:
+        """
+        :return: the peak in MB, None where the memory cannot be read
+        """
+        self.stopped.set()
+        self.thread.join()
+        self._sample()
+        return self.peak
+
+
+def reset_peak_memory(device: str) -> None:
+    """Reset the cuda allocator peak, the max resident set size of a cpu process cannot be reset."""
+    if str(device).startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats()
+
+
+def model_logits(model: torch.nn.Module, input_ids: torch.Tensor) -> torch.Tensor:
+    """
+    Two-class logits of any classifier model. The Capsule model returns (capsules, encoded) and its logits are
+    the lengths of the output capsules.
+    """
+    output = model(input_ids)
+    if isinstance(output, tuple):
+        return torch.sqrt((output[0].float() ** 2).sum(dim=2))
+    return output
+
+
+def apply_perf_profile(args, model_name: str, argv: Optional[List[str]] = None) -> None:
+    """
+    Replace num_threads, batch_size and num_workers of the parsed arguments with the best configuration of the
+    model in the profile written by autotune.py, if args.perf_profile is set and holds the model. Values given
+    explicitly on the command line are kept.
+    :param args: parsed arguments of a trainer
+    :param model_name: key of the model in the profile, e.g. Softmax, DNN, Capsule or SDAE
+    :param argv: command line arguments, defaults to sys.argv[1:]
+    """
+    if getattr(args, "perf_profile", None) is None:
+        return
+    with open(args.perf_profile, "r") as fp:
+        profile = json.load(fp)
+    if model_name not in profile:
+        print(f"No configuration of {model_name} in {args.perf_profile}.")
+        return
+    argv = sys.argv[1:] if argv is None else argv
+    for key in ("num_threads", "batch_size", "num_workers"):
+        if key not in profile[model_name]:
+            continue
+        if any(arg == f"--{key}" or arg.startswith(f"--{key}=") for arg in argv):
+            print(f"Keep --{key} {getattr(args, key)} of the command line instead of {profile[model_name][key]} of the perf profile.")
+            continue
+        setattr(args, key, profile[model_name][key])
+    print(f"Perf profile of {model_name}: {profile[model_name]}")
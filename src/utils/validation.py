@@ -0,0 +1,95 @@
+import time
+import numpy as np
+import torch
+from typing import Dict, List, Optional, Sequence
+from src.utils.checkpoint import snapshot
+
+
+class ValidationScheduler(object):
+    """Decide when to validate inside an epoch: every N training steps and/or once a time budget has elapsed since
+    the last validation. With neither set it is never due and validation only runs at epoch end.
+    """
+    def __init__(self, every_steps: Optional[int] = None, every_seconds: Optional[float] = None):
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.last_time = time.time()
+
+    def due(self, step: int) -> bool:
+        if self.every_steps is not None and step > 0 and step % self.every_steps == 0:
+            return True
+        return self.every_seconds is not None and time.time() - self.last_time >= self.every_seconds
+
+    def reset(self) -> None:
+        self.last_time = time.time()
+
+
+def stratified_subsample(size: int, total: int, labels: Optional[Sequence[int]] = None, seed: int = 42) -> List[int]:
+    """
+    Fixed subsample of indices keeping the class proportions of the labels, or uniform when no labels are given.
+    :param size: number of indices to draw
+    :param total: size of the dataset
+    :param labels: optional label of every item
+    :param seed: seed of the draw, so that every evaluation sees the same subsample
+    :return: sorted indices
+    """
+    if size >= total:
+        return list(range(total))
+    rng = np.random.RandomState(seed)
+    if labels is None:
+        return sorted(rng.choice(total, size, replace=False).tolist())
+    labels = np.asarray(labels)
+    indices = []
+    for label in np.unique(labels):
+        label_indices = np.flatnonzero(labels == label)
+        label_size = max(1, int(round(size * len(label_indices) / total)))
+        indices.extend(rng.choice(label_indices, min(label_size, len(label_indices)), replace=False).tolist())
+    return sorted(indices)
+
+
+class EarlyStopping(object):
+    """
+    Patience-based early stopping on a validation metric that keeps the weights of the best epoch in memory.
+    """
+    def __init__(self, metric: str = "auc", patience: int = 3, min_delta: float = 0.0):
+        """
+        :param metric: name of the validation metric, "loss" is minimized and every other metric maximized
+        :param patience: number of epochs without improvement before stopping
+        :param min_delta: minimum change of the metric that counts as an improvement
+        """
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.reset()
+
+    def reset(self) -> None:
+        self.best_value = None
+        self.best_epoch = None
+        self.best_state = None
+        self.best_metrics = None
+        self.bad_epochs = 0
+
+    def improved(self, value: float) -> bool:
+        if self.best_value is None:
+            return True
+        if self.metric == "loss":
+            return value < self.best_value - self.min_delta
+        return value > self.best_value + self.min_delta
+
+    def step(self, value: float, epoch: int, model: torch.nn.Module, metrics: Optional[Dict] = None) -> bool:
+        """
+        Record the validation value of an epoch.
+        :param metrics: optional validation metrics of the epoch, kept with the weights of the best epoch
+        :return: True if training should stop
+        """
+        if self.improved(value):
+            self.best_value, self.best_epoch, self.bad_epochs = value, epoch, 0
+            self.best_state = snapshot(model.state_dict())
+            self.best_metrics = dict(metrics) if metrics is not None else None
+        else:
+            self.bad_epochs += 1
+        return self.bad_epochs >= self.patience
+
+    def restore(self, model: torch.nn.Module) -> None:
+        """Load the best weights back into the model."""
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
@@ -76,19 +76,19 @@ if __name__ == "__main__":
     """Classifier Model: Softmax, DNN, SDAE"""
     # softmax model
     softmax_vis = torch.load("../../data/visualization/visualization_Softmax.pt")
-    softmax_predicts, softmax_labels = softmax_vis["epoch4"]["validation_classifier"], softmax_vis["epoch4"]["validation_labels"]
+    softmax_predicts, softmax_labels = softmax_vis[softmax_vis.get("best_epoch", "epoch4")]["validation_classifier"], softmax_vis[softmax_vis.get("best_epoch", "epoch4")]["validation_labels"]
 
     # dnn model
     dnn_vis = torch.load("../../data/visualization/visualization_DNN.pt")
-    dnn_predicts, dnn_labels = dnn_vis["epoch1"]["validation_classifier"], dnn_vis["epoch1"]["validation_labels"]
+    dnn_predicts, dnn_labels = dnn_vis[dnn_vis.get("best_epoch", "epoch1")]["validation_classifier"], dnn_vis[dnn_vis.get("best_epoch", "epoch1")]["validation_labels"]
 
     # sdae model
     sdae_vis = torch.load("../../data/visualization/visualization_SDAE-p3-c3-f5_ext.pt")
-    sdae_predicts, sdae_labels = sdae_vis["epoch1"]["validation_classifier"], sdae_vis["epoch1"]["validation_labels"]
+    sdae_predicts, sdae_labels = sdae_vis[sdae_vis.get("best_epoch", "epoch1")]["validation_classifier"], sdae_vis[sdae_vis.get("best_epoch", "epoch1")]["validation_labels"]
 
     # capsule model
     capsule_vis = torch.load("../../data/visualization/visualization_Capsule_ext.pt")
-    capsule_predicts, capsule_labels = capsule_vis["epoch2"]["validation_classifier"], capsule_vis["epoch2"]["validation_labels"]
+    capsule_predicts, capsule_labels = capsule_vis[capsule_vis.get("best_epoch", "epoch2")]["validation_classifier"], capsule_vis[capsule_vis.get("best_epoch", "epoch2")]["validation_labels"]
     capsule_predicts = capsule_predicts.sum(axis=-1)
 
     plot_roc(softmax_predicts, softmax_labels, "Softmax Model")